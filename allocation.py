@@ -1,102 +1,512 @@
-from support.linked_list import Node, LinkedList
+from support.buddy_map import BuddyMap
+from support.copy_on_write import CopyOnWriteMap, ForkedFileTable
+from support.free_map import FreeMap, FreeMapFork
+from support.hole_tree import HoleTree
+from support.interval_index import IntervalIndex
+from support.journal import Journal, journaled
+from support.metrics import Metrics, instrumented
+from support.size_class_pools import SizeClassPools
+from support.snapshot import Snapshot, SnapshotFileTable
+import copy
+import heapq
 import math
+import os
+import time
+
+# Units sizes may be given in, each 1024 times the one before
+UNITS = ['b', 'kb', 'mb', 'gb', 'tb']
+
+def to_bytes(size: int, unit: str) -> int:
+    '''
+    Translates size to bytes according to given unit, one of UNITS in any case
+    '''
+    if not isinstance(unit, str) or unit.lower() not in UNITS:
+        raise ValueError('Incorrect unit, must be one of b, kb, mb, gb, or tb')
+    return size * 1024**UNITS.index(unit.lower())
 
 class Allocation:
-    def __init__(self, capacity: int, block: int, capacity_unit: str = 'mb', block_unit: str = 'kb', allocation_algorithm: str = 'best') -> None:
+    def __init__(self, capacity: int, block: int, capacity_unit: str = 'mb', block_unit: str = 'kb', allocation_algorithm: str = 'best', backend: str = 'list', size_classes: tuple = None, pool_refill: int = 16, metrics: bool = False, scatter: bool = False) -> None:
         '''
-        Initializes an object that represents a single file manager. Four private instance variables are created:
-            capacity_used: amount of capacity used in Bytes
+        Initializes an object that represents a single file manager. Several private instance variables are created:
+            capacity_used: amount of capacity used in Bytes (including blocks reserved but unused by buddy allocation or
+                           size class rounding, and capacity set aside by reserve)
+            internal_fragmentation: amount of capacity reserved by buddy allocation or size class rounding beyond what
+                                    files need in Bytes
             capacity: amount of capacity available in Bytes
             block: size of block in Bytes
-            available: linked list that tracks remaining empty space
-            cache: hashmap (dict) that is used to store file_id -> list of assigned blocks for quick retrival
+            available: free map that tracks remaining empty space, either as runs of adjacent blocks or as a bitmap
+            backend: name of the structure used for available
+            cache: hashmap (dict) that is used to store file_id -> tuple of (start, count) extents of assigned blocks
+                   for quick retrival. Files are stored contiguously where possible, so this is usually a single
+                   extent regardless of file size
             allocation_algorithm: algorithm chosen to allocate blocks
+            scatter: whether files may be split across several chunks when no single chunk is large enough
+            pools: per size class free lists of slots for small files, or None if not enabled
+            metrics: operation counters and histograms, or None if not enabled
+            listeners: callbacks notified when a file is saved or deleted
+            journal: write-ahead journal of placements, or None if not open
+            reservations: hashmap (dict) of file_id -> (capacity set aside in Bytes, expiry time or None) for files
+                          reserved but not yet committed
+            reservation_expiry: heap of (expiry time, file_id) of reservations that expire. Entries for reservations
+                                since committed or released are skipped when they reach the top.
+            capacity_reserved: total capacity set aside by reservations in Bytes
+            owners: index of the blocks held by each extent of every file, answering owner and owners, or None until
+                    first needed
+            batch_floors: during save_many, hashmap (dict) of blocks needed -> block where the last first fit search
+                          for that many blocks succeeded, or None outside of a batch
+            pending_moves: tuple of the last compaction plan and the index of its next move, as far as budgeted calls
+                           have carried it out, or None. Dropped as soon as any file is saved, deleted or moved other
+                           than by compact.
 
         :param capacity: Total capacity of memory
         :param block: Size of block of memory
         :param capacity_unit: Unit used for capacity. Must be one of B, KB, MB, GB, or TB. Defaults to MB.
         :param block_unit: Unit used for block size. Must be one of B, KB, MB, GB, or TB. Defaults to KB.
-        :param allocation_algorithm: Algorithm used for allocation. Either 'best' or 'first'. Defaults to best if
-                                     nothing passed.
+        :param allocation_algorithm: Algorithm used for allocation. One of 'best', 'first', 'next' or 'buddy'.
+                                     Defaults to best if nothing passed.
+        :param backend: Structure used to track empty space. Either 'list' (linked list of free extents) or 'bitmap'
+                        (NumPy bitmap with one byte per block, requires numpy). Defaults to list.
+        :param size_classes: Slot sizes in blocks for small files, e.g. (1, 2, 3, 4). Files no larger than the largest
+                             class are given the smallest slot that fits from a per class free list, which is refilled
+                             in bulk from the free map, so saving and deleting them is O(1). Larger files use the
+                             allocation algorithm as normal. Not enabled if nothing passed.
+        :param pool_refill: Number of slots carved from the free map at once when a size class runs out. Defaults to
+                            16.
+        :param metrics: Whether to record operation counts, latency histograms, free map entries examined per search
+                        and bytes allocated and freed, which are then included in stats(). Defaults to False, in which
+                        case no timing is done.
+        :param scatter: Whether a file may be split across several chunks when no single chunk is large enough for it,
+                        using as few chunks as possible. Files that fit in a size class are never split. Defaults to
+                        False, in which case such saves fail.
         '''
         self._capacity_used = 0
+        self._internal_fragmentation = 0
         self._allocation_algorithm = allocation_algorithm
+        self._scatter = scatter
+        if scatter and allocation_algorithm == 'buddy':
+            raise ValueError('Scattered files cannot be used with buddy allocation')
 
         # Translate all amounts to bytes for standardization
         self._block = self._to_bytes(block, block_unit)
         self._capacity = self._to_bytes(capacity, capacity_unit)
 
         num_blocks = int(self._capacity/self._block)
-        print('Number of Blocks: {}'.format(str(num_blocks)))
 
-        print('Creating block list...')
-        self._available = LinkedList()
-        self._available.fill(num_blocks)
-        print('Creating cache...')
+        self._backend = backend
+        self._available = self._create_free_map(backend, num_blocks)
+        self._pools = None
+        if size_classes:
+            if allocation_algorithm == 'buddy':
+                raise ValueError('Size classes cannot be used with buddy allocation')
+            self._pools = SizeClassPools(size_classes, pool_refill)
         self._cache = {}
-        print('Done!')
+        self._metrics = Metrics() if metrics else None
+        self._listeners = []
+        self._journal = None
+        self._reservations = {}
+        self._reservation_expiry = []
+        self._capacity_reserved = 0
+        self._owners = None
+        self._batch_floors = None
+        self._pending_moves = None
 
-    def save(self, file_id: str, size: int, size_unit: str) -> list:
+    @instrumented('save')
+    @journaled
+    def save(self, file_id: str, size: int, size_unit: str, as_list: bool = False, near=None) -> range:
         '''
-        Takes file_id and saves it in a given location, returns list of blocks that is assigned to the file
+        Takes file_id and saves it in a given location, returns range of blocks that is assigned to the file. If the
+        file had to be split across several chunks, a list of ranges is returned instead, one per chunk.
 
         :param file_id: desired file_id as a string
         :param size: size of given file
         :param size_unit: unit used for file size. Must be one of B, KB, MB, or GB
-        :return: list of blocks that is assigned to the file given
+        :param as_list: return the blocks as a list rather than a range. Defaults to False.
+        :param near: file_id of a file to place this one just after, or block to place it at, if possible. With first
+                     and best fit, the file goes in the free chunk nearest that position among those around it that
+                     are large enough, and is placed by the allocation algorithm as usual if there are none. The hint
+                     is ignored for other algorithms, for files given a size class slot, and if the file does not
+                     exist, but a block that is not on the device is an error. Not used if nothing passed.
+        :return: range of blocks that is assigned to the file given
         '''
-        if self._cache.get(file_id):
+        return self._location(self._save(file_id, size, size_unit, near), as_list)
+
+    @instrumented('save_many')
+    @journaled
+    def save_many(self, files: list, as_list: bool = False) -> list:
+        '''
+        Saves many files in one pass, in order. Placement is the same as calling save for each file, but first fit
+        searches resume where earlier searches in the batch for as many or fewer blocks left off instead of starting
+        from the first free chunk each time. A file that cannot be saved does not stop the rest of the batch.
+
+        :param files: list of (file_id, size, size_unit) tuples
+        :param as_list: return the blocks as lists rather than ranges. Defaults to False.
+        :return: list with, for each file in order, the range of blocks assigned to it or the ValueError explaining
+                 why it could not be saved
+        '''
+        results = []
+        self._batch_floors = {}
+        try:
+            for file_id, size, size_unit in files:
+                try:
+                    results.append(self._location(self._save(file_id, size, size_unit), as_list))
+                except ValueError as e:
+                    results.append(e)
+        finally:
+            self._batch_floors = None
+        return results
+
+    @instrumented('reserve')
+    def reserve(self, file_id: str, size: int, size_unit: str, ttl: float = 60.0) -> None:
+        '''
+        Sets aside capacity for a file whose final size is not known yet, without placing it. The capacity, rounded up
+        as saving a file of that size would be, counts as used until the file is committed, the reservation is
+        released, or it expires. Deciding placement at commit time, when the size is known and other reservations can
+        be placed alongside it, avoids placing files at guessed sizes and moving them later.
+
+        :param file_id: desired file_id as a string
+        :param size: estimated size of the file
+        :param size_unit: unit used for file size. Must be one of B, KB, MB, or GB
+        :param ttl: seconds after which the reservation is released if not committed, or None to keep it until then.
+                    Defaults to 60.
+        '''
+        self._expire_reservations()
+        if self._cache.get(file_id) or file_id in self._reservations:
             raise ValueError('file_id already exists')
         if size <= 0:
             raise ValueError('Size must be greater than 0')
 
-        print('Saving file...')
-        size = self._to_bytes(size, size_unit)
-
-        if size > self.get_capacity_remaining():
+        reserved = self._capacity_needed(self._to_bytes(size, size_unit))
+        if reserved > self.get_capacity_remaining():
             raise ValueError('Not enough capacity to store file')
 
-        # First fit approach
-        location = []
-        if self._allocation_algorithm == 'best':
-            location = self._allocate_best_location(size)
-        else:
-            location = self._allocate_first_location(size)
-        self._cache_location(file_id, location)
-        self._update_capacity_used(self._block * len(location))
-        return location
+        expires = None if ttl is None else time.monotonic() + ttl
+        self._reservations[file_id] = (reserved, expires)
+        self._capacity_reserved += reserved
+        self._capacity_used += reserved
+        if expires is not None:
+            heapq.heappush(self._reservation_expiry, (expires, file_id))
+
+    def release(self, file_id: str) -> None:
+        '''
+        Gives up a reservation made by reserve without saving the file
 
+        :param file_id: desired file_id as a string
+        '''
+        if file_id not in self._reservations:
+            raise ValueError('file_id has no reservation')
+        self._release_reservation(file_id)
+
+    @instrumented('commit')
+    @journaled
+    def commit(self, file_id: str, size: int, size_unit: str, as_list: bool = False) -> range:
+        '''
+        Saves a reserved file now that its final size is known, which may differ from the estimate. See commit_many.
+
+        :param file_id: desired file_id as a string
+        :param size: final size of the file
+        :param size_unit: unit used for file size. Must be one of B, KB, MB, or GB
+        :param as_list: return the blocks as a list rather than a range. Defaults to False.
+        :return: range of blocks that is assigned to the file given
+        '''
+        result = self._commit_many([(file_id, size, size_unit)], as_list)[0]
+        if isinstance(result, ValueError):
+            raise result
+        return result
+
+    @instrumented('commit_many')
+    @journaled
+    def commit_many(self, files: list, as_list: bool = False) -> list:
+        '''
+        Saves many reserved files in one pass. Their reservations are released and the files are placed largest first,
+        which packs them more tightly than placing them in the order they happen to finish, with first fit searches
+        resuming as in save_many. A file that cannot be placed keeps its reservation and does not stop the rest of
+        the batch.
+
+        :param files: list of (file_id, size, size_unit) tuples, giving the final size of each file
+        :param as_list: return the blocks as lists rather than ranges. Defaults to False.
+        :return: list with, for each file in order, the range of blocks assigned to it or the ValueError explaining
+                 why it could not be saved
+        '''
+        return self._commit_many(files, as_list)
+
+    @instrumented('delete')
+    @journaled
     def delete(self, file_id: str) -> None:
         '''
         Removes allocation for provided file_id, and returns its blocks to the pool to be re-allocated.
 
         :param file_id: desired file_id as a string
         '''
-        print('Deleting file...')
-        location = self._cache.get(file_id)
-        if location:
-            del(self._cache[file_id])
-            self._add_availability(location)
-            self._update_capacity_used(-1 * self._block * len(location))
-            print('File deleted, blocks ready to be reallocated!')
+        extents = self._cache.get(file_id)
+        if extents:
+            self._uncache_location(file_id)
+            self._add_availability(extents)
+            self._account_location(extents, -1)
         else:
             raise ValueError('file_id does not exist')
 
-    def read(self, file_id: str) -> list:
+    @instrumented('delete_many')
+    @journaled
+    def delete_many(self, file_ids: list) -> list:
+        '''
+        Removes allocation for many files at once. The freed chunks are sorted and merged with each other and with the
+        free map in a single pass. A file that cannot be deleted does not stop the rest of the batch.
+
+        :param file_ids: list of file_ids as strings
+        :return: list with, for each file_id in order, None if it was deleted or the ValueError explaining why not
         '''
-        Return blocks allocated to file in a list. Uses cache to look up location.
+        results = []
+        locations = []
+        for file_id in file_ids:
+            extents = self._cache.get(file_id)
+            if extents:
+                self._uncache_location(file_id)
+                self._account_location(extents, -1)
+                locations.append(extents)
+                results.append(None)
+            else:
+                results.append(ValueError('file_id does not exist'))
+        self._add_availability_many(locations)
+        return results
+
+    @instrumented('read')
+    def read(self, file_id: str, as_list: bool = False) -> range:
+        '''
+        Return blocks allocated to file as a range, or a list of ranges if the file is split across several chunks.
+        Uses cache to look up location.
 
         :param file_id: desired file_id as a string
-        :return: list of blocks allocated to the file
+        :param as_list: return the blocks as a list rather than a range. Defaults to False.
+        :return: range of blocks allocated to the file
         '''
-        print('Reading file...')
-        location = self._cache.get(file_id)
-        if location:
-            print('Returning file location!')
-            return location
+        extents = self._cache.get(file_id)
+        if extents:
+            return self._location(extents, as_list)
         else:
             raise ValueError('file_id does not exist')
 
+    @instrumented('resize')
+    @journaled
+    def resize(self, file_id: str, size: int, size_unit: str) -> bool:
+        '''
+        Changes the size of a saved file, keeping it where it is whenever possible. A file shrinks in place by
+        returning the blocks past its new end to the free map, and grows in place if the blocks just past its end are
+        free. Otherwise it is moved to a new location found as for save, which needs room for the new size alongside
+        the current one; if there is none the file is left as it was. Buddy allocated files only shrink in place.
+
+        :param file_id: desired file_id as a string
+        :param size: new size of the file
+        :param size_unit: unit used for file size. Must be one of B, KB, MB, or GB
+        :return: whether the file was moved
+        '''
+        extents = self._cache.get(file_id)
+        if not extents:
+            raise ValueError('file_id does not exist')
+        if size <= 0:
+            raise ValueError('Size must be greater than 0')
+        size = self._to_bytes(size, size_unit)
+        count = math.ceil(size/self._block)
+        reserved = self._reserved_blocks(((0, count),))
+        if self._block * (reserved - self._reserved_blocks(extents)) > self.get_capacity_remaining():
+            raise ValueError('Not enough capacity to store file')
+
+        resized = self._resize_in_place(extents, count)
+        if resized:
+            self._relocate_location(file_id, resized)
+            self._reaccount_location(extents, resized)
+            return False
+
+        resized = self._allocate_location(size)
+        self._add_availability(extents)
+        self._relocate_location(file_id, resized)
+        self._reaccount_location(extents, resized)
+        return True
+
+    @instrumented('compact')
+    @journaled
+    def compact(self, budget: int = None, apply: bool = True) -> list:
+        '''
+        Relocates files towards the start of the device so that free space merges into a single chunk at the end,
+        letting saves succeed that would otherwise fail for lack of a large enough chunk. Two plans are considered:
+        sliding every file after the first gap down to close it, and first moving files from the end of the device
+        down into gaps they fit before sliding the rest. Whichever moves fewer blocks is used.
+
+        :param budget: most blocks to move in this call. Moves are taken from the start of the plan for as long as
+                       they fit in the budget, so repeated calls make incremental progress. The first move is always
+                       made, even if it alone is larger than the budget, so an empty list only ever means the device
+                       is already compact. The rest of the plan is kept, and later calls carry on with it rather than
+                       planning again unless files have changed in between, so each of them takes time in proportion
+                       to the moves it makes. No limit if nothing passed.
+        :param apply: whether to carry out the moves, updating the cache and free map together. If False, the plan is
+                      returned without changing anything. Defaults to True.
+        :return: list of (file_id, from_block, to_block, count) moves, in the order they must be carried out
+        '''
+        if self._allocation_algorithm == 'buddy':
+            raise ValueError('Compaction is not supported with buddy allocation')
+
+        if self._pending_moves is None:
+            self._pending_moves = (self._compaction_plan(), 0)
+        planned, first = self._pending_moves
+        last = len(planned)
+        if budget is not None:
+            moved = 0
+            for i in range(first, len(planned)):
+                moved += planned[i][3]
+                if moved > budget:
+                    last = max(i, first + 1)
+                    break
+        plan = planned[first:last]
+
+        if apply and plan:
+            self._apply_moves(plan)
+            self._pending_moves = (planned, last)
+        return plan
+
+    def clone(self) -> 'Allocation':
+        '''
+        Forks the allocator, e.g. to try out placements without touching the original. The fork shares the free map
+        and file table with the original rather than copying them, and each keeps only its own changes on top of what
+        they share, so a fork costs time and memory in proportion to what it changes rather than to the number of
+        files and free extents. The bitmap and buddy free maps are instead copied by whichever of the two changes
+        them first. Size class pools and reservations are copied. The fork has no listeners or journal, and counts
+        its own metrics if the original does.
+
+        :return: a new Allocation, independent of this one
+        '''
+        if isinstance(self._available, FreeMap):
+            self._available = FreeMapFork.of(self._available)
+        elif not isinstance(self._available, (FreeMapFork, CopyOnWriteMap)):
+            self._available = CopyOnWriteMap(self._available)
+        fork = copy.copy(self)
+        fork._available = self._available.fork()
+        self._cache, fork._cache = ForkedFileTable.fork(self._cache)
+        if self._pools:
+            fork._pools = SizeClassPools(self._pools.classes, self._pools.refill)
+            fork._pools.load(self._pools.to_dict())
+        fork._metrics = Metrics() if self._metrics else None
+        fork._listeners = []
+        fork._journal = None
+        fork._reservations = dict(self._reservations)
+        fork._reservation_expiry = list(self._reservation_expiry)
+        fork._owners = None
+        return fork
+
+    def snapshot(self, path: str) -> None:
+        '''
+        Writes a compact binary image of the free map, size class pools and file locations to path, see
+        support/snapshot.py. The file is replaced only once the new image is complete. Metrics and listeners are not
+        included.
+
+        :param path: file to write the image to
+        '''
+        config = {
+            'allocation_algorithm': self._allocation_algorithm,
+            'backend': self._backend,
+            'size_classes': self._pools.classes if self._pools else None,
+            'pool_refill': self._pools.refill if self._pools else 16,
+            'metrics': self._metrics is not None,
+            'scatter': self._scatter,
+            'pools': self._pools.to_dict() if self._pools else None,
+        }
+        header = {
+            'capacity': self._capacity,
+            'block': self._block,
+            # Reservations are not kept in snapshots
+            'capacity_used': self._capacity_used - self._capacity_reserved,
+            'internal_fragmentation': self._internal_fragmentation,
+        }
+        Snapshot.write(path, header, config, list(self._available), self._cache.items())
+
+    @classmethod
+    def restore(cls, path: str) -> 'Allocation':
+        '''
+        Recreates an Allocation from an image written by snapshot. The image is memory mapped and its file table is
+        decoded one entry at a time as files are looked up, so restoring takes time proportional to the number of
+        free chunks rather than the number of files. Changes made afterwards are held in memory and never written
+        back to the image.
+
+        :param path: file to read the image from
+        :return: Allocation in the same state as when snapshot was called
+        '''
+        image = Snapshot(path)
+        config = dict(image.config)
+        pools = config.pop('pools')
+        memory = cls(image.header['capacity'], image.header['block'], 'b', 'b', **config)
+        memory._available.load(list(image.free()))
+        if pools:
+            memory._pools.load(pools)
+        memory._cache = SnapshotFileTable(image)
+        memory._capacity_used = image.header['capacity_used']
+        memory._internal_fragmentation = image.header['internal_fragmentation']
+        return memory
+
+    def open_journal(self, directory: str, group_commit: int = 64, commit_window: float = 0.005,
+                     checkpoint_every: int = 10000) -> None:
+        '''
+        Starts recording every save, delete and compaction move in a write-ahead journal in directory, beginning with
+        a checkpoint of the current state. Records are written in groups, so a call may return before its record is
+        durable: at most group_commit records, or commit_window seconds of records, are lost if the process stops.
+        Call sync to wait until everything so far is durable. A new checkpoint is taken, and the journal truncated,
+        every checkpoint_every records. See support/journal.py.
+
+        :param directory: directory to keep checkpoints and the journal in. Created if it does not exist, and must not
+                          already hold a journal.
+        :param group_commit: most records written with a single fsync. Defaults to 64.
+        :param commit_window: most seconds a record waits to be written, or None for no limit. Defaults to 0.005.
+        :param checkpoint_every: records between automatic checkpoints. Defaults to 10000.
+        '''
+        if self._journal:
+            raise ValueError('A journal is already open')
+        os.makedirs(directory, exist_ok=True)
+        if Journal.latest_generation(directory) is not None:
+            raise ValueError('{} already holds a journal, use Allocation.recover'.format(directory))
+        self._start_journal(directory, 0, group_commit, commit_window, checkpoint_every)
+
+    def checkpoint(self) -> None:
+        '''
+        Writes a checkpoint of the current state and starts a new, empty journal after it, removing the previous
+        checkpoint and journal
+        '''
+        if not self._journal:
+            raise ValueError('No journal is open')
+        journal = self._journal
+        self._start_journal(journal.directory, journal.generation + 1, journal.group_commit, journal.commit_window,
+                            journal.checkpoint_every)
+
+    def sync(self) -> None:
+        '''
+        Waits until every change made so far is durable in the journal
+        '''
+        if self._journal:
+            self._journal.flush()
+
+    def close_journal(self) -> None:
+        '''
+        Writes any buffered records and stops journaling. The directory can later be passed to recover.
+        '''
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+
+    @classmethod
+    def recover(cls, directory: str, group_commit: int = 64, commit_window: float = 0.005,
+                checkpoint_every: int = 10000) -> 'Allocation':
+        '''
+        Rebuilds an Allocation from the latest checkpoint in a journal directory and the records journaled after it,
+        up to the first incomplete record. Idle size class slots are handed back to the free map. Journaling then
+        carries on in the same directory from a fresh checkpoint.
+
+        :param directory: directory previously passed to open_journal
+        :return: Allocation holding every file whose save was durable, in the same location
+        '''
+        if not os.path.isdir(directory) or Journal.latest_generation(directory) is None:
+            raise ValueError('{} does not hold a journal'.format(directory))
+        generation = Journal.latest_generation(directory)
+        memory = cls.restore(Journal.checkpoint_path(directory, generation))
+        memory._replay_journal(Journal.read(Journal.log_path(directory, generation)))
+        memory._start_journal(directory, generation + 1, group_commit, commit_window, checkpoint_every)
+        return memory
+
     # Setters and Getters
     def get_capacity(self) -> int:
         '''
@@ -118,187 +528,802 @@ class Allocation:
 
     def list_files(self) -> dict:
         '''
-        List all files in cache
+        List all files in cache, as file_id -> range of blocks allocated to the file
+        '''
+        return {file_id: self._location(extents) for file_id, extents in self._cache.items()}
+
+    def owner(self, block: int) -> str:
+        '''
+        Finds the file a block is allocated to in O(log n) time. Blocks reserved for a file by buddy allocation or size
+        class rounding but not needed to store it have no owner.
+
+        :param block: block number
+        :return: file_id, or None if the block is not allocated
+        '''
+        self._check_blocks(block, block + 1)
+        return self._owner_index().owner(block)
+
+    def owners(self, start: int, stop: int) -> list:
+        '''
+        Finds the files allocated any of blocks start to stop - 1, in O(log n + k) time for k extents found
+
+        :param start: first block of the range
+        :param stop: block after the last block of the range
+        :return: list of file_ids in ascending address order of their first block in the range
+        '''
+        self._check_blocks(start, stop)
+        found = {}
+        for extent_start, count, file_id in self._owner_index().overlapping(start, stop):
+            found.setdefault(file_id, None)
+        return list(found)
+
+    def stats(self) -> dict:
+        '''
+        Summary of how the device is being used. Sizes are in bytes.
+            files: number of files saved
+            free_extents: number of separate runs of free blocks
+            largest_free_extent: size of the largest run of free blocks
+            internal_fragmentation: capacity reserved for files beyond what they need (buddy allocation and size
+                                    class rounding only)
+            pools: idle and in use slot counts for each size class, keyed by slot size in blocks
+            reservations: number of files reserved but not yet committed
+            capacity_reserved: capacity set aside for them, which is included in capacity_used
+        If metrics are enabled, the operation counts, histograms and byte totals described in support/metrics.py are
+        included as well.
+        '''
+        self._expire_reservations()
+        stats = {
+            'capacity': self._capacity,
+            'capacity_used': self._capacity_used,
+            'capacity_remaining': self.get_capacity_remaining(),
+            'files': len(self._cache),
+            'free_extents': len(self._available),
+            'largest_free_extent': self._block * self._available.largest(),
+            'internal_fragmentation': self._internal_fragmentation,
+            'pools': self._pools.occupancy() if self._pools else {},
+            'reservations': len(self._reservations),
+            'capacity_reserved': self._capacity_reserved,
+        }
+        if self._metrics:
+            stats.update(self._metrics.to_dict())
+        return stats
+
+    def subscribe(self, listener) -> None:
+        '''
+        Registers a callback that is called as listener(event, file_id, location) whenever a file is saved (event
+        'save'), deleted (event 'delete') or moved or resized (event 'move', with the new location). Nothing is done on
+        any of these paths if no callbacks are registered.
+
+        :param listener: callable taking the event name, file_id and range of blocks allocated to the file
         '''
-        return self._cache
+        self._listeners.append(listener)
 
     def availability(self) -> str:
         '''
-        Blocks that have not been allocated
+        Blocks that have not been allocated, including idle slots held by size class pools
         '''
-        if self._available.next:
-            curr = self._available.next
-            string = str(curr.val)
-            curr = curr.next
-            while curr:
-                string += ' -> ' + str(curr.val)
-                curr = curr.next
+        extents = list(self._available)
+        if self._pools:
+            extents = sorted(extents + list(self._pools))
+        if extents:
+            string = ' -> '.join(str(block) for start, length in extents for block in range(start, start + length))
         else:
             string = 'No available blocks'
         return string
 
     # Private support functions
-    def _allocate_first_location(self, size: int) -> list:
+    def _save(self, file_id: str, size: int, size_unit: str, near=None) -> tuple:
+        '''
+        Saves file_id as described in save
+
+        :return: tuple of (start, count) extents assigned to the file
+        '''
+        self._expire_reservations()
+        if self._cache.get(file_id) or file_id in self._reservations:
+            raise ValueError('file_id already exists')
+        if size <= 0:
+            raise ValueError('Size must be greater than 0')
+
+        size = self._to_bytes(size, size_unit)
+
+        if self._capacity_needed(size) > self.get_capacity_remaining():
+            raise ValueError('Not enough capacity to store file')
+
+        extents = self._allocate_location(size, self._near_block(near))
+        self._cache_location(file_id, extents)
+        self._account_location(extents, 1)
+        return extents
+
+    def _near_block(self, near):
+        '''
+        Block a placement hint refers to: the block after the end of the file if near is a file_id, or near itself if
+        it is a block
+
+        :return: block number, or None if there is no hint or the file does not exist
+        '''
+        if near is None or isinstance(near, int):
+            if near is not None:
+                self._check_blocks(near, near + 1)
+            return near
+        extents = self._cache.get(near)
+        if not extents:
+            return None
+        start, count = extents[-1]
+        return start + count
+
+    def _commit_many(self, files: list, as_list: bool) -> list:
+        '''
+        Saves reserved files as described in commit_many
+        '''
+        self._expire_reservations()
+        sizes = []
+        for file_id, size, size_unit in files:
+            try:
+                sizes.append(self._to_bytes(size, size_unit))
+            except ValueError:
+                sizes.append(0)  # Reported when the file is saved
+
+        results = [None] * len(files)
+        self._batch_floors = {}
+        try:
+            for i in sorted(range(len(files)), key=lambda i: -sizes[i]):
+                file_id, size, size_unit = files[i]
+                reservation = self._reservations.get(file_id)
+                if reservation is None:
+                    results[i] = ValueError('file_id has no reservation')
+                    continue
+                self._release_reservation(file_id)
+                try:
+                    results[i] = self._location(self._save(file_id, size, size_unit), as_list)
+                except ValueError as e:
+                    # Put back as it was. Its expiry is still in the heap.
+                    self._reservations[file_id] = reservation
+                    self._capacity_reserved += reservation[0]
+                    self._capacity_used += reservation[0]
+                    results[i] = e
+        finally:
+            self._batch_floors = None
+        return results
+
+    def _release_reservation(self, file_id: str) -> None:
+        reserved, expires = self._reservations.pop(file_id)
+        self._capacity_reserved -= reserved
+        self._capacity_used -= reserved
+
+    def _expire_reservations(self) -> None:
+        '''
+        Releases every reservation whose time has run out
+        '''
+        expiry = self._reservation_expiry
+        if not expiry or expiry[0][0] > time.monotonic():
+            return
+        now = time.monotonic()
+        while expiry and expiry[0][0] <= now:
+            expires, file_id = heapq.heappop(expiry)
+            reservation = self._reservations.get(file_id)
+            if reservation and reservation[1] == expires:
+                self._release_reservation(file_id)
+
+    def _allocate_location(self, size: int, near: int = None) -> tuple:
+        '''
+        Allocates a location for a file of given size. Small files are given a slot from the size class pools, others
+        are placed in the free map by the chosen allocation algorithm, or near the given block if first or best fit
+        finds room there. If no chunk is large enough, idle pool slots are handed back to the free map and the
+        allocation is tried once more, and failing that the file is scattered if enabled.
+
+        :param size: size of file in bytes
+        :param near: block to place the file near, or None
+        :return: tuple of (start, count) extents to be allocated to file
+        '''
+        chunk_size_needed = math.ceil(size/self._block)
+        if self._pools and self._pools.slot_size(chunk_size_needed):
+            location = self._allocate_pooled_location(chunk_size_needed)
+            return ((location.start, len(location)),)
+        if near is not None and self._allocation_algorithm in ('first', 'best'):
+            first_block = self._available.near_fit(chunk_size_needed, near)
+            if self._metrics:
+                self._metrics.record_search(self._available.visited)
+            if first_block is not None:
+                return ((first_block, chunk_size_needed),)
+        try:
+            location = self._allocate_free_map_location(size)
+            return ((location.start, len(location)),)
+        except ValueError:
+            pass
+        if self._drain_pools():
+            try:
+                location = self._allocate_free_map_location(size)
+                return ((location.start, len(location)),)
+            except ValueError:
+                pass
+        if self._scatter:
+            return self._allocate_scattered_location(chunk_size_needed)
+        raise ValueError('No chunk large enough to be allocated for given size')
+
+    def _allocate_scattered_location(self, chunk_size_needed: int) -> tuple:
+        '''
+        Splits a file across as few chunks as possible: the largest chunks are used whole until the rest of the file
+        fits in a single chunk, which is then chosen by best fit.
+
+        :param chunk_size_needed: size of file in blocks
+        :return: tuple of (start, count) extents to be allocated to file, in ascending address order
+        '''
+        if chunk_size_needed > self._available.free_blocks:
+            raise ValueError('Not enough free blocks to scatter file')
+
+        extents = []
+        remaining = chunk_size_needed
+        while self._available.largest() < remaining:
+            start, length = self._available.largest_extent()
+            self._available.take(start, length)
+            extents.append((start, length))
+            remaining -= length
+        extents.append((self._available.best_fit(remaining), remaining))
+        return tuple(sorted(extents))
+
+    def _allocate_free_map_location(self, size: int) -> range:
+        '''
+        Allocates a location for a file of given size from the free map, using the chosen allocation algorithm
+        '''
+        try:
+            if self._allocation_algorithm == 'best':
+                return self._allocate_best_location(size)
+            elif self._allocation_algorithm == 'next':
+                return self._allocate_next_location(size)
+            elif self._allocation_algorithm == 'buddy':
+                return self._allocate_buddy_location(size)
+            return self._allocate_first_location(size)
+        finally:
+            if self._metrics:
+                self._metrics.record_search(self._available.visited)
+
+    def _allocate_pooled_location(self, chunk_size_needed: int) -> range:
+        '''
+        Takes a slot from the pool of the smallest size class that holds the file, refilling the pool first if it is
+        empty.
+
+        :param chunk_size_needed: size of file in blocks
+        :return: range of blocks to be allocated to file
+        '''
+        slot_size = self._pools.slot_size(chunk_size_needed)
+        first_block = self._pools.pop(slot_size)
+        if first_block is None:
+            self._refill_pool(slot_size)
+            first_block = self._pools.pop(slot_size)
+        return range(first_block, first_block + chunk_size_needed)
+
+    def _refill_pool(self, slot_size: int) -> None:
+        '''
+        Carves a run of slots for the given size class out of the free map. If there is no room for a full refill,
+        progressively fewer slots are carved; if there is no room for even one, idle slots of other size classes are
+        handed back to the free map first.
+        '''
+        slots = self._pools.refill
+        while slots:
+            try:
+                location = self._allocate_free_map_location(self._block * slot_size * slots)
+                self._pools.fill(slot_size, location.start, slots)
+                return
+            except ValueError:
+                slots //= 2
+
+        if not self._drain_pools():
+            raise ValueError('No chunk large enough to be allocated for given size')
+        location = self._allocate_free_map_location(self._block * slot_size)
+        self._pools.fill(slot_size, location.start, 1)
+
+    def _drain_pools(self) -> bool:
+        '''
+        Hands every idle pool slot back to the free map
+
+        :return: whether any slots were handed back
+        '''
+        slots = self._pools.drain() if self._pools else []
+        self._available.free_many(slots)
+        if slots and self._batch_floors:
+            # Freed chunks may sit below where earlier first fit searches in the batch stopped
+            self._batch_floors.clear()
+        return len(slots) > 0
+
+    def _allocate_first_location(self, size: int) -> range:
         '''
         Finds first possible location to store file of given size, and allocates it for the file by removing assigned
-        chunks from linked list of available nodes. Note: a chunk refers to a group of successive blocks.
+        chunks from the free map. Note: a chunk refers to a group of successive blocks.
 
         :param size: size of file in bytes
-        :return: list of blocks to be allocated to file
-        '''
-        print('Allocating blocks using first fit...')
-
-        no_error = False  # Cannot use chunk_postend as indicator of no error, as it may be None if last block assigned
-        curr = self._available
-        chunk_prestart = curr  # Node preceeding chunk
-        chunk_postend = None  # Node succeeding chunk
-        chunk_size = 0  # Size of current chunk
-        while curr.next:
-            if self._blocks_are_adjacent(curr.next.val, chunk_prestart.next.val, chunk_size):
-                chunk_size += 1
-                if chunk_size * self._block >= size:
-                    chunk_postend = curr.next.next
-                    no_error = True
-                    break
-            else:  # Nodes not adjacent
-                chunk_prestart = curr
-                chunk_size = 1
-            curr = curr.next  # Update to next as last step so current pointer can be assigned as prestart if needed
+        :return: range of blocks to be allocated to file
+        '''
+        chunk_size_needed = math.ceil(size/self._block)
+        floor = 0
+        if self._batch_floors is not None:
+            floor = max([block for count, block in self._batch_floors.items() if count <= chunk_size_needed], default=0)
+        first_block = self._available.first_fit(chunk_size_needed, floor)
+        if first_block is None:
+            raise ValueError('No chunk large enough to be allocated for given size')
+        if self._batch_floors is not None:
+            self._batch_floors[chunk_size_needed] = first_block
 
-        if no_error:  # Sufficient block was found
-            first_block = chunk_prestart.next.val
+        return range(first_block, first_block + chunk_size_needed)
 
-            # Remove allocated blocks from linked list
-            chunk_prestart.next = chunk_postend
+    def _allocate_next_location(self, size: int) -> range:
+        '''
+        Finds the next possible location to store file of given size, resuming the search where the previous
+        allocation ended and wrapping around to the start of the device. Avoids rescanning the same full prefix of the
+        device on every save when files at the front are long-lived.
 
-            print('Blocks allocated!')
-            return [x for x in range(first_block, first_block + chunk_size)]
-        else:
+        :param size: size of file in bytes
+        :return: range of blocks to be allocated to file
+        '''
+        chunk_size_needed = math.ceil(size/self._block)
+        first_block = self._available.next_fit(chunk_size_needed)
+        if first_block is None:
             raise ValueError('No chunk large enough to be allocated for given size')
 
-    def _allocate_best_location(self, size: int) -> list:
+        return range(first_block, first_block + chunk_size_needed)
+
+    def _allocate_best_location(self, size: int) -> range:
         '''
         Finds best possible location to store file of given size, and allocates it for the file by removing assigned
-        chunks from linked list of available nodes. Note: a chunk refers to a group of successive blocks, and best
-        location is defined as smallest existing chunk that can be allocated for given size
+        chunks from the free map. Note: a chunk refers to a group of successive blocks, and best location is defined as
+        smallest existing chunk that can be allocated for given size
 
         :param size: size of file in bytes
-        :return: list of blocks to be allocated to file
+        :return: range of blocks to be allocated to file
         '''
-        print('Allocating blocks using best fit...')
+        chunk_size_needed = math.ceil(size/self._block)
+        first_block = self._available.best_fit(chunk_size_needed)
+        if first_block is None:
+            raise ValueError('No chunk large enough to be allocated for given size')
 
+        return range(first_block, first_block + chunk_size_needed)
+
+    def _allocate_buddy_location(self, size: int) -> range:
+        '''
+        Finds a location using buddy allocation, where the file is given a power-of-two sized run of blocks split from
+        the smallest free run available. Blocks beyond those the file needs are counted as internal fragmentation.
+
+        :param size: size of file in bytes
+        :return: range of blocks to be allocated to file
+        '''
         chunk_size_needed = math.ceil(size/self._block)
+        first_block = self._available.allocate(chunk_size_needed)
+        if first_block is None:
+            raise ValueError('No chunk large enough to be allocated for given size')
 
-        curr = self._available
-        best_chunk_prestart = None
-        best_chunk_size = None
-        chunk_prestart = curr  # Node preceeding chunk
-        chunk_size = 0  # Size of current chunk
-        while curr.next:
-            if self._blocks_are_adjacent(curr.next.val, chunk_prestart.next.val, chunk_size):
-                chunk_size += 1
+        return range(first_block, first_block + chunk_size_needed)
+
+    def _compaction_plan(self) -> list:
+        '''
+        Plans moves that leave all free space in a single chunk at the end of the device, as described in compact
+        '''
+        layout = []  # (start, blocks reserved, file_id) of every extent, in ascending address order
+        for file_id, extents in self._cache.items():
+            if len(extents) == 1:
+                layout.append((extents[0][0], self._reserved_blocks(extents), file_id))
             else:
-                if self._chunk_is_valid_and_better(best_chunk_size, chunk_size, chunk_size_needed):
-                    best_chunk_size = chunk_size
-                    best_chunk_prestart = chunk_prestart
-                if chunk_size == chunk_size_needed:  # Break if perfect size found, no need to keep searching
-                    break
-                chunk_prestart = curr
-                chunk_size = 1
-            curr = curr.next
-
-        # Do checks for last chunk (not checked in loop)
-        if self._chunk_is_valid_and_better(best_chunk_size, chunk_size, chunk_size_needed):
-            best_chunk_size = chunk_size
-            best_chunk_prestart = chunk_prestart
-
-        if best_chunk_size and best_chunk_prestart:  # Sufficient block was found
-            first_block = best_chunk_prestart.next.val
-
-            # Remove allocated blocks from linked list
-            best_chunk_postend = best_chunk_prestart
-            for i in range(chunk_size_needed + 1):
-                best_chunk_postend = best_chunk_postend.next
-            best_chunk_prestart.next = best_chunk_postend
-
-            print('Blocks allocated!')
-            return [x for x in range(first_block, first_block + chunk_size_needed)]
-        else:
-            raise ValueError('No chunk large enough to be allocated for given size')
+                layout.extend((start, count, file_id) for start, count in extents)
+        layout.sort()
+
+        free = list(self._available)
+        if self._pools:
+            free = sorted(free + list(self._pools))
+
+        sliding = self._sliding_moves(layout)
+        hole_moves, moved_layout = self._hole_filling_moves(layout, free)
+        combined = hole_moves + self._sliding_moves(moved_layout)
+        if sum(move[3] for move in combined) < sum(move[3] for move in sliding):
+            return combined
+        return sliding
+
+    def _sliding_moves(self, layout: list) -> list:
+        '''
+        Moves that slide every file after the first gap down to close the gaps, in ascending address order so each
+        file's destination is free by the time it is moved
 
-    def _blocks_are_adjacent(self, block_num: int, prestart_num: int, chunk_size: int):
-        return block_num == prestart_num + chunk_size
+        :param layout: list of (start, blocks reserved, file_id) of every file, in ascending address order
+        '''
+        moves = []
+        end = 0  # End of the files packed so far
+        for start, reserved, file_id in layout:
+            if start != end:
+                moves.append((file_id, start, end, reserved))
+            end += reserved
+        return moves
+
+    def _hole_filling_moves(self, layout: list, free: list) -> tuple:
+        '''
+        Moves files, highest address first, into the lowest free chunk below them that fits them. Each file is moved
+        at most once.
+
+        :param layout: list of (start, blocks reserved, file_id) of every file, in ascending address order
+        :param free: list of (start, length) of free chunks, in ascending address order
+        :return: tuple of the moves, and the layout after them in ascending address order
+        '''
+        holes = HoleTree(free)
+        moves = []
+        moved_layout = []
+        for start, reserved, file_id in reversed(layout):
+            destination = holes.take(reserved, start)
+            if destination is None:
+                destination = start
+            else:
+                moves.append((file_id, start, destination, reserved))
+            moved_layout.append((destination, reserved, file_id))
+        # Space vacated by moved files lies above every file still to be considered, so is never a useful hole
+        return moves, sorted(moved_layout)
+
+    def _apply_moves(self, moves: list) -> None:
+        '''
+        Carries out moves from a compaction plan, updating the free map and cache
+        '''
+        self._drain_pools()
+        relocated = {}
+        for file_id, from_block, to_block, count in moves:
+            self._available.free(from_block, count)
+            self._available.take(to_block, count)
+            extents = relocated.get(file_id, self._cache[file_id])
+            relocated[file_id] = tuple((to_block if start == from_block else start, length)
+                                       for start, length in extents)
+        # Files may move onto blocks another file has yet to vacate, so the index is updated once every file has moved
+        owners, self._owners = self._owners, None
+        if owners is not None:
+            for file_id in relocated:
+                for start, count in self._cache[file_id]:
+                    owners.remove(start)
+        for file_id, extents in relocated.items():
+            self._relocate_location(file_id, self._merge_extents(extents))
+        if owners is not None:
+            for file_id in relocated:
+                for start, count in self._cache[file_id]:
+                    owners.add(start, count, file_id)
+        self._owners = owners
+
+    def _start_journal(self, directory: str, generation: int, group_commit: int, commit_window: float,
+                       checkpoint_every: int) -> None:
+        '''
+        Writes the checkpoint for a new journal generation and switches to its journal. Older generations are only
+        removed once the new checkpoint is complete.
+        '''
+        if self._journal:
+            self._journal.flush()
+        self.snapshot(Journal.checkpoint_path(directory, generation))
+        journal = Journal(directory, generation, group_commit, commit_window, checkpoint_every)
+        if self._journal:
+            self._journal.close()
+        self._journal = journal
+        Journal.remove_before(directory, generation)
+
+    def _replay_journal(self, records: list) -> None:
+        '''
+        Applies journaled records to the state restored from their checkpoint, taking each file's blocks directly from
+        the free map. Consecutive moves come from a single compaction, where a file may move into space vacated by a
+        file recorded after it, so every vacated run is freed before any destination is taken.
+
+        :param records: list of (event, file_id, extents) tuples
+        '''
+        self._drain_pools()
+        self._owners = None  # Rebuilt when next needed, as the cache is changed directly
+        self._pending_moves = None
+        moves = []
+        for event, file_id, extents in records:
+            if event == 'move':
+                moves.append((file_id, extents))
+                continue
+            self._replay_moves(moves)
+            moves = []
 
-    def _chunk_is_valid_and_better(self, best_chunk_size: int, chunk_size: int, chunk_size_needed: int):
-        return (not best_chunk_size or chunk_size < best_chunk_size) and chunk_size >= chunk_size_needed
+            if event == 'save':
+                for start, count in self._reserved_runs(extents):
+                    self._available.take(start, count)
+                if self._pools and len(extents) == 1 and self._pools.slot_size(extents[0][1]):
+                    self._pools.adopt(self._pools.slot_size(extents[0][1]))
+                self._cache[file_id] = extents
+                self._account_location(extents, 1)
+            elif event == 'delete':
+                extents = self._cache.pop(file_id)
+                self._add_availability(extents)
+                # Keep the pools empty, so every slot a later record names is in the free map
+                self._drain_pools()
+                self._account_location(extents, -1)
+        self._replay_moves(moves)
 
-    def _cache_location(self, file_id: str, location: list) -> None:
+    def _replay_moves(self, moves: list) -> None:
+        '''
+        Applies a run of journaled moves as list of (file_id, extents) tuples. Only the last move of each file matters.
+        '''
+        if not moves:
+            return
+        final = dict(moves)
+        self._available.free_many([run for file_id in final for run in self._reserved_runs(self._cache[file_id])])
+        for file_id, extents in final.items():
+            for start, count in self._reserved_runs(extents):
+                self._available.take(start, count)
+            self._reslot(self._cache[file_id], extents)
+            self._reaccount_location(self._cache[file_id], extents)
+            self._cache[file_id] = extents
+
+    def _reserved_runs(self, extents: tuple) -> list:
+        '''
+        Runs of blocks taken out of the free map to store a file with the given extents, as (start, count) tuples
+        '''
+        if len(extents) > 1 or self._allocation_algorithm == 'buddy':
+            # Buddy maps round each run up themselves
+            return list(extents)
+        start, count = extents[0]
+        return [(start, self._reserved_blocks(extents))]
+
+    def _resize_in_place(self, extents: tuple, count: int):
+        '''
+        Gives a file count blocks without moving its start, taking or freeing blocks past its end as needed
+
+        :return: the file's new extents, or None if the blocks past its end are not free
+        '''
+        if self._allocation_algorithm == 'buddy':
+            start, old_count = extents[0]
+            old_reserved = self._available.reserved(old_count)
+            half = self._available.reserved(count)
+            if half > old_reserved:
+                return None
+            # The upper halves of the run are freed in turn. Their buddies are the part still in use, so none merge.
+            while half < old_reserved:
+                self._available.free(start + half, half)
+                half *= 2
+            return ((start, count),)
+
+        resized = []
+        remaining = count
+        for start, length in extents:
+            if remaining <= 0:
+                break
+            resized.append((start, min(length, remaining)))
+            remaining -= length
+        if remaining > 0:
+            start, length = resized[-1]
+            resized[-1] = (start, length + remaining)
+        resized = tuple(resized)
+
+        taken = self._subtract_runs(self._reserved_runs(resized), self._reserved_runs(extents))
+        for i, (start, length) in enumerate(taken):
+            try:
+                self._available.take(start, length)
+            except ValueError:
+                for start, length in taken[:i]:
+                    self._available.free(start, length)
+                return None
+        freed = self._subtract_runs(self._reserved_runs(extents), self._reserved_runs(resized))
+        if freed:
+            self._available.free_many(freed)
+            if self._batch_floors:
+                self._batch_floors.clear()
+
+        self._reslot(extents, resized)
+        return resized
+
+    def _reslot(self, extents: tuple, resized: tuple) -> None:
+        '''
+        Updates the in use counts of size class pools for a file that has changed size without going through them
+        '''
+        if not self._pools:
+            return
+        old_slot = self._pools.slot_size(extents[0][1]) if len(extents) == 1 else None
+        slot = self._pools.slot_size(resized[0][1]) if len(resized) == 1 else None
+        if old_slot != slot:
+            if old_slot:
+                self._pools.release(old_slot)
+            if slot:
+                self._pools.adopt(slot)
+
+    def _subtract_runs(self, runs: list, other: list) -> list:
+        '''
+        Parts of runs that do not overlap any of other, both being lists of (start, count) tuples in ascending address
+        order
+        '''
+        result = []
+        i = 0
+        for start, count in runs:
+            end = start + count
+            while i < len(other) and other[i][0] + other[i][1] <= start:
+                i += 1
+            j = i
+            while start < end and j < len(other) and other[j][0] < end:
+                if other[j][0] > start:
+                    result.append((start, other[j][0] - start))
+                start = max(start, other[j][0] + other[j][1])
+                j += 1
+            if start < end:
+                result.append((start, end - start))
+        return result
+
+    def _reaccount_location(self, extents: tuple, resized: tuple) -> None:
+        '''
+        Updates capacity used and internal fragmentation for a file whose extents have changed
+        '''
+        reserved = self._reserved_blocks(resized) - self._reserved_blocks(extents)
+        needed = sum(count for start, count in resized) - sum(count for start, count in extents)
+        self._internal_fragmentation += self._block * (reserved - needed)
+        self._update_capacity_used(self._block * reserved)
+
+    def _merge_extents(self, extents: tuple) -> tuple:
+        '''
+        Merges consecutive extents of a scattered file that have ended up adjacent, e.g. after compaction
+        '''
+        merged = [list(extents[0])]
+        for start, count in extents[1:]:
+            if merged[-1][0] + merged[-1][1] == start:
+                merged[-1][1] += count
+            else:
+                merged.append([start, count])
+        return tuple((start, count) for start, count in merged)
+
+    def _account_location(self, extents: tuple, direction: int) -> None:
+        '''
+        Updates capacity used and internal fragmentation for a file with the given extents being saved (direction 1)
+        or deleted (direction -1)
+        '''
+        reserved = self._reserved_blocks(extents)
+        self._internal_fragmentation += direction * self._block * (reserved - sum(count for start, count in extents))
+        self._update_capacity_used(direction * self._block * reserved)
+
+    def _capacity_needed(self, size: int) -> int:
+        '''
+        Capacity in Bytes that saving a file of size Bytes in one chunk uses, including buddy and size class rounding
+        '''
+        return self._block * self._reserved_blocks(((0, math.ceil(size/self._block)),))
+
+    def _reserved_blocks(self, extents: tuple) -> int:
+        '''
+        Number of blocks taken out of the free map to store a file with the given extents
+        '''
+        if len(extents) > 1:
+            return sum(count for start, count in extents)
+        count = extents[0][1]
+        if self._allocation_algorithm == 'buddy':
+            return self._available.reserved(count)
+        elif self._pools:
+            return self._pools.slot_size(count) or count
+        return count
+
+    def _location(self, extents: tuple, as_list: bool = False) -> range:
+        '''
+        Location returned to callers for a file with the given extents: a range, or a list of ranges for a scattered
+        file. Ranges take constant space however large the file is, so a list of blocks is only built when asked for.
+        '''
+        if len(extents) > 1:
+            locations = [range(start, start + count) for start, count in extents]
+            return [block for location in locations for block in location] if as_list else locations
+        start, count = extents[0]
+        location = range(start, start + count)
+        return list(location) if as_list else location
+
+    def _owner_index(self) -> IntervalIndex:
+        '''
+        Index of the extents of every file, built from the cache the first time it is needed and kept up to date by
+        _cache_location, _uncache_location and _relocate_location from then on
+        '''
+        if self._owners is None:
+            self._owners = IntervalIndex()
+            for file_id, extents in self._cache.items():
+                for start, count in extents:
+                    self._owners.add(start, count, file_id)
+        return self._owners
+
+    def _check_blocks(self, start: int, stop: int) -> None:
+        if not 0 <= start < stop <= self._capacity // self._block:
+            raise ValueError('Blocks {} to {} are not on the device'.format(start, stop - 1))
+
+    def _cache_location(self, file_id: str, extents: tuple) -> None:
         '''
         Caches file location in instance cache.
         '''
-        print('Caching location...')
-        self._cache[file_id] = location
-        print('Location cached!')
+        self._cache[file_id] = extents
+        self._pending_moves = None
+        if self._owners is not None:
+            for start, count in extents:
+                self._owners.add(start, count, file_id)
+        if self._journal:
+            self._journal.append('save', file_id, extents)
+        if self._listeners:
+            self._notify('save', file_id, extents)
+
+    def _uncache_location(self, file_id: str) -> None:
+        '''
+        Removes file location from instance cache.
+        '''
+        extents = self._cache.pop(file_id)
+        self._pending_moves = None
+        if self._owners is not None:
+            for start, count in extents:
+                self._owners.remove(start)
+        if self._journal:
+            self._journal.append('delete', file_id, extents)
+        if self._listeners:
+            self._notify('delete', file_id, extents)
+
+    def _relocate_location(self, file_id: str, extents: tuple) -> None:
+        '''
+        Updates the cached location of a file that has been moved.
+        '''
+        if self._owners is not None:
+            for start, count in self._cache[file_id]:
+                self._owners.remove(start)
+            for start, count in extents:
+                self._owners.add(start, count, file_id)
+        self._cache[file_id] = extents
+        self._pending_moves = None
+        if self._journal:
+            self._journal.append('move', file_id, extents)
+        if self._listeners:
+            self._notify('move', file_id, extents)
+
+    def _notify(self, event: str, file_id: str, extents: tuple) -> None:
+        location = self._location(extents)
+        for listener in self._listeners:
+            listener(event, file_id, location)
 
     def _update_capacity_used(self, size: int) -> None:
         '''
         Updates capacity used (either positive or negative size)
         '''
-        print('Updating capacity used...')
         self._capacity_used += size
-        print('Updated capacity used!')
+        if self._metrics:
+            self._metrics.record_capacity(size)
+
+    def _create_free_map(self, backend: str, num_blocks: int):
+        '''
+        Creates the structure used to track empty space for the given backend
+        '''
+        if self._allocation_algorithm == 'buddy':
+            if backend != 'list':
+                raise ValueError('Buddy allocation keeps its own free lists, backend must be list')
+            return BuddyMap(num_blocks)
+        elif backend == 'list':
+            return FreeMap(num_blocks)
+        elif backend == 'bitmap':
+            # Imported here so numpy is only needed when the bitmap backend is used
+            from support.bitmap_map import BitmapMap
+            return BitmapMap(num_blocks)
+        raise ValueError('Incorrect backend, must be one of list or bitmap')
 
     def _to_bytes(self, size: int, unit: str) -> int:
         '''
         Translates size to bytes according to given unit
         '''
-        conversion_unit = unit.lower()
-        if (conversion_unit not in ['b', 'kb', 'mb', 'gb', 'tb']):
-            raise ValueError('Incorrect unit, must be one of b, kb, mb, gb, or tb')
-
-        converted_size = size
-        unit_num = 0
-        if conversion_unit == 'kb':
-            unit_num = 1
-        elif conversion_unit == 'mb':
-            unit_num = 2
-        elif conversion_unit == 'gb':
-            unit_num = 3
-        elif conversion_unit == 'tb':
-            unit_num = 4
-
-        return converted_size * (1024**unit_num)
-
-    def _add_availability(self, blocks: list) -> None:
-        '''
-        Return availability of blocks to the availability linked list.
-
-        :param location: sorted list of blocks to be returned and reallocated
-        '''
-        # Blocks used by one file always adjacent, so build a linked list
-        blocks_linked = LinkedList()
-        curr_chunk = blocks_linked
-        for block in blocks:
-            curr_chunk.next = Node(block)
-            curr_chunk = curr_chunk.next
-
-        # Search through availability to find the gap blocks to be returned to
-        # Note assumption is linked list will always be sorted in ascending order
-        chunk_prestart = self._available  # Node at which chunk should be inserted
-        chunk_postend = None  # Sucessive node after chunk
-        chunk_min = blocks[0]  # Lowest block in chunk
-        chunk_max = blocks[len(blocks)-1]  # Highest block in chunk
-
-        if self._available.next:
-            curr = self._available.next
-            while curr:
-                if chunk_min > curr.val:
-                    chunk_prestart = curr
-                if chunk_max < curr.val:
-                    chunk_postend = curr
-                if chunk_prestart and chunk_postend:
-                    break
-                curr = curr.next
+        return to_bytes(size, unit)
+
+    def _add_availability(self, extents: tuple) -> None:
+        '''
+        Return availability of blocks to the free map, merging them with neighbouring free chunks.
+
+        :param extents: tuple of (start, count) extents of blocks to be returned and reallocated
+        '''
+        runs = self._unpooled(extents)
+        if len(runs) == 1:
+            self._available.free(*runs[0])
+        elif runs:
+            # A scattered file's extents are sorted and merged with the free map in a single pass
+            self._available.free_many(runs)
+
+    def _add_availability_many(self, locations: list) -> None:
+        '''
+        Return availability of blocks of many files to the free map in a single pass.
+
+        :param locations: list of tuples of (start, count) extents of blocks to be returned and reallocated
+        '''
+        self._available.free_many([run for extents in locations for run in self._unpooled(extents)])
+
+    def _unpooled(self, extents: tuple) -> list:
+        '''
+        Returns a file's slot to its size class pool if it has one and the pool has room
 
-        chunk_prestart.next = blocks_linked.next
-        curr_chunk.next = chunk_postend
+        :param extents: tuple of (start, count) extents of blocks to be returned
+        :return: list of (start, count) tuples of runs that should go back to the free map instead
+        '''
+        if len(extents) > 1:  # Scattered files never come from pools
+            return list(extents)
+        start, count = extents[0]
+        slot_size = self._pools.slot_size(count) if self._pools else None
+        if slot_size:
+            if self._pools.push(slot_size, start):
+                return []
+            count = slot_size
+        return [(start, count)]
@@ -1,4 +1,14 @@
+import argparse
+import json
+import sys
+import time
+
 import allocation
+import benchmark
+from support import traces
+
+# Lines of batch output gathered before each write
+FLUSH_EVERY = 4096
 
 class AllocationCli():
     def run_cli(self):
@@ -34,7 +44,7 @@ class AllocationCli():
                 size, unit = self.obtain_size_and_unit('file size')
                 print()
                 try:
-                    location = memory.save(file_id, size, unit)
+                    location = memory.save(file_id, size, unit, as_list=True)
                     print()
                     print('File located at ' + str(location))
                 except ValueError as e:
@@ -44,7 +54,7 @@ class AllocationCli():
                 file_id = self.obtain_file_id()
                 print()
                 try:
-                    location = memory.read(file_id)
+                    location = memory.read(file_id, as_list=True)
                     print()
                     print('File located at ' + str(location))
                 except ValueError as e:
@@ -66,8 +76,8 @@ class AllocationCli():
                 if len(files) == 0:
                     print('No files saved')
                 else:
-                    for file_id, blocks in files.items():
-                        print('{}: {}'.format(file_id, blocks))
+                    for file_id, location in files.items():
+                        print('{}: {}'.format(file_id, _blocks(location)))
                 print()
             elif choice == 5:
                 print('Unallocated Blocks: ' + memory.availability())
@@ -103,5 +113,120 @@ class AllocationCli():
             unit = unit.lower()
         return size, unit
 
+def run_batch(memory: allocation.Allocation, lines, out) -> dict:
+    '''
+    Carries out a stream of commands against memory, one per line: 'save <file_id> <size> [unit]', 'read <file_id>',
+    'delete <file_id>' or 'stats'. Blank lines and lines starting with # are skipped. Writes one line of JSON per
+    command to out, e.g. {"line":1,"op":"save","ok":true,"result":[0,2]}, with locations as [start, stop] or a list of
+    them, and the error message as the result when ok is false. Lines that cannot be parsed are reported the same way.
+
+    :param memory: the Allocation to use
+    :param lines: iterable of lines, e.g. an open file or sys.stdin, read as it goes
+    :param out: file to write results to, written to in chunks of FLUSH_EVERY lines
+    :return: dict of totals:
+        ops: number of commands carried out
+        errors: number of commands that failed or could not be parsed
+        seconds: time taken in total
+        ops_per_sec: commands per second, counting only time spent in the allocator
+        p50_us, p99_us: median and 99th percentile command latency in microseconds
+    '''
+    encoder = json.JSONEncoder(separators=(',', ':'))
+    pending = []
+    latencies = []
+    errors = 0
+    began = time.perf_counter()
+
+    for number, line in enumerate(lines, 1):
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        command = fields[0].lower()
+        try:
+            if command == 'stats' and len(fields) == 1:
+                operation = ('stats',)
+            else:
+                operation = traces.parse_operation(fields, number)
+        except ValueError as e:
+            errors += 1
+            pending.append(encoder.encode({'line': number, 'op': command, 'ok': False, 'result': str(e)}))
+        else:
+            start = time.perf_counter_ns()
+            try:
+                result = _carry_out(memory, operation)
+                ok = True
+            except ValueError as e:
+                result = str(e)
+                ok = False
+            latencies.append(time.perf_counter_ns() - start)
+            errors += not ok
+            pending.append(encoder.encode({'line': number, 'op': command, 'ok': ok, 'result': _encode(result)}))
+        if len(pending) >= FLUSH_EVERY:
+            out.write('\n'.join(pending) + '\n')
+            pending = []
+    if pending:
+        out.write('\n'.join(pending) + '\n')
+    out.flush()
+
+    latencies.sort()
+    elapsed = sum(latencies)
+    return {
+        'ops': len(latencies),
+        'errors': errors,
+        'seconds': time.perf_counter() - began,
+        'ops_per_sec': len(latencies) / (elapsed / 1e9) if elapsed else 0.0,
+        'p50_us': benchmark.percentile(latencies, 50) / 1000,
+        'p99_us': benchmark.percentile(latencies, 99) / 1000,
+    }
+
+def _blocks(location) -> list:
+    '''
+    List of the blocks in a location as returned by list_files, a range or a list of ranges
+    '''
+    if isinstance(location, range):
+        return list(location)
+    return [block for part in location for block in part]
+
+def _carry_out(memory: allocation.Allocation, operation: tuple):
+    if operation[0] == 'save':
+        return memory.save(*operation[1:])
+    elif operation[0] == 'read':
+        return memory.read(operation[1])
+    elif operation[0] == 'delete':
+        return memory.delete(operation[1])
+    return memory.stats()
+
+def _encode(result):
+    '''
+    Converts ranges in a result to [start, stop] lists so it can be written as JSON
+    '''
+    if isinstance(result, range):
+        return [result.start, result.stop]
+    elif isinstance(result, list):
+        return [_encode(part) for part in result]
+    return result
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description='Manage an Allocation interactively, or run a batch of commands')
+    parser.add_argument('--batch', nargs='?', const='-', metavar='FILE',
+                        help='run commands from FILE, or stdin if no FILE or -, instead of prompting')
+    parser.add_argument('--capacity', type=benchmark.parse_size, default=benchmark.parse_size('64mb'))
+    parser.add_argument('--block', type=benchmark.parse_size, default=benchmark.parse_size('4kb'))
+    parser.add_argument('--algorithm', default='best', choices=['best', 'first', 'next', 'buddy'])
+    args = parser.parse_args(argv)
+
+    if args.batch is None:
+        AllocationCli().run_cli()
+        return
+
+    memory = allocation.Allocation(args.capacity, args.block, 'b', 'b', args.algorithm)
+    if args.batch == '-':
+        summary = run_batch(memory, sys.stdin, sys.stdout)
+    else:
+        with open(args.batch) as f:
+            summary = run_batch(memory, f, sys.stdout)
+    # Kept off stdout so the results can be piped on as they are
+    print('{ops} ops, {errors} errors in {seconds:.3f}s: {ops_per_sec:.0f} ops/sec, p50 {p50_us:.1f} us, '
+          'p99 {p99_us:.1f} us'.format(**summary), file=sys.stderr)
+
 if __name__ == '__main__':
-    AllocationCli().run_cli()
+    main()
@@ -0,0 +1,53 @@
+import contextlib
+import io
+import json
+import unittest
+from unittest import mock
+import allocation
+import allocation_cli
+
+class TestBatch(unittest.TestCase):
+    def run_batch(self, lines, **kwargs):
+        memory = allocation.Allocation(1, 128, 'mb', 'kb', 'first', **kwargs)
+        out = io.StringIO()
+        summary = allocation_cli.run_batch(memory, lines, out)
+        return [json.loads(line) for line in out.getvalue().splitlines()], summary
+
+    def test_commands(self):
+        results, summary = self.run_batch(['save a 256 kb', '# comment', '', 'read a', 'delete a', 'stats'])
+        self.assertEqual([(result['line'], result['op'], result['ok']) for result in results],
+                         [(1, 'save', True), (4, 'read', True), (5, 'delete', True), (6, 'stats', True)])
+        self.assertEqual(results[0]['result'], [0, 2])
+        self.assertIsNone(results[2]['result'])
+        self.assertEqual(results[3]['result']['files'], 0)
+        self.assertEqual(summary['ops'], 4)
+        self.assertEqual(summary['errors'], 0)
+
+    def test_errors_reported_in_line(self):
+        results, summary = self.run_batch(['read a', 'save a lots', 'save b 2 mb'])
+        self.assertEqual([result['ok'] for result in results], [False, False, False])
+        self.assertEqual(results[0]['result'], 'file_id does not exist')
+        self.assertIn('Line 2', results[1]['result'])
+        self.assertEqual(summary['ops'], 2)
+        self.assertEqual(summary['errors'], 3)
+
+    def test_scattered_location(self):
+        results, summary = self.run_batch(['save a 128 kb', 'save b 128 kb', 'save c 640 kb', 'delete b',
+                                           'save d 256 kb'], scatter=True)
+        self.assertEqual(results[-1]['result'], [[1, 2], [7, 8]])
+
+    def test_buffered_output(self):
+        lines = ['save {} 1 kb'.format(i) for i in range(allocation_cli.FLUSH_EVERY + 5)]
+        results, summary = self.run_batch(lines)
+        self.assertEqual(len(results), len(lines))
+        self.assertEqual(summary['ops'], len(lines))
+        self.assertEqual(summary['errors'], len(lines) - 8)
+
+class TestInteractive(unittest.TestCase):
+    def test_locations_shown_as_blocks(self):
+        answers = ['1', 'mb', '128', 'kb', 'first', '1', 'a', '300', 'kb', '2', 'a', '4', '6']
+        out = io.StringIO()
+        with mock.patch('builtins.input', side_effect=answers), contextlib.redirect_stdout(out):
+            allocation_cli.AllocationCli().run_cli()
+        self.assertEqual(out.getvalue().count('File located at [0, 1, 2]'), 2)
+        self.assertIn('a: [0, 1, 2]', out.getvalue())
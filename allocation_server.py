@@ -0,0 +1,348 @@
+import argparse
+import asyncio
+import itertools
+import json
+import struct
+
+import allocation
+import benchmark
+
+# Every message is a frame of a 4 byte big-endian length followed by that many bytes of JSON:
+#     request: [request_id, operation, arguments...], operation being one of save, read, delete, list or stats
+#     response: [request_id, ok, result], result being the error message when ok is false
+# A frame that is not UTF-8 encoded JSON is answered with request_id null. The connection is closed after a frame
+# longer than MAX_FRAME, or one that is not a non-empty list.
+# Locations are sent as [start, stop] for a range, or a list of them for a file split across several chunks.
+# Requests may be pipelined: a client can send any number before reading responses, which come back in order.
+FRAME = struct.Struct('!I')
+MAX_FRAME = 16 * 1024 * 1024
+# Bytes a client buffers before waiting for the socket to catch up
+HIGH_WATER = 64 * 1024
+
+_encoder = json.JSONEncoder(separators=(',', ':'))
+_decoder = json.JSONDecoder()
+
+class AllocationServer:
+    def __init__(self, memory: allocation.Allocation, max_batch: int = 1024):
+        '''
+        Serves an Allocation to clients over a socket. Requests from every connection go through a single queue, and
+        are carried out in the order they arrived by one task, so the Allocation needs no locking. Runs of saves and
+        runs of deletes that are waiting together are carried out with save_many and delete_many.
+            queue: requests waiting to be carried out, as (writer, request) tuples
+            writers: set of open connections
+            connections: set of tasks reading from connections
+            max_batch: most requests taken from the queue at once
+
+        :param memory: the Allocation to serve
+        :param max_batch: most requests carried out together. Defaults to 1024.
+        '''
+        self._memory = memory
+        self._max_batch = max_batch
+        self._queue = None
+        self._server = None
+        self._dispatcher = None
+        self._writers = set()
+        self._connections = set()
+
+    async def start(self, path: str = None, host: str = '127.0.0.1', port: int = 0):
+        '''
+        Starts listening on a Unix socket at path if given, otherwise on TCP host and port
+
+        :return: the asyncio server, whose sockets give the address actually bound
+        '''
+        self._queue = asyncio.Queue()
+        self._dispatcher = asyncio.ensure_future(self._dispatch())
+        if path:
+            self._server = await asyncio.start_unix_server(self._connection, path)
+        else:
+            self._server = await asyncio.start_server(self._connection, host, port)
+        return self._server
+
+    async def close(self) -> None:
+        '''
+        Stops listening and closes every connection. Requests still queued are not carried out.
+        '''
+        self._server.close()
+        self._dispatcher.cancel()
+        for writer in self._writers:
+            writer.close()
+        # Closing a connection ends its reader, so each task finishes by itself
+        await asyncio.gather(*self._connections)
+        await self._server.wait_closed()
+
+    async def _connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        '''
+        Reads requests from one client until it disconnects, queueing them to be carried out. A frame that cannot be
+        decoded is queued with its error in place of the operation, so it is answered in turn like any other request.
+        '''
+        self._writers.add(writer)
+        self._connections.add(asyncio.current_task())
+        try:
+            while True:
+                try:
+                    request = await read_frame(reader)
+                except ValueError as e:  # The whole frame was read, so the next one can be
+                    request = [None, e]
+                if not isinstance(request, list) or not request:  # Closed, or not speaking the protocol
+                    break
+                self._queue.put_nowait((writer, request))
+        except ConnectionError:  # Reset by the client, or a frame too large to skip
+            pass
+        finally:
+            self._connections.discard(asyncio.current_task())
+            self._queue.put_nowait((writer, None))
+
+    async def _dispatch(self) -> None:
+        '''
+        Carries out queued requests in batches, writing each response back to the connection it came from
+        '''
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self._max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            responses = []
+            try:
+                responses.extend(self._carry_out(batch))
+            except Exception as e:  # A bug must not stop the server for every client
+                for writer, request in batch[len(responses):]:
+                    responses.append((writer, request and [request[0], False, 'Server error: {}'.format(e)]))
+
+            touched = set()
+            for writer, response in responses:
+                if response is None:
+                    self._writers.discard(writer)
+                    writer.close()
+                elif not writer.is_closing():
+                    try:
+                        write_frame(writer, response)
+                    except (TypeError, ValueError) as e:
+                        write_frame(writer, [response[0], False, 'Response could not be encoded: {}'.format(e)])
+                    touched.add(writer)
+            for writer in touched:
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    writer.close()
+
+    def _carry_out(self, batch: list):
+        '''
+        Carries out a batch of requests in order, grouping consecutive saves and consecutive deletes
+
+        :return: generator of (writer, response) tuples in the order of the batch. The response is None for the
+                 marker queued when a connection ends.
+        '''
+        for operation, group in itertools.groupby(batch, key=lambda item: self._batchable(item[1])):
+            group = list(group)
+            if operation == 'save' and len(group) > 1:
+                results = self._memory.save_many([tuple(request[2:5]) for writer, request in group])
+                for (writer, request), result in zip(group, results):
+                    yield writer, self._response(request, result)
+            elif operation == 'delete' and len(group) > 1:
+                results = self._memory.delete_many([request[2] for writer, request in group])
+                for (writer, request), result in zip(group, results):
+                    yield writer, self._response(request, result)
+            else:
+                for writer, request in group:
+                    yield writer, request and self._response(request, self._call(request))
+
+    def _batchable(self, request):
+        '''
+        Operation of a well formed save or delete request, which can be carried out with others of its kind, or None
+        '''
+        if not isinstance(request, list) or len(request) < 2:
+            return None
+        if not all(isinstance(argument, str) for argument in request[1:3]):
+            return None
+        if request[1] == 'save' and len(request) == 5 and isinstance(request[3], int) and isinstance(request[4], str):
+            return 'save'
+        elif request[1] == 'delete' and len(request) == 3:
+            return 'delete'
+        return None
+
+    def _call(self, request: list):
+        '''
+        Carries out a single request
+
+        :return: the result, or the ValueError raised. Any other error is taken to come from a malformed request and
+                 returned as a ValueError.
+        '''
+        try:
+            operation, arguments = request[1], request[2:]
+            if isinstance(operation, ValueError):  # Queued by _connection for a frame that could not be decoded
+                return operation
+            if not isinstance(operation, str):
+                raise ValueError('Unknown operation {!r}'.format(operation))
+            if operation == 'save':
+                return self._memory.save(*arguments)
+            elif operation == 'read':
+                return self._memory.read(*arguments)
+            elif operation == 'delete':
+                return self._memory.delete(*arguments)
+            elif operation == 'list':
+                return self._memory.list_files()
+            elif operation == 'stats':
+                return self._memory.stats()
+            raise ValueError('Unknown operation {!r}'.format(operation))
+        except ValueError as e:
+            return e
+        except Exception as e:
+            return ValueError('Malformed request: {}'.format(e))
+
+    def _response(self, request: list, result) -> list:
+        if isinstance(result, ValueError):
+            return [request[0], False, str(result)]
+        elif isinstance(result, dict) and request[1] == 'list':
+            result = {file_id: encode_location(location) for file_id, location in result.items()}
+        elif isinstance(result, (range, list)):
+            result = encode_location(result)
+        return [request[0], True, result]
+
+class AllocationClient:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        '''
+        Client for an AllocationServer. Use connect rather than creating one directly. Every method may be called
+        again before earlier calls finish, in which case the requests are pipelined over the one connection.
+            pending: hashmap (dict) of request_id -> future for the response
+        '''
+        self._reader = reader
+        self._writer = writer
+        self._pending = {}
+        self._request_ids = itertools.count()
+        self._responses = asyncio.ensure_future(self._read_responses())
+
+    @classmethod
+    async def connect(cls, path: str = None, host: str = '127.0.0.1', port: int = None) -> 'AllocationClient':
+        '''
+        Connects to a server listening on a Unix socket at path if given, otherwise on TCP host and port
+        '''
+        if path:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def save(self, file_id: str, size: int, size_unit: str) -> range:
+        '''
+        See Allocation.save
+        '''
+        return decode_location(await self._request('save', file_id, size, size_unit))
+
+    async def read(self, file_id: str) -> range:
+        '''
+        See Allocation.read
+        '''
+        return decode_location(await self._request('read', file_id))
+
+    async def delete(self, file_id: str) -> None:
+        '''
+        See Allocation.delete
+        '''
+        await self._request('delete', file_id)
+
+    async def list_files(self) -> dict:
+        '''
+        See Allocation.list_files
+        '''
+        return {file_id: decode_location(location) for file_id, location in (await self._request('list')).items()}
+
+    async def stats(self) -> dict:
+        '''
+        See Allocation.stats. Keys of nested dicts are strings, as they are sent as JSON.
+        '''
+        return await self._request('stats')
+
+    async def close(self) -> None:
+        self._writer.close()
+        await self._writer.wait_closed()
+        await self._responses
+
+    async def _request(self, *request):
+        request_id = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        write_frame(self._writer, [request_id, *request])
+        if self._writer.transport.get_write_buffer_size() > HIGH_WATER:
+            await self._writer.drain()
+        return await future
+
+    async def _read_responses(self) -> None:
+        '''
+        Resolves the future of each request as its response arrives
+        '''
+        try:
+            while True:
+                response = await read_frame(self._reader)
+                if response is None:
+                    break
+                request_id, ok, result = response
+                future = self._pending.pop(request_id)
+                if ok:
+                    future.set_result(result)
+                else:
+                    future.set_exception(ValueError(result))
+        except (ConnectionError, ValueError):  # Reset, or sent something that is not a response
+            pass
+        for future in self._pending.values():
+            future.set_exception(ConnectionError('Connection to allocation server closed'))
+        self._pending.clear()
+
+async def read_frame(reader: asyncio.StreamReader):
+    '''
+    Reads one frame. Raises ValueError if it is not UTF-8 encoded JSON, having read all of it, and ConnectionError if
+    it is longer than MAX_FRAME.
+
+    :return: the decoded message, or None if the connection was closed
+    '''
+    try:
+        header = await reader.readexactly(FRAME.size)
+        (length,) = FRAME.unpack(header)
+        if length > MAX_FRAME:
+            raise ConnectionError('Frame of {} bytes is too large'.format(length))
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+    try:
+        return _decoder.decode(payload.decode())
+    except ValueError as e:  # Including UnicodeDecodeError and JSONDecodeError
+        raise ValueError('Malformed frame: {}'.format(e))
+
+def write_frame(writer: asyncio.StreamWriter, message) -> None:
+    '''
+    Buffers one frame to be sent, without waiting for it to be
+    '''
+    payload = _encoder.encode(message).encode()
+    writer.write(FRAME.pack(len(payload)) + payload)
+
+def encode_location(location):
+    if isinstance(location, range):
+        return [location.start, location.stop]
+    return [encode_location(part) for part in location]
+
+def decode_location(location):
+    if location is None:
+        return None
+    elif location and isinstance(location[0], list):
+        return [range(start, stop) for start, stop in location]
+    return range(*location)
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description='Serve an Allocation to local clients')
+    parser.add_argument('--unix', help='path of a Unix socket to listen on, instead of TCP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7070)
+    parser.add_argument('--capacity', type=benchmark.parse_size, default=benchmark.parse_size('64mb'))
+    parser.add_argument('--block', type=benchmark.parse_size, default=benchmark.parse_size('4kb'))
+    parser.add_argument('--algorithm', default='best', choices=['best', 'first', 'next', 'buddy'])
+    args = parser.parse_args(argv)
+
+    async def serve():
+        memory = allocation.Allocation(args.capacity, args.block, 'b', 'b', args.algorithm)
+        server = await AllocationServer(memory).start(args.unix, args.host, args.port)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import asyncio
+import os
+import tempfile
+import unittest
+import allocation
+import allocation_server
+
+class TestAllocationServer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.memory = allocation.Allocation(1, 128, 'mb', 'kb', 'first')
+        self.server = allocation_server.AllocationServer(self.memory)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'allocation.sock')
+        await self.server.start(self.path)
+        self.client = await allocation_server.AllocationClient.connect(self.path)
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.server.close()
+
+    async def test_save_read_delete(self):
+        self.assertEqual(await self.client.save('a', 256, 'kb'), range(0, 2))
+        self.assertEqual(await self.client.read('a'), range(0, 2))
+        await self.client.delete('a')
+        with self.assertRaises(ValueError):
+            await self.client.read('a')
+
+    async def test_errors(self):
+        await self.client.save('a', 128, 'kb')
+        with self.assertRaises(ValueError):
+            await self.client.save('a', 128, 'kb')
+        with self.assertRaises(ValueError):
+            await self.client.save('b', 128, 'zb')
+        with self.assertRaises(ValueError):
+            await self.client.save('b', 2, 'mb')
+        with self.assertRaises(ValueError):
+            await self.client.delete('b')
+        with self.assertRaises(ValueError):
+            await self.client._request('format')
+
+    async def test_malformed_requests(self):
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        frames = [[1], [2, 'save', 'a', 10, 5], [3, 'save', 'a', 10], [4, 'read', ['a']], [5, 'save', 'a', 10, 'kb']]
+        for frame in frames:
+            allocation_server.write_frame(writer, frame)
+        responses = [await asyncio.wait_for(allocation_server.read_frame(reader), 5) for frame in frames]
+        self.assertEqual([response[:2] for response in responses],
+                         [[1, False], [2, False], [3, False], [4, False], [5, True]])
+        writer.close()
+        await writer.wait_closed()
+
+        other = await allocation_server.AllocationClient.connect(self.path)
+        self.assertEqual(await other.save('b', 128, 'kb'), range(1, 2))
+        self.assertEqual(await self.client.read('a'), range(0, 1))
+        await other.close()
+
+    async def test_undecodable_frames(self):
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        writer.write(allocation_server.FRAME.pack(3) + b'{x]')
+        writer.write(allocation_server.FRAME.pack(2) + b'\xff\xfe')
+        allocation_server.write_frame(writer, [3, 'save', 'a', 10, 'kb'])
+        responses = [await asyncio.wait_for(allocation_server.read_frame(reader), 5) for i in range(3)]
+        self.assertEqual([response[:2] for response in responses], [[None, False], [None, False], [3, True]])
+        self.assertTrue(responses[0][2].startswith('Malformed frame'))
+
+        # The rest of a frame too large to read cannot be skipped, so the connection is closed
+        writer.write(allocation_server.FRAME.pack(allocation_server.MAX_FRAME + 1))
+        self.assertIsNone(await asyncio.wait_for(allocation_server.read_frame(reader), 5))
+        writer.close()
+        await writer.wait_closed()
+        self.assertEqual(await self.client.read('a'), range(0, 1))
+        self.assertEqual(errors, [])
+
+    async def test_list_and_stats(self):
+        await self.client.save('a', 128, 'kb')
+        await self.client.save('b', 256, 'kb')
+        self.assertEqual(await self.client.list_files(), {'a': range(0, 1), 'b': range(1, 3)})
+        stats = await self.client.stats()
+        self.assertEqual(stats['files'], 2)
+        self.assertEqual(stats['capacity_used'], 384 * 1024)
+
+    async def test_pipelining(self):
+        # Sent together, so carried out with save_many and delete_many, with the same results as one at a time
+        saves = await asyncio.gather(*(self.client.save(str(i), 128, 'kb') for i in range(9)), return_exceptions=True)
+        self.assertEqual(saves[:8], [range(i, i + 1) for i in range(8)])
+        self.assertIsInstance(saves[8], ValueError)
+        deletes = await asyncio.gather(*(self.client.delete(str(i)) for i in (1, 1, 3)), return_exceptions=True)
+        self.assertEqual(deletes[0], None)
+        self.assertIsInstance(deletes[1], ValueError)
+        self.assertEqual(self.memory.availability(), '1 -> 3')
+
+    async def test_several_clients(self):
+        other = await allocation_server.AllocationClient.connect(self.path)
+        self.addAsyncCleanup(other.close)
+        results = await asyncio.gather(self.client.save('a', 128, 'kb'), other.save('b', 128, 'kb'))
+        self.assertEqual(sorted(results, key=lambda location: location.start), [range(0, 1), range(1, 2)])
+        self.assertEqual(await other.read('a'), await self.client.read('a'))
+
+    async def test_tcp(self):
+        server = allocation_server.AllocationServer(self.memory)
+        listening = await server.start(port=0)
+        client = await allocation_server.AllocationClient.connect(port=listening.sockets[0].getsockname()[1])
+        self.assertEqual(await client.save('a', 128, 'kb'), range(0, 1))
+        await client.close()
+        await server.close()
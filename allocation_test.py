@@ -1,6 +1,15 @@
+import importlib.util
+import os
+import random
+import shutil
+import tempfile
+import time
 import unittest
+from unittest import mock
 import allocation
 
+HAS_NUMPY = importlib.util.find_spec('numpy') is not None
+
 class TestGeneral(unittest.TestCase):
     def test_wrong_unit(self):
         with self.assertRaises(ValueError):
@@ -18,6 +27,12 @@ class TestGeneral(unittest.TestCase):
         self.assertEqual(memory.list_files(), {})
         self.assertEqual(memory.availability(), '0 -> 1 -> 2 -> 3 -> 4 -> 5 -> 6 -> 7')
 
+    def test_init_large_device(self):
+        memory = allocation.Allocation(1, 4, 'tb', 'kb')
+        self.assertEqual(memory.get_capacity_remaining(), 1024**4)
+        memory.save('a', 10, 'kb')
+        self.assertEqual(memory.read('a', as_list=True), [0, 1, 2])
+
 class TestReadMethods(unittest.TestCase):
     def initialize_standard(self):
         return allocation.Allocation(1, 128, 'mb', 'kb', 'first')
@@ -25,7 +40,18 @@ class TestReadMethods(unittest.TestCase):
     def test_read(self):
         memory = self.initialize_standard()
         memory.save('a', 120, 'kb')
-        self.assertEqual(memory.read('a'), [0])
+        self.assertEqual(memory.read('a', as_list=True), [0])
+
+    def test_read_range(self):
+        memory = self.initialize_standard()
+        memory.save('a', 300, 'kb')
+        self.assertEqual(memory.read('a'), range(0, 3))
+        self.assertEqual(memory.list_files(), {'a': range(0, 3)})
+
+    def test_save_as_list(self):
+        memory = self.initialize_standard()
+        self.assertEqual(memory.save('a', 300, 'kb'), range(0, 3))
+        self.assertEqual(memory.save('b', 300, 'kb', as_list=True), [3, 4, 5])
 
     def test_read_non_existant(self):
         memory = self.initialize_standard()
@@ -57,24 +83,24 @@ class TestFirstFitSaveMethods(unittest.TestCase):
     def test_save_one_block(self):
         memory = self.initialize_standard()
         memory.save('a', 120, 'kb')
-        self.assertEqual(memory.read('a'), [0])
+        self.assertEqual(memory.read('a', as_list=True), [0])
 
     def test_save_one_block_exact(self):
         memory = self.initialize_standard()
         memory.save('a', 128, 'kb')
-        self.assertEqual(memory.read('a'), [0])
+        self.assertEqual(memory.read('a', as_list=True), [0])
 
     def test_save_multi_block(self):
         memory = self.initialize_standard()
         memory.save('a', 130, 'kb')
-        self.assertEqual(memory.read('a'), [0, 1])
+        self.assertEqual(memory.read('a', as_list=True), [0, 1])
 
     def test_save_multi_chunk(self):
         memory = self.initialize_standard()
         memory.save('a', 120, 'kb')
         memory.save('b', 200, 'kb')
-        self.assertEqual(memory.read('a'), [0])
-        self.assertEqual(memory.read('b'), [1, 2])
+        self.assertEqual(memory.read('a', as_list=True), [0])
+        self.assertEqual(memory.read('b', as_list=True), [1, 2])
 
     def test_save_to_full(self):
         memory = self.initialize_standard()
@@ -86,8 +112,8 @@ class TestFirstFitSaveMethods(unittest.TestCase):
         memory = self.initialize_standard()
         memory.save('a', 896, 'kb')
         memory.save('b', 120, 'kb')
-        self.assertEqual(memory.read('a'), [0, 1, 2, 3, 4, 5, 6])
-        self.assertEqual(memory.read('b'), [7])
+        self.assertEqual(memory.read('a', as_list=True), [0, 1, 2, 3, 4, 5, 6])
+        self.assertEqual(memory.read('b', as_list=True), [7])
 
     def test_save_fragmented_blocks_no_chunk_available(self):
         memory = self.initialize_standard()
@@ -104,7 +130,7 @@ class TestFirstFitSaveMethods(unittest.TestCase):
         memory.delete('a')
         memory.delete('b')
         memory.save('z', 200, 'kb')
-        self.assertEqual(memory.read('z'), [0, 1])
+        self.assertEqual(memory.read('z', as_list=True), [0, 1])
 
     def test_save_fragmented_blocks_middle(self):
         memory = self.initialize_standard()
@@ -112,7 +138,7 @@ class TestFirstFitSaveMethods(unittest.TestCase):
         memory.delete('c')
         memory.delete('d')
         memory.save('z', 200, 'kb')
-        self.assertEqual(memory.read('z'), [2, 3])
+        self.assertEqual(memory.read('z', as_list=True), [2, 3])
 
     def test_save_fragmented_blocks_back(self):
         memory = self.initialize_standard()
@@ -121,7 +147,7 @@ class TestFirstFitSaveMethods(unittest.TestCase):
         memory.delete('g')
         memory.delete('h')
         memory.save('z', 200, 'kb')
-        self.assertEqual(memory.read('z'), [6, 7])
+        self.assertEqual(memory.read('z', as_list=True), [6, 7])
 
     def test_save_fragmented_blocks_oversized(self):
         memory = self.initialize_standard()
@@ -130,7 +156,7 @@ class TestFirstFitSaveMethods(unittest.TestCase):
         memory.delete('c')
         memory.delete('d')
         memory.save('z', 200, 'kb')
-        self.assertEqual(memory.read('z'), [1, 2])
+        self.assertEqual(memory.read('z', as_list=True), [1, 2])
 
 class TestBestFitSaveMethods(unittest.TestCase):
     def initialize_standard(self):
@@ -151,24 +177,24 @@ class TestBestFitSaveMethods(unittest.TestCase):
     def test_save_one_block(self):
         memory = self.initialize_standard()
         memory.save('a', 120, 'kb')
-        self.assertEqual(memory.read('a'), [0])
+        self.assertEqual(memory.read('a', as_list=True), [0])
 
     def test_save_one_block_exact(self):
         memory = self.initialize_standard()
         memory.save('a', 128, 'kb')
-        self.assertEqual(memory.read('a'), [0])
+        self.assertEqual(memory.read('a', as_list=True), [0])
 
     def test_save_multi_block(self):
         memory = self.initialize_standard()
         memory.save('a', 130, 'kb')
-        self.assertEqual(memory.read('a'), [0, 1])
+        self.assertEqual(memory.read('a', as_list=True), [0, 1])
 
     def test_save_multi_chunk(self):
         memory = self.initialize_standard()
         memory.save('a', 120, 'kb')
         memory.save('b', 200, 'kb')
-        self.assertEqual(memory.read('a'), [0])
-        self.assertEqual(memory.read('b'), [1, 2])
+        self.assertEqual(memory.read('a', as_list=True), [0])
+        self.assertEqual(memory.read('b', as_list=True), [1, 2])
 
     def test_save_to_full(self):
         memory = self.initialize_standard()
@@ -180,8 +206,8 @@ class TestBestFitSaveMethods(unittest.TestCase):
         memory = self.initialize_standard()
         memory.save('a', 896, 'kb')
         memory.save('b', 120, 'kb')
-        self.assertEqual(memory.read('a'), [0, 1, 2, 3, 4, 5, 6])
-        self.assertEqual(memory.read('b'), [7])
+        self.assertEqual(memory.read('a', as_list=True), [0, 1, 2, 3, 4, 5, 6])
+        self.assertEqual(memory.read('b', as_list=True), [7])
 
     def test_save_fragmented_blocks_no_chunk_available(self):
         memory = self.initialize_standard()
@@ -198,7 +224,7 @@ class TestBestFitSaveMethods(unittest.TestCase):
         memory.delete('a')
         memory.delete('b')
         memory.save('z', 200, 'kb')
-        self.assertEqual(memory.read('z'), [0, 1])
+        self.assertEqual(memory.read('z', as_list=True), [0, 1])
 
     def test_save_fragmented_blocks_middle(self):
         memory = self.initialize_standard()
@@ -206,7 +232,7 @@ class TestBestFitSaveMethods(unittest.TestCase):
         memory.delete('c')
         memory.delete('d')
         memory.save('z', 200, 'kb')
-        self.assertEqual(memory.read('z'), [2, 3])
+        self.assertEqual(memory.read('z', as_list=True), [2, 3])
 
     def test_save_fragmented_blocks_back(self):
         memory = self.initialize_standard()
@@ -215,7 +241,7 @@ class TestBestFitSaveMethods(unittest.TestCase):
         memory.delete('g')
         memory.delete('h')
         memory.save('z', 200, 'kb')
-        self.assertEqual(memory.read('z'), [6, 7])
+        self.assertEqual(memory.read('z', as_list=True), [6, 7])
 
     def test_save_fragmented_best_block(self):
         memory = self.initialize_standard()
@@ -224,7 +250,16 @@ class TestBestFitSaveMethods(unittest.TestCase):
         memory.delete('d')
         memory.delete('f')
         memory.save('z', 100, 'kb')
-        self.assertEqual(memory.read('z'), [5])
+        self.assertEqual(memory.read('z', as_list=True), [5])
+
+    def test_save_fragmented_best_block_tie(self):
+        memory = self.initialize_standard()
+        self.save_full(memory)
+        memory.delete('f')
+        memory.delete('b')
+        memory.delete('d')
+        memory.save('z', 100, 'kb')
+        self.assertEqual(memory.read('z', as_list=True), [1])
 
     def test_save_fragmented_best_block_oversized(self):
         memory = self.initialize_standard()
@@ -235,7 +270,7 @@ class TestBestFitSaveMethods(unittest.TestCase):
         memory.delete('f')
         memory.delete('g')
         memory.save('z', 100, 'kb')
-        self.assertEqual(memory.read('z'), [5])
+        self.assertEqual(memory.read('z', as_list=True), [5])
 
     def test_save_fragmented_blocks_oversized(self):
         memory = self.initialize_standard()
@@ -244,7 +279,7 @@ class TestBestFitSaveMethods(unittest.TestCase):
         memory.delete('c')
         memory.delete('d')
         memory.save('z', 200, 'kb')
-        self.assertEqual(memory.read('z'), [1, 2])
+        self.assertEqual(memory.read('z', as_list=True), [1, 2])
 
 class TestDeleteMethods(unittest.TestCase):
     def initialize_standard(self):
@@ -298,6 +333,16 @@ class TestDeleteMethods(unittest.TestCase):
             memory.read('h')
         self.assertEqual(memory.availability(), '7')
 
+    def test_delete_coalesces_neighbours(self):
+        memory = self.initialize_standard()
+        self.save_full(memory)
+        memory.delete('b')
+        memory.delete('d')
+        memory.delete('c')
+        self.assertEqual(memory.availability(), '1 -> 2 -> 3')
+        memory.save('z', 384, 'kb')
+        self.assertEqual(memory.read('z', as_list=True), [1, 2, 3])
+
     def test_delete_front_2(self):
         memory = self.initialize_standard()
         memory.save('a', 120, 'kb')
@@ -338,5 +383,905 @@ class TestDeleteMethods(unittest.TestCase):
         memory.delete('d')
         self.assertEqual(memory.availability(), '0 -> 3 -> 4 -> 5 -> 6 -> 7')
 
+class TestNextFitSaveMethods(unittest.TestCase):
+    def initialize_standard(self):
+        return allocation.Allocation(1, 128, 'mb', 'kb', 'next')
+
+    def save_full(self, memory):
+        counter = 'a'
+        for i in range(8):
+            memory.save(counter, 128, 'kb')
+            counter = chr(ord(counter[0]) + 1)
+
+    def test_save_resumes_after_last(self):
+        memory = self.initialize_standard()
+        memory.save('a', 120, 'kb')
+        memory.save('b', 120, 'kb')
+        memory.delete('a')
+        memory.save('c', 120, 'kb')
+        self.assertEqual(memory.read('c', as_list=True), [2])
+
+    def test_save_wraps_around(self):
+        memory = self.initialize_standard()
+        memory.save('a', 130, 'kb')
+        memory.save('b', 768, 'kb')
+        memory.delete('a')
+        memory.save('c', 200, 'kb')
+        self.assertEqual(memory.read('c', as_list=True), [0, 1])
+
+    def test_save_after_coalescing(self):
+        memory = self.initialize_standard()
+        self.save_full(memory)
+        memory.delete('c')
+        memory.delete('e')
+        memory.save('z', 100, 'kb')
+        self.assertEqual(memory.read('z', as_list=True), [2])
+        memory.delete('z')
+        memory.delete('d')
+        memory.save('y', 300, 'kb')
+        self.assertEqual(memory.read('y', as_list=True), [2, 3, 4])
+
+    def test_save_fragmented_blocks_no_chunk_available(self):
+        memory = self.initialize_standard()
+        self.save_full(memory)
+        memory.delete('a')
+        memory.delete('d')
+        memory.delete('h')
+        with self.assertRaises(ValueError):
+            memory.save('z', 200, 'kb')
+
+class TestBatchMethods(unittest.TestCase):
+    def initialize_standard(self):
+        return allocation.Allocation(1, 128, 'mb', 'kb', 'first')
+
+    def test_save_many(self):
+        memory = self.initialize_standard()
+        results = memory.save_many([('a', 120, 'kb'), ('b', 200, 'kb'), ('a', 100, 'kb'), ('c', 2, 'mb'),
+                                    ('d', 100, 'kb')])
+        self.assertEqual(results[:2], [range(0, 1), range(1, 3)])
+        self.assertIsInstance(results[2], ValueError)
+        self.assertIsInstance(results[3], ValueError)
+        self.assertEqual(results[4], range(3, 4))
+        self.assertEqual(memory.get_capacity_used(), 512 * 1024)
+
+    def test_save_many_matches_save(self):
+        memory = self.initialize_standard()
+        memory.save_many([(c, 128, 'kb') for c in 'abcdefgh'])
+        memory.delete('b')
+        memory.delete('d')
+        memory.delete('e')
+        results = memory.save_many([('x', 100, 'kb'), ('y', 200, 'kb'), ('z', 100, 'kb')], as_list=True)
+        self.assertEqual(results[:2], [[1], [3, 4]])
+        self.assertIsInstance(results[2], ValueError)
+
+    def test_delete_many(self):
+        memory = self.initialize_standard()
+        memory.save_many([(c, 128, 'kb') for c in 'abcdefgh'])
+        results = memory.delete_many(['c', 'z', 'b', 'd', 'f'])
+        self.assertEqual(results[:1] + results[2:], [None, None, None, None])
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(memory.availability(), '1 -> 2 -> 3 -> 5')
+        self.assertEqual(memory.get_capacity_used(), 512 * 1024)
+        memory.save('z', 384, 'kb')
+        self.assertEqual(memory.read('z', as_list=True), [1, 2, 3])
+
+class TestResize(unittest.TestCase):
+    def initialize_standard(self, algorithm='first', **kwargs):
+        memory = allocation.Allocation(1, 128, 'mb', 'kb', algorithm, **kwargs)
+        memory.save('a', 256, 'kb')
+        memory.save('b', 128, 'kb')
+        memory.delete('b')
+        memory.save('c', 128, 'kb')
+        return memory
+
+    def test_shrink_in_place(self):
+        memory = self.initialize_standard()
+        self.assertFalse(memory.resize('a', 128, 'kb'))
+        self.assertEqual(memory.read('a'), range(0, 1))
+        self.assertEqual(memory.availability(), '1 -> 3 -> 4 -> 5 -> 6 -> 7')
+        self.assertEqual(memory.get_capacity_used(), 256 * 1024)
+
+    def test_grow_in_place(self):
+        memory = self.initialize_standard()
+        self.assertFalse(memory.resize('c', 384, 'kb'))
+        self.assertEqual(memory.read('c'), range(2, 5))
+        self.assertEqual(memory.availability(), '5 -> 6 -> 7')
+
+    def test_grow_by_moving(self):
+        memory = self.initialize_standard()
+        memory.save('d', 128, 'kb')
+        self.assertTrue(memory.resize('a', 384, 'kb'))
+        self.assertEqual(memory.read('a'), range(4, 7))
+        self.assertEqual(memory.availability(), '0 -> 1 -> 7')
+        self.assertEqual(memory.get_capacity_used(), 640 * 1024)
+
+    def test_grow_no_room(self):
+        memory = self.initialize_standard()
+        memory.save('d', 640, 'kb')
+        with self.assertRaises(ValueError):
+            memory.resize('a', 384, 'kb')
+        self.assertEqual(memory.read('a'), range(0, 2))
+
+    def test_resize_errors(self):
+        memory = self.initialize_standard()
+        with self.assertRaises(ValueError):
+            memory.resize('z', 128, 'kb')
+        with self.assertRaises(ValueError):
+            memory.resize('a', 0, 'kb')
+        with self.assertRaises(ValueError):
+            memory.resize('a', 2, 'mb')
+
+    def test_resize_scattered(self):
+        memory = allocation.Allocation(1, 128, 'mb', 'kb', 'first', scatter=True)
+        for c in 'abcdefgh':
+            memory.save(c, 128, 'kb')
+        for c in 'bdf':
+            memory.delete(c)
+        memory.save('z', 384, 'kb')
+        self.assertFalse(memory.resize('z', 256, 'kb'))
+        self.assertEqual(memory.read('z'), [range(1, 2), range(3, 4)])
+        self.assertEqual(memory.availability(), '5')
+
+    def test_resize_buddy(self):
+        memory = allocation.Allocation(1, 128, 'mb', 'kb', 'buddy')
+        memory.save('a', 512, 'kb')
+        self.assertFalse(memory.resize('a', 128, 'kb'))
+        self.assertEqual(memory.read('a'), range(0, 1))
+        self.assertEqual(memory.availability(), '1 -> 2 -> 3 -> 4 -> 5 -> 6 -> 7')
+        self.assertTrue(memory.resize('a', 384, 'kb'))
+        self.assertEqual(memory.read('a'), range(4, 7))
+        self.assertEqual(memory.stats()['internal_fragmentation'], 128 * 1024)
+        # Grows in place while it still fits the run reserved for it
+        self.assertFalse(memory.resize('a', 512, 'kb'))
+        self.assertEqual(memory.stats()['internal_fragmentation'], 0)
+
+    def test_resize_size_class(self):
+        memory = allocation.Allocation(1, 128, 'mb', 'kb', 'first', size_classes=(1, 2), pool_refill=1)
+        memory.save('a', 512, 'kb')
+        self.assertFalse(memory.resize('a', 128, 'kb'))
+        self.assertEqual(memory.stats()['pools'][1], {'idle': 0, 'in_use': 1})
+        memory.delete('a')
+        self.assertEqual(memory.stats()['pools'][1], {'idle': 1, 'in_use': 0})
+
+    def test_resize_notifies(self):
+        memory = self.initialize_standard()
+        events = []
+        memory.subscribe(lambda *event: events.append(event))
+        memory.resize('c', 256, 'kb')
+        self.assertEqual(events, [('move', 'c', range(2, 4))])
+
+class TestReservations(unittest.TestCase):
+    def initialize_standard(self):
+        return allocation.Allocation(1, 128, 'mb', 'kb', 'first')
+
+    def test_reserve_counts_capacity(self):
+        memory = self.initialize_standard()
+        memory.reserve('a', 200, 'kb')
+        self.assertEqual(memory.get_capacity_used(), 256 * 1024)
+        self.assertEqual(memory.availability(), '0 -> 1 -> 2 -> 3 -> 4 -> 5 -> 6 -> 7')
+        with self.assertRaises(ValueError):
+            memory.save('b', 896, 'kb')
+        with self.assertRaises(ValueError):
+            memory.read('a')
+
+    def test_commit(self):
+        memory = self.initialize_standard()
+        memory.reserve('a', 512, 'kb')
+        self.assertEqual(memory.commit('a', 256, 'kb'), range(0, 2))
+        self.assertEqual(memory.get_capacity_used(), 256 * 1024)
+        self.assertEqual(memory.stats()['reservations'], 0)
+        with self.assertRaises(ValueError):
+            memory.commit('a', 256, 'kb')
+
+    def test_commit_many_largest_first(self):
+        memory = self.initialize_standard()
+        for c in 'abcdefgh':
+            memory.save(c, 128, 'kb')
+        for c in 'adef':
+            memory.delete(c)
+        memory.reserve('x', 128, 'kb')
+        memory.reserve('y', 128, 'kb')
+        # Placed one at a time in this order, x would take block 0 and leave no room for y
+        results = memory.commit_many([('x', 128, 'kb'), ('y', 384, 'kb'), ('z', 128, 'kb')])
+        self.assertEqual(results[:2], [range(0, 1), range(3, 6)])
+        self.assertIsInstance(results[2], ValueError)
+
+    def test_commit_failure_keeps_reservation(self):
+        memory = self.initialize_standard()
+        memory.reserve('a', 128, 'kb')
+        memory.save('b', 896, 'kb')
+        with self.assertRaises(ValueError):
+            memory.commit('a', 256, 'kb')
+        self.assertEqual(memory.stats()['reservations'], 1)
+        self.assertEqual(memory.commit('a', 128, 'kb'), range(7, 8))
+
+    def test_release(self):
+        memory = self.initialize_standard()
+        memory.reserve('a', 512, 'kb')
+        memory.release('a')
+        self.assertEqual(memory.get_capacity_used(), 0)
+        with self.assertRaises(ValueError):
+            memory.release('a')
+        with self.assertRaises(ValueError):
+            memory.commit('a', 128, 'kb')
+
+    def test_reserve_errors(self):
+        memory = self.initialize_standard()
+        memory.save('a', 128, 'kb')
+        memory.reserve('b', 128, 'kb')
+        for file_id in 'ab':
+            with self.assertRaises(ValueError):
+                memory.reserve(file_id, 128, 'kb')
+        with self.assertRaises(ValueError):
+            memory.save('b', 128, 'kb')
+        with self.assertRaises(ValueError):
+            memory.reserve('c', 1, 'mb')
+        with self.assertRaises(ValueError):
+            memory.reserve('c', 0, 'kb')
+
+    def test_rounded_save_cannot_use_reserved_capacity(self):
+        for kwargs in ({'allocation_algorithm': 'buddy'}, {'size_classes': (4,)}):
+            memory = allocation.Allocation(8, 1, 'kb', 'kb', **kwargs)
+            memory.reserve('r', 5, 'kb')
+            with self.assertRaises(ValueError):
+                memory.save('a', 3, 'kb')
+            self.assertGreaterEqual(memory.get_capacity_remaining(), 0)
+            self.assertEqual(len(memory.commit('r', 5, 'kb')), 5)
+            self.assertGreaterEqual(memory.get_capacity_remaining(), 0)
+
+    def test_expiry(self):
+        memory = self.initialize_standard()
+        memory.reserve('a', 512, 'kb', ttl=0)
+        memory.reserve('b', 256, 'kb', ttl=None)
+        self.assertEqual(memory.stats()['capacity_reserved'], 256 * 1024)
+        with self.assertRaises(ValueError):
+            memory.commit('a', 512, 'kb')
+        self.assertEqual(memory.commit('b', 256, 'kb'), range(0, 2))
+
+class TestOwners(unittest.TestCase):
+    def initialize_standard(self, **kwargs):
+        return allocation.Allocation(1, 128, 'mb', 'kb', 'first', **kwargs)
+
+    def test_owner(self):
+        memory = self.initialize_standard()
+        memory.save('a', 256, 'kb')
+        memory.save('b', 128, 'kb')
+        self.assertEqual([memory.owner(block) for block in range(4)], ['a', 'a', 'b', None])
+        memory.delete('a')
+        self.assertIsNone(memory.owner(0))
+        memory.save('c', 128, 'kb')
+        self.assertEqual(memory.owner(0), 'c')
+        with self.assertRaises(ValueError):
+            memory.owner(8)
+
+    def test_owners(self):
+        memory = self.initialize_standard(scatter=True)
+        for c in 'abcdefgh':
+            memory.save(c, 128, 'kb')
+        for c in 'bdf':
+            memory.delete(c)
+        memory.save('z', 384, 'kb')
+        self.assertEqual(memory.owners(0, 8), ['a', 'z', 'c', 'e', 'g', 'h'])
+        self.assertEqual(memory.owners(2, 4), ['c', 'z'])
+        with self.assertRaises(ValueError):
+            memory.owners(4, 2)
+
+    def test_reserved_blocks_have_no_owner(self):
+        memory = self.initialize_standard(size_classes=(1, 2, 4))
+        memory.save('a', 384, 'kb')
+        self.assertEqual([memory.owner(block) for block in range(4)], ['a', 'a', 'a', None])
+
+    def test_relocations(self):
+        memory = self.initialize_standard()
+        for c in 'abcdefgh':
+            memory.save(c, 128, 'kb')
+        for c in 'bdf':
+            memory.delete(c)
+        self.assertEqual(memory.owner(7), 'h')
+        memory.compact()
+        self.assertEqual([memory.owner(block) for block in range(8)], ['a', 'h', 'c', 'g', 'e', None, None, None])
+        memory.resize('c', 256, 'kb')
+        self.assertEqual(memory.owners(2, 8), ['g', 'e', 'c'])
+        self.assertIsNone(memory.owner(2))
+
+    def test_recovered_index(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        memory = self.initialize_standard()
+        memory.save('a', 128, 'kb')
+        memory.open_journal(directory, group_commit=1)
+        memory.save('b', 256, 'kb')
+        memory.delete('a')
+        memory.close_journal()
+        recovered = allocation.Allocation.recover(directory)
+        self.assertEqual([recovered.owner(block) for block in range(4)], [None, 'b', 'b', None])
+        recovered.close_journal()
+
+class TestClone(unittest.TestCase):
+    def initialize_standard(self, **kwargs):
+        memory = allocation.Allocation(1, 128, 'mb', 'kb', 'first', **kwargs)
+        for c in 'abcd':
+            memory.save(c, 128, 'kb')
+        memory.delete('b')
+        return memory
+
+    def test_clone_is_independent(self):
+        memory = self.initialize_standard()
+        fork = memory.clone()
+        fork.save('x', 256, 'kb')
+        fork.delete('a')
+        memory.save('y', 128, 'kb')
+        self.assertEqual(memory.list_files(), {'a': range(0, 1), 'c': range(2, 3), 'd': range(3, 4), 'y': range(1, 2)})
+        self.assertEqual(memory.availability(), '4 -> 5 -> 6 -> 7')
+        self.assertEqual(fork.list_files(), {'c': range(2, 3), 'd': range(3, 4), 'x': range(4, 6)})
+        self.assertEqual(fork.availability(), '0 -> 1 -> 6 -> 7')
+        self.assertEqual(fork.get_capacity_used(), 512 * 1024)
+        self.assertEqual(memory.get_capacity_used(), 512 * 1024)
+
+    def test_clone_of_clone(self):
+        memory = self.initialize_standard()
+        fork = memory.clone()
+        fork.save('x', 128, 'kb')
+        inner = fork.clone()
+        inner.delete('x')
+        inner.delete('c')
+        self.assertEqual(fork.read('x'), range(1, 2))
+        self.assertEqual(inner.availability(), '1 -> 2 -> 4 -> 5 -> 6 -> 7')
+        self.assertEqual(memory.availability(), '1 -> 4 -> 5 -> 6 -> 7')
+
+    def test_clone_does_not_share_listeners_or_journal(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        memory = self.initialize_standard()
+        events = []
+        memory.subscribe(lambda event, file_id, location: events.append(file_id))
+        memory.open_journal(directory, group_commit=1)
+        fork = memory.clone()
+        fork.save('x', 128, 'kb')
+        memory.close_journal()
+        self.assertEqual(events, [])
+        recovered = allocation.Allocation.recover(directory)
+        self.assertEqual(recovered.list_files(), memory.list_files())
+        recovered.close_journal()
+
+    def test_clone_with_pools_and_reservations(self):
+        memory = self.initialize_standard(size_classes=(1, 2))
+        memory.reserve('r', 128, 'kb')
+        fork = memory.clone()
+        fork.commit('r', 128, 'kb')
+        fork.save('x', 128, 'kb')
+        self.assertEqual(memory.stats()['reservations'], 1)
+        self.assertEqual(memory.stats()['pools'], memory.clone().stats()['pools'])
+        self.assertNotEqual(fork.stats()['pools'], memory.stats()['pools'])
+
+    def test_best_fit_after_clone_skips_pulled_extents_in_log_time(self):
+        # 10000 free extents of 1 to 7 blocks, the smallest of which the saves below pull from the shared base
+        memory = allocation.Allocation(1, 4, 'gb', 'kb', 'best', metrics=True)
+        for i in range(20000):
+            memory.save(str(i), 4 * (1 + i % 7), 'kb')
+        for i in range(0, 20000, 2):
+            memory.delete(str(i))
+        fork = memory.clone()
+        for allocator in (memory, fork):
+            for i in range(2000):
+                allocator.save('x{}'.format(i), 4, 'kb')
+        # A search examines one entry of each size index, plus those bisected to skip up to 2000 pulled entries
+        self.assertLessEqual(max(memory.stats()['visited']), 16)
+        self.assertLessEqual(max(fork.stats()['visited']), 16)
+
+class TestNearHint(unittest.TestCase):
+    def initialize_fragmented(self, algorithm='first', **kwargs):
+        # Free blocks 1, 3-4 and 7-15 between files
+        memory = allocation.Allocation(2, 128, 'mb', 'kb', algorithm, **kwargs)
+        for c in 'abcdefg':
+            memory.save(c, 128, 'kb')
+        for c in 'bde':
+            memory.delete(c)
+        return memory
+
+    def test_near_file(self):
+        memory = self.initialize_fragmented()
+        self.assertEqual(memory.save('x', 128, 'kb', near='g'), range(7, 8))
+        # Blocks 4 and 8 are as near to the end of f as each other, so the lower address is used
+        self.assertEqual(memory.save('y', 128, 'kb', near='f'), range(4, 5))
+        self.assertEqual(memory.save('z', 256, 'kb', near='c'), range(8, 10))
+
+    def test_near_block(self):
+        memory = self.initialize_fragmented('best')
+        self.assertEqual(memory.save('x', 256, 'kb', near=12), range(12, 14))
+        self.assertEqual(memory.save('y', 128, 'kb', near=5), range(4, 5))
+        self.assertEqual(memory.availability(), '1 -> 3 -> 7 -> 8 -> 9 -> 10 -> 11 -> 14 -> 15')
+
+    def test_near_ignored(self):
+        memory = self.initialize_fragmented()
+        self.assertEqual(memory.save('x', 128, 'kb', near='missing'), range(1, 2))
+        memory = self.initialize_fragmented('next')
+        self.assertEqual(memory.save('x', 128, 'kb', near=12), range(7, 8))
+        memory = self.initialize_fragmented(size_classes=(1, 2))
+        self.assertEqual(memory.save('x', 128, 'kb', near=12), memory.read('x'))
+        self.assertLess(memory.read('x').start, 12)
+        with self.assertRaises(ValueError):
+            memory.save('y', 128, 'kb', near=16)
+
+    def test_falls_back_outside_window(self):
+        memory = allocation.Allocation(16, 128, 'mb', 'kb', 'best')
+        for i in range(128):
+            memory.save(str(i), 128, 'kb')
+        for i in list(range(0, 60, 2)) + [61, 62, 63, 100, 101]:
+            memory.delete(str(i))
+        # The nearest chunk large enough, at 61, is more than 16 chunks away from block 0, so best fit is used instead
+        self.assertEqual(memory.save('x', 256, 'kb', near=0), range(100, 102))
+        self.assertEqual(memory.save('y', 256, 'kb', near=50), range(61, 63))
+
+class TestCompaction(unittest.TestCase):
+    def initialize_fragmented(self):
+        memory = allocation.Allocation(1, 128, 'mb', 'kb', 'first')
+        for c in 'abcdefgh':
+            memory.save(c, 128, 'kb')
+        memory.delete('b')
+        memory.delete('d')
+        memory.delete('f')
+        return memory
+
+    def test_plan_only(self):
+        memory = self.initialize_fragmented()
+        self.assertEqual(memory.compact(apply=False), [('h', 7, 1, 1), ('g', 6, 3, 1)])
+        self.assertEqual(memory.availability(), '1 -> 3 -> 5')
+        self.assertEqual(memory.read('h', as_list=True), [7])
+
+    def test_compact(self):
+        memory = self.initialize_fragmented()
+        with self.assertRaises(ValueError):
+            memory.save('z', 200, 'kb')
+        memory.compact()
+        self.assertEqual(memory.availability(), '5 -> 6 -> 7')
+        self.assertEqual(memory.read('h', as_list=True), [1])
+        self.assertEqual(memory.read('g', as_list=True), [3])
+        memory.save('z', 200, 'kb')
+        self.assertEqual(memory.read('z', as_list=True), [5, 6])
+        self.assertEqual(memory.compact(), [])
+
+    def test_compact_sliding(self):
+        memory = allocation.Allocation(1, 128, 'mb', 'kb', 'first')
+        memory.save('a', 128, 'kb')
+        memory.save('b', 128, 'kb')
+        memory.save('c', 384, 'kb')
+        memory.save('d', 256, 'kb')
+        memory.delete('b')
+        self.assertEqual(memory.compact(), [('c', 2, 1, 3), ('d', 5, 4, 2)])
+        self.assertEqual(memory.availability(), '6 -> 7')
+
+    def test_compact_budget(self):
+        memory = self.initialize_fragmented()
+        self.assertEqual(memory.compact(budget=1), [('h', 7, 1, 1)])
+        self.assertEqual(memory.availability(), '3 -> 5 -> 7')
+        self.assertEqual(memory.compact(budget=1), [('g', 6, 3, 1)])
+        self.assertEqual(memory.availability(), '5 -> 6 -> 7')
+
+    def test_compact_budget_smaller_than_first_move(self):
+        memory = allocation.Allocation(1, 128, 'mb', 'kb', 'first')
+        memory.save('a', 128, 'kb')
+        memory.save('b', 512, 'kb')
+        memory.delete('a')
+        self.assertEqual(memory.compact(budget=2), [('b', 1, 0, 4)])
+        self.assertEqual(memory.availability(), '4 -> 5 -> 6 -> 7')
+        self.assertEqual(memory.compact(budget=2), [])
+
+    def test_compact_budget_resumes_plan(self):
+        # 2000 files with a free block after every other one, so the plan moves about 1000 blocks
+        memory = allocation.Allocation(4, 1, 'mb', 'kb', 'first')
+        for i in range(3000):
+            memory.save(str(i), 1, 'kb')
+        for i in range(0, 3000, 3):
+            memory.delete(str(i))
+        planned = memory.compact(apply=False)
+        with mock.patch.object(memory, '_compaction_plan', wraps=memory._compaction_plan) as planner:
+            steps = []
+            while True:
+                step = memory.compact(budget=16)
+                if not step:
+                    break
+                steps.append(step)
+            # Each step carries on with the plan instead of planning again from every file on the device
+            self.assertEqual(planner.call_count, 0)
+        self.assertEqual([move for step in steps for move in step], planned)
+        self.assertTrue(all(sum(move[3] for move in step) <= 16 for step in steps))
+        self.assertEqual(memory.availability().split(' -> ')[0], '2000')
+
+    def test_compact_budget_plans_again_after_changes(self):
+        memory = self.initialize_fragmented()
+        self.assertEqual(memory.compact(budget=1), [('h', 7, 1, 1)])
+        memory.delete('a')
+        # Block 0 is now the lowest hole, which the plan made before the delete would not have used
+        self.assertEqual(memory.compact(budget=1), [('g', 6, 0, 1)])
+        self.assertEqual(memory.compact(), [('e', 4, 3, 1)])
+        self.assertEqual(memory.availability(), '4 -> 5 -> 6 -> 7')
+
+    def test_compact_buddy(self):
+        memory = allocation.Allocation(1, 128, 'mb', 'kb', 'buddy')
+        with self.assertRaises(ValueError):
+            memory.compact()
+
+class TestScatter(unittest.TestCase):
+    def initialize_standard(self):
+        memory = allocation.Allocation(1, 128, 'mb', 'kb', 'first', scatter=True)
+        for c in 'abcdefgh':
+            memory.save(c, 128, 'kb')
+        return memory
+
+    def test_save_contiguous_when_possible(self):
+        memory = self.initialize_standard()
+        memory.delete('c')
+        memory.delete('d')
+        self.assertEqual(memory.save('z', 200, 'kb'), range(2, 4))
+
+    def test_save_scattered(self):
+        memory = self.initialize_standard()
+        memory.delete('a')
+        memory.delete('d')
+        memory.delete('h')
+        self.assertEqual(memory.save('z', 200, 'kb'), [range(0, 1), range(3, 4)])
+        self.assertEqual(memory.read('z'), [range(0, 1), range(3, 4)])
+        self.assertEqual(memory.read('z', as_list=True), [0, 3])
+        self.assertEqual(memory.availability(), '7')
+
+    def test_save_fewest_extents(self):
+        memory = self.initialize_standard()
+        for c in 'acdfgh':
+            memory.delete(c)
+        memory.save('z', 512, 'kb')
+        self.assertEqual(memory.read('z'), [range(0, 1), range(5, 8)])
+        self.assertEqual(memory.availability(), '2 -> 3')
+
+    def test_save_not_enough_capacity(self):
+        memory = self.initialize_standard()
+        memory.delete('a')
+        memory.delete('d')
+        with self.assertRaises(ValueError):
+            memory.save('z', 384, 'kb')
+
+    def test_delete_scattered(self):
+        memory = self.initialize_standard()
+        memory.delete('b')
+        memory.delete('d')
+        memory.delete('f')
+        memory.save('z', 384, 'kb')
+        memory.delete('c')
+        memory.delete('z')
+        self.assertEqual(memory.availability(), '1 -> 2 -> 3 -> 5')
+        self.assertEqual(memory.get_capacity_used(), 4 * 128 * 1024)
+
+    def test_scatter_buddy(self):
+        with self.assertRaises(ValueError):
+            allocation.Allocation(1, 128, 'mb', 'kb', 'buddy', scatter=True)
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'memory.snap')
+
+    def assertSameState(self, memory, restored):
+        self.assertEqual(restored.list_files(), memory.list_files())
+        self.assertEqual(restored.availability(), memory.availability())
+        self.assertEqual(restored.stats(), memory.stats())
+
+    def test_round_trip(self):
+        memory = allocation.Allocation(1, 128, 'mb', 'kb', 'first', scatter=True)
+        for c in 'abcdefgh':
+            memory.save(c, 128, 'kb')
+        for c in 'adh':
+            memory.delete(c)
+        memory.save('z', 200, 'kb')
+        memory.snapshot(self.path)
+        restored = allocation.Allocation.restore(self.path)
+        self.assertSameState(memory, restored)
+        self.assertEqual(restored.read('z'), [range(0, 1), range(3, 4)])
+
+    def test_restored_allocation_is_usable(self):
+        memory = allocation.Allocation(1, 128, 'mb', 'kb', 'first')
+        for c in 'abcd':
+            memory.save(c, 128, 'kb')
+        memory.delete('b')
+        memory.snapshot(self.path)
+        restored = allocation.Allocation.restore(self.path)
+        self.assertEqual(restored.save('e', 128, 'kb'), range(1, 2))
+        restored.delete('a')
+        with self.assertRaises(ValueError):
+            restored.read('a')
+        with self.assertRaises(ValueError):
+            restored.save('c', 128, 'kb')
+        self.assertEqual(sorted(restored.list_files()), ['c', 'd', 'e'])
+        self.assertEqual(restored.availability(), '0 -> 4 -> 5 -> 6 -> 7')
+        # The image itself is unchanged
+        self.assertSameState(memory, allocation.Allocation.restore(self.path))
+
+    def test_snapshot_of_restored_allocation(self):
+        memory = allocation.Allocation(1, 128, 'mb', 'kb', 'best')
+        for c in 'abcd':
+            memory.save(c, 128, 'kb')
+        memory.snapshot(self.path)
+        restored = allocation.Allocation.restore(self.path)
+        restored.delete('b')
+        restored.save('e', 256, 'kb')
+        restored.snapshot(self.path)
+        self.assertSameState(restored, allocation.Allocation.restore(self.path))
+
+    def test_round_trip_buddy_and_pools(self):
+        rng = random.Random(3)
+        for kwargs in ({'allocation_algorithm': 'buddy'}, {'size_classes': (1, 2, 4), 'pool_refill': 2}):
+            memory = allocation.Allocation(4, 4, 'mb', 'kb', **kwargs)
+            for i in range(100):
+                memory.save(str(i), rng.randint(1, 24), 'kb')
+            for i in rng.sample(range(100), 50):
+                memory.delete(str(i))
+            memory.snapshot(self.path)
+            restored = allocation.Allocation.restore(self.path)
+            self.assertSameState(memory, restored)
+            for i in range(100, 150):
+                size = rng.randint(1, 24)
+                self.assertEqual(restored.save(str(i), size, 'kb'), memory.save(str(i), size, 'kb'))
+
+    def test_restore_not_a_snapshot(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a snapshot')
+        with self.assertRaises(ValueError):
+            allocation.Allocation.restore(self.path)
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = os.path.join(directory.name, 'journal')
+
+    def crash(self):
+        # Copies the journal directory as it is on disk, as if the process had stopped here
+        self.crashes = getattr(self, 'crashes', 0) + 1
+        return shutil.copytree(self.directory, '{}-{}'.format(self.directory, self.crashes))
+
+    def initialize_standard(self, **kwargs):
+        memory = allocation.Allocation(1, 128, 'mb', 'kb', 'first')
+        memory.open_journal(self.directory, **kwargs)
+        self.addCleanup(memory.close_journal)
+        for c in 'abcdefgh':
+            memory.save(c, 128, 'kb')
+        memory.delete('b')
+        memory.delete('d')
+        return memory
+
+    def test_recover(self):
+        memory = self.initialize_standard()
+        memory.close_journal()
+        recovered = allocation.Allocation.recover(self.directory)
+        self.addCleanup(recovered.close_journal)
+        self.assertEqual(recovered.list_files(), memory.list_files())
+        self.assertEqual(recovered.availability(), '1 -> 3')
+        self.assertEqual(recovered.get_capacity_used(), memory.get_capacity_used())
+
+    def test_recover_compaction(self):
+        memory = self.initialize_standard()
+        memory.compact()
+        memory.sync()
+        recovered = allocation.Allocation.recover(self.crash())
+        self.addCleanup(recovered.close_journal)
+        self.assertEqual(recovered.list_files(), memory.list_files())
+        self.assertEqual(recovered.availability(), '6 -> 7')
+
+    def test_group_commit(self):
+        memory = self.initialize_standard(group_commit=3, commit_window=None)
+        # Ten records appended, so the last one is still waiting for its group
+        recovered = allocation.Allocation.recover(self.crash())
+        recovered.close_journal()
+        self.assertEqual(sorted(recovered.list_files()), ['a', 'c', 'd', 'e', 'f', 'g', 'h'])
+        memory.sync()
+        recovered = allocation.Allocation.recover(self.crash())
+        recovered.close_journal()
+        self.assertEqual(recovered.list_files(), memory.list_files())
+
+    def test_commit_window(self):
+        memory = self.initialize_standard(group_commit=1000, commit_window=0.01)
+        time.sleep(0.2)
+        recovered = allocation.Allocation.recover(self.crash())
+        recovered.close_journal()
+        self.assertEqual(recovered.list_files(), memory.list_files())
+
+    def test_torn_record_ignored(self):
+        memory = self.initialize_standard()
+        memory.close_journal()
+        with open(os.path.join(self.directory, 'journal.0'), 'ab') as f:
+            f.write(b'0000abcd ["delete","a",[[0')
+        recovered = allocation.Allocation.recover(self.directory)
+        self.addCleanup(recovered.close_journal)
+        self.assertEqual(recovered.list_files(), memory.list_files())
+
+    def test_checkpoint_truncates_journal(self):
+        memory = self.initialize_standard(checkpoint_every=4)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['checkpoint.2', 'journal.2'])
+        memory.checkpoint()
+        self.assertEqual(sorted(os.listdir(self.directory)), ['checkpoint.3', 'journal.3'])
+        self.assertEqual(os.path.getsize(os.path.join(self.directory, 'journal.3')), 0)
+        memory.close_journal()
+        recovered = allocation.Allocation.recover(self.directory)
+        self.addCleanup(recovered.close_journal)
+        self.assertEqual(recovered.list_files(), memory.list_files())
+
+    def test_open_existing_journal(self):
+        self.initialize_standard().close_journal()
+        memory = allocation.Allocation(1, 128, 'mb', 'kb', 'first')
+        with self.assertRaises(ValueError):
+            memory.open_journal(self.directory)
+
+    def test_recover_without_journal(self):
+        with self.assertRaises(ValueError):
+            allocation.Allocation.recover(self.directory)
+
+class TestBuddyMethods(unittest.TestCase):
+    def initialize_standard(self):
+        return allocation.Allocation(1, 128, 'mb', 'kb', 'buddy')
+
+    def test_wrong_backend(self):
+        with self.assertRaises(ValueError):
+            allocation.Allocation(1, 128, 'mb', 'kb', 'buddy', 'bitmap')
+
+    def test_save_rounds_to_power_of_two(self):
+        memory = self.initialize_standard()
+        memory.save('a', 300, 'kb')
+        self.assertEqual(memory.read('a', as_list=True), [0, 1, 2])
+        self.assertEqual(memory.get_capacity_used(), 512 * 1024)
+        self.assertEqual(memory.stats()['internal_fragmentation'], 128 * 1024)
+        memory.save('b', 100, 'kb')
+        self.assertEqual(memory.read('b', as_list=True), [4])
+        memory.save('c', 100, 'kb')
+        self.assertEqual(memory.read('c', as_list=True), [5])
+
+    def test_save_smallest_run(self):
+        memory = allocation.Allocation(768, 128, 'kb', 'kb', 'buddy')
+        memory.save('a', 200, 'kb')
+        self.assertEqual(memory.read('a', as_list=True), [4, 5])
+        memory.save('b', 512, 'kb')
+        self.assertEqual(memory.read('b', as_list=True), [0, 1, 2, 3])
+        with self.assertRaises(ValueError):
+            memory.save('c', 100, 'kb')
+
+    def test_delete_merges_buddies(self):
+        memory = self.initialize_standard()
+        memory.save('a', 100, 'kb')
+        memory.save('b', 100, 'kb')
+        memory.save('c', 300, 'kb')
+        memory.delete('b')
+        memory.delete('a')
+        memory.delete('c')
+        self.assertEqual(memory.stats()['free_extents'], 1)
+        self.assertEqual(memory.stats()['internal_fragmentation'], 0)
+        memory.save('d', 1024, 'kb')
+        self.assertEqual(memory.read('d', as_list=True), [0, 1, 2, 3, 4, 5, 6, 7])
+
+class TestSizeClassPools(unittest.TestCase):
+    def initialize_standard(self):
+        return allocation.Allocation(1, 128, 'mb', 'kb', 'best', size_classes=(1, 2), pool_refill=2)
+
+    def test_wrong_size_classes(self):
+        with self.assertRaises(ValueError):
+            allocation.Allocation(1, 128, 'mb', 'kb', 'best', size_classes=(0, 2))
+        with self.assertRaises(ValueError):
+            allocation.Allocation(1, 128, 'mb', 'kb', 'buddy', size_classes=(1, 2))
+
+    def test_save_refills_pool(self):
+        memory = self.initialize_standard()
+        memory.save('a', 100, 'kb')
+        memory.save('b', 100, 'kb')
+        memory.save('c', 100, 'kb')
+        self.assertEqual(memory.read('a', as_list=True), [0])
+        self.assertEqual(memory.read('b', as_list=True), [1])
+        self.assertEqual(memory.read('c', as_list=True), [2])
+        self.assertEqual(memory.stats()['pools'], {1: {'idle': 1, 'in_use': 3}, 2: {'idle': 0, 'in_use': 0}})
+        self.assertEqual(memory.availability(), '3 -> 4 -> 5 -> 6 -> 7')
+
+    def test_save_rounds_to_size_class(self):
+        memory = allocation.Allocation(1, 128, 'mb', 'kb', 'best', size_classes=(1, 4), pool_refill=2)
+        memory.save('a', 200, 'kb')
+        self.assertEqual(memory.read('a', as_list=True), [0, 1])
+        self.assertEqual(memory.get_capacity_used(), 512 * 1024)
+        self.assertEqual(memory.stats()['internal_fragmentation'], 256 * 1024)
+
+    def test_delete_returns_slot_to_pool(self):
+        memory = self.initialize_standard()
+        memory.save('a', 100, 'kb')
+        memory.delete('a')
+        self.assertEqual(memory.stats()['pools'][1], {'idle': 2, 'in_use': 0})
+        memory.save('b', 100, 'kb')
+        self.assertEqual(memory.read('b', as_list=True), [0])
+
+    def test_save_large_drains_pools(self):
+        memory = self.initialize_standard()
+        memory.save('a', 100, 'kb')
+        memory.save('b', 200, 'kb')
+        memory.delete('a')
+        memory.delete('b')
+        memory.save('c', 1024, 'kb')
+        self.assertEqual(memory.read('c', as_list=True), [0, 1, 2, 3, 4, 5, 6, 7])
+        self.assertEqual(memory.stats()['pools'][1], {'idle': 0, 'in_use': 0})
+
+class TestMetrics(unittest.TestCase):
+    def initialize_standard(self):
+        return allocation.Allocation(1, 128, 'mb', 'kb', 'first', metrics=True)
+
+    def test_disabled_by_default(self):
+        memory = allocation.Allocation(1, 128, 'mb', 'kb')
+        memory.save('a', 120, 'kb')
+        self.assertNotIn('operations', memory.stats())
+
+    def test_operation_counts(self):
+        memory = self.initialize_standard()
+        memory.save('a', 200, 'kb')
+        memory.read('a')
+        with self.assertRaises(ValueError):
+            memory.read('b')
+        memory.delete('a')
+        stats = memory.stats()
+        self.assertEqual(stats['operations'], {'save': 1, 'read': 2, 'read_failed': 1, 'delete': 1})
+        self.assertEqual(sum(stats['latency_ns']['read'].values()), 2)
+        self.assertEqual(stats['bytes_allocated'], 256 * 1024)
+        self.assertEqual(stats['bytes_freed'], 256 * 1024)
+
+    def test_visited_per_search(self):
+        memory = self.initialize_standard()
+        memory.save('a', 120, 'kb')
+        memory.save('b', 120, 'kb')
+        memory.save('c', 120, 'kb')
+        memory.delete('b')
+        memory.save('d', 200, 'kb')
+        self.assertEqual(memory.stats()['visited'], {1: 3, 2: 1})
+
+    def test_subscribe(self):
+        memory = allocation.Allocation(1, 128, 'mb', 'kb')
+        events = []
+        memory.subscribe(lambda event, file_id, location: events.append((event, file_id, location)))
+        memory.save('a', 200, 'kb')
+        memory.delete('a')
+        self.assertEqual(events, [('save', 'a', range(0, 2)), ('delete', 'a', range(0, 2))])
+
+@unittest.skipUnless(HAS_NUMPY, 'bitmap backend requires numpy')
+class TestBitmapBackend(unittest.TestCase):
+    def replay(self, backend, algorithm, seed):
+        rng = random.Random(seed)
+        memory = allocation.Allocation(64, 1, 'kb', 'kb', algorithm, backend)
+        results = []
+        files = []
+        for i in range(300):
+            if files and rng.random() < 0.45:
+                file_id = files.pop(rng.randrange(len(files)))
+                memory.delete(file_id)
+                results.append(memory.availability())
+            else:
+                file_id = str(i)
+                try:
+                    results.append(memory.save(file_id, rng.randint(1, 6000), 'b'))
+                    files.append(file_id)
+                except ValueError as e:
+                    results.append(str(e))
+        results.append({file_id: memory.read(file_id) for file_id in files})
+        return results
+
+    def test_wrong_backend(self):
+        with self.assertRaises(ValueError):
+            allocation.Allocation(1, 128, 'mb', 'kb', 'best', 'tree')
+
+    def test_init(self):
+        memory = allocation.Allocation(1, 128, 'mb', 'kb', 'best', 'bitmap')
+        self.assertEqual(memory.availability(), '0 -> 1 -> 2 -> 3 -> 4 -> 5 -> 6 -> 7')
+
+    def test_matches_list_backend_first_fit(self):
+        for seed in range(5):
+            self.assertEqual(self.replay('bitmap', 'first', seed), self.replay('list', 'first', seed))
+
+    def test_matches_list_backend_next_fit(self):
+        for seed in range(5):
+            self.assertEqual(self.replay('bitmap', 'next', seed), self.replay('list', 'next', seed))
+
+    def test_matches_list_backend_best_fit(self):
+        for seed in range(5):
+            self.assertEqual(self.replay('bitmap', 'best', seed), self.replay('list', 'best', seed))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,244 @@
+import argparse
+import importlib.util
+import multiprocessing
+import resource
+import time
+
+import allocation
+from support import traces
+
+# Allocation configurations compared by default, as keyword arguments on top of the device size
+ENGINES = {
+    'first': {'allocation_algorithm': 'first'},
+    'best': {'allocation_algorithm': 'best'},
+    'next': {'allocation_algorithm': 'next'},
+    'buddy': {'allocation_algorithm': 'buddy'},
+    'pooled': {'allocation_algorithm': 'best', 'size_classes': (1, 2, 3, 4)},
+}
+if importlib.util.find_spec('numpy') is not None:
+    ENGINES['bitmap-first'] = {'allocation_algorithm': 'first', 'backend': 'bitmap'}
+    ENGINES['bitmap-best'] = {'allocation_algorithm': 'best', 'backend': 'bitmap'}
+
+def replay(trace: list, capacity: int, block: int, engine: dict, samples: int = 20) -> dict:
+    '''
+    Replays a trace against a new Allocation, timing every operation
+
+    :param trace: list of operations, see support/traces.py
+    :param capacity: capacity of the device in bytes
+    :param block: size of block in bytes
+    :param engine: keyword arguments for Allocation, e.g. {'allocation_algorithm': 'first'}
+    :param samples: number of times to sample fragmentation over the course of the trace
+    :return: dict of results:
+        ops: number of operations replayed
+        ops_per_sec: operations per second, counting only time spent in the allocator
+        p50_us, p99_us: median and 99th percentile operation latency in microseconds
+        failed_saves: number of saves that raised an error
+        failed_ops: number of other operations that raised an error
+        fragmentation: list of (operation index, fragmentation) samples, where fragmentation is the share of free
+                       space outside the largest free chunk
+        largest_free_extent: size of the largest free chunk at the end of the trace in bytes
+        peak_rss_kb: peak resident set size of the process in KB
+    '''
+    memory = allocation.Allocation(capacity, block, 'b', 'b', **engine)
+    latencies = []
+    fragmentation = []
+    failed_saves = 0
+    failed_ops = 0
+    sample_every = max(len(trace) // max(samples, 1), 1)
+
+    for i, operation in enumerate(trace, 1):
+        start = time.perf_counter_ns()
+        try:
+            if operation[0] == 'save':
+                memory.save(operation[1], operation[2], operation[3])
+            elif operation[0] == 'read':
+                memory.read(operation[1])
+            else:
+                memory.delete(operation[1])
+        except ValueError:
+            if operation[0] == 'save':
+                failed_saves += 1
+            else:
+                failed_ops += 1
+        latencies.append(time.perf_counter_ns() - start)
+        if i % sample_every == 0 or i == len(trace):
+            fragmentation.append((i, external_fragmentation(memory)))
+
+    latencies.sort()
+    elapsed = sum(latencies)
+    return {
+        'ops': len(trace),
+        'ops_per_sec': len(trace) / (elapsed / 1e9) if elapsed else 0.0,
+        'p50_us': percentile(latencies, 50) / 1000,
+        'p99_us': percentile(latencies, 99) / 1000,
+        'failed_saves': failed_saves,
+        'failed_ops': failed_ops,
+        'fragmentation': fragmentation,
+        'largest_free_extent': memory.stats()['largest_free_extent'],
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+def external_fragmentation(memory: allocation.Allocation) -> float:
+    '''
+    Share of free space that lies outside the largest free chunk: 0 when all free space is contiguous, approaching 1
+    as it splinters
+    '''
+    stats = memory.stats()
+    free = stats['capacity'] - stats['capacity_used']
+    return 1 - stats['largest_free_extent'] / free if free else 0.0
+
+def percentile(values: list, pct: float) -> float:
+    '''
+    Nearest rank percentile of an already sorted list
+    '''
+    if not values:
+        return 0
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+def build_trace(name: str, ops: int, capacity: int, block: int, seed: int) -> list:
+    '''
+    Generates a synthetic trace by name, or reads a recorded one if name is a path
+    '''
+    if name in traces.SYNTHETIC:
+        return traces.SYNTHETIC[name](ops, capacity // block, block, seed)
+    with open(name) as f:
+        return traces.parse(f)
+
+def parse_size(size: str) -> int:
+    '''
+    Parses a size such as '64mb' or '4096' into bytes
+    '''
+    digits = size.rstrip('bBkKmMgGtT')
+    unit = size[len(digits):].lower() or 'b'
+    if not digits.isdigit() or unit not in allocation.UNITS:
+        raise argparse.ArgumentTypeError('{!r} is not a size such as 64mb'.format(size))
+    return allocation.to_bytes(int(digits), unit)
+
+def format_table(rows: list, columns: list) -> str:
+    '''
+    Formats rows of dicts as a plain text table with the given (header, key, format) columns
+    '''
+    cells = [[header for header, key, fmt in columns]]
+    for row in rows:
+        cells.append([fmt.format(row[key]) for header, key, fmt in columns])
+    widths = [max(len(line[i]) for line in cells) for i in range(len(columns))]
+    return '\n'.join('  '.join(cell.rjust(width) for cell, width in zip(line, widths)) for line in cells)
+
+def summarize_fragmentation(result: dict) -> dict:
+    '''
+    Adds final_fragmentation and peak_fragmentation, taken from the fragmentation samples, to a result of replay
+
+    :return: the result
+    '''
+    result['final_fragmentation'] = result['fragmentation'][-1][1] if result['fragmentation'] else 0.0
+    result['peak_fragmentation'] = max((f for i, f in result['fragmentation']), default=0.0)
+    return result
+
+def clone_cost(capacity: int, block: int, engine: dict) -> dict:
+    '''
+    Times single block saves on a device fragmented into many small free chunks, once on a device never cloned and
+    once on each side of a clone, to show what sharing the free map with a fork costs. Half the device is filled with
+    files of 1 to 7 blocks and every other one deleted, and a fifth as many saves as there are free chunks are timed,
+    so the clone is never folded into a new base partway through.
+
+    :param capacity: capacity of the device in bytes
+    :param block: size of block in bytes
+    :param engine: keyword arguments for Allocation, e.g. {'allocation_algorithm': 'best'}
+    :return: dict of free_chunks, saves, and the seconds the saves took on the device before cloning (before_s), on
+             the original after cloning (original_s) and on the clone (clone_s)
+    '''
+    def fragmented() -> allocation.Allocation:
+        memory = allocation.Allocation(capacity, block, 'b', 'b', **engine)
+        files = 0
+        used = 0
+        while used + 7 <= capacity // block // 2:
+            memory.save(str(files), (1 + files % 7) * block, 'b')
+            used += 1 + files % 7
+            files += 1
+        for i in range(0, files, 2):
+            memory.delete(str(i))
+        return memory
+
+    def saving(memory: allocation.Allocation, saves: int) -> float:
+        began = time.perf_counter()
+        for i in range(saves):
+            memory.save('x{}'.format(i), block, 'b')
+        return time.perf_counter() - began
+
+    memory = fragmented()
+    free_chunks = memory.stats()['free_extents']
+    saves = free_chunks // 5
+    before = saving(memory, saves)
+    original = fragmented()
+    clone = original.clone()
+    return {
+        'free_chunks': free_chunks,
+        'saves': saves,
+        'before_s': before,
+        'original_s': saving(original, saves),
+        'clone_s': saving(clone, saves),
+    }
+
+def _replay_job(job: tuple) -> dict:
+    trace_name, trace, capacity, block, engine_name, samples = job
+    result = replay(trace, capacity, block, ENGINES[engine_name], samples)
+    result['trace'] = trace_name
+    result['engine'] = engine_name
+    return summarize_fragmentation(result)
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description='Replay operation traces against each allocation engine')
+    parser.add_argument('traces', nargs='*', default=list(traces.SYNTHETIC),
+                        help='synthetic trace names ({}) or paths to recorded traces'.format(
+                            ', '.join(traces.SYNTHETIC)))
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=list(ENGINES))
+    parser.add_argument('--ops', type=int, default=20000, help='operations per synthetic trace')
+    parser.add_argument('--capacity', type=parse_size, default=parse_size('64mb'))
+    parser.add_argument('--block', type=parse_size, default=parse_size('4kb'))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--samples', type=int, default=20, help='fragmentation samples per run')
+    parser.add_argument('--clone', action='store_true',
+                        help='instead of replaying traces, time saves before and after cloning a fragmented device')
+    args = parser.parse_args(argv)
+
+    if args.clone:
+        results = []
+        for engine in args.engines:
+            result = clone_cost(args.capacity, args.block, ENGINES[engine])
+            result['engine'] = engine
+            results.append(result)
+        print(format_table(results, [
+            ('engine', 'engine', '{}'),
+            ('free chunks', 'free_chunks', '{}'),
+            ('saves', 'saves', '{}'),
+            ('before s', 'before_s', '{:.3f}'),
+            ('original s', 'original_s', '{:.3f}'),
+            ('clone s', 'clone_s', '{:.3f}'),
+        ]))
+        return
+
+    jobs = []
+    for name in args.traces:
+        trace = build_trace(name, args.ops, args.capacity, args.block, args.seed)
+        jobs.extend((name, trace, args.capacity, args.block, engine, args.samples) for engine in args.engines)
+
+    # Each run gets a fresh process, one at a time, so peak RSS belongs to that run alone and runs do not compete
+    # for CPU
+    with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        results = pool.map(_replay_job, jobs, chunksize=1)
+
+    print(format_table(results, [
+        ('trace', 'trace', '{}'),
+        ('engine', 'engine', '{}'),
+        ('ops', 'ops', '{}'),
+        ('ops/sec', 'ops_per_sec', '{:.0f}'),
+        ('p50 us', 'p50_us', '{:.1f}'),
+        ('p99 us', 'p99_us', '{:.1f}'),
+        ('failed saves', 'failed_saves', '{}'),
+        ('frag end', 'final_fragmentation', '{:.3f}'),
+        ('frag peak', 'peak_fragmentation', '{:.3f}'),
+        ('peak RSS KB', 'peak_rss_kb', '{}'),
+    ]))
+
+if __name__ == '__main__':
+    main()
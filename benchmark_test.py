@@ -0,0 +1,57 @@
+import unittest
+import benchmark
+from support import traces
+
+class TestTraces(unittest.TestCase):
+    def test_synthetic_deterministic(self):
+        for name, generate in traces.SYNTHETIC.items():
+            self.assertEqual(generate(500, 256, 1024, 7), generate(500, 256, 1024, 7), name)
+
+    def test_synthetic_only_deletes_saved_files(self):
+        for name, generate in traces.SYNTHETIC.items():
+            saved = set()
+            for operation in generate(2000, 256, 1024, 1):
+                if operation[0] == 'save':
+                    saved.add(operation[1])
+                else:
+                    self.assertIn(operation[1], saved, name)
+
+    def test_fill_to_full_stops_when_full(self):
+        trace = traces.fill_to_full(10000, 256, 1024)
+        self.assertLessEqual(sum(operation[2] for operation in trace), (256 + 64) * 1024)
+
+    def test_parse_round_trip(self):
+        trace = traces.uniform(200, 256, 1024)
+        self.assertEqual(traces.parse(traces.dump(trace).splitlines()), trace)
+
+    def test_parse(self):
+        self.assertEqual(traces.parse(['# comment', '', 'save a 3 KB', 'read a', 'delete a']),
+                         [('save', 'a', 3, 'kb'), ('read', 'a'), ('delete', 'a')])
+        with self.assertRaises(ValueError):
+            traces.parse(['save a'])
+
+class TestReplay(unittest.TestCase):
+    def test_replay(self):
+        trace = [('save', 'a', 2048, 'b'), ('save', 'b', 1024, 'b'), ('delete', 'a'), ('read', 'b'),
+                 ('delete', 'c'), ('save', 'c', 8192, 'b')]
+        result = benchmark.replay(trace, 4096, 1024, benchmark.ENGINES['first'], samples=3)
+        self.assertEqual(result['ops'], 6)
+        self.assertEqual(result['failed_saves'], 1)
+        self.assertEqual(result['failed_ops'], 1)
+        self.assertEqual([i for i, fragmentation in result['fragmentation']], [2, 4, 6])
+        self.assertEqual(result['fragmentation'][0][1], 0.0)
+        self.assertAlmostEqual(result['fragmentation'][1][1], 1 / 3)
+        self.assertEqual(result['largest_free_extent'], 2048)
+
+    def test_clone_cost(self):
+        result = benchmark.clone_cost(1024 * 1024, 1024, benchmark.ENGINES['best'])
+        self.assertGreater(result['free_chunks'], 50)
+        self.assertEqual(result['saves'], result['free_chunks'] // 5)
+        self.assertTrue(all(result[key] >= 0 for key in ('before_s', 'original_s', 'clone_s')))
+
+    def test_parse_size(self):
+        self.assertEqual(benchmark.parse_size('64mb'), 64 * 1024**2)
+        self.assertEqual(benchmark.parse_size('4096'), 4096)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+from collections import deque
+import itertools
+import os
+import threading
+
+import allocation
+
+class ConcurrentAllocation:
+    def __init__(self, capacity: int, block: int, capacity_unit: str = 'mb', block_unit: str = 'kb', allocation_algorithm: str = 'best', groups: int = None, **kwargs) -> None:
+        '''
+        Initializes a file manager that is safe to share between threads. The device is split into allocation groups,
+        each an independent Allocation over its own range of blocks with its own lock, so threads working in different
+        groups never wait for each other. Each thread is given a home group to save files in, and only takes space from
+        other groups once its home group has none left. Several private instance variables are created:
+            block: size of block in Bytes
+            groups: list of Allocation objects, one per group
+            locks: list of locks, one per group, held for every call into that group
+            offsets: list of the first block of each group on the device
+            index: hashmap (dict) of file_id -> number of the group holding the file, used to route reads and deletes.
+                   Only single dict operations are used on it, which are atomic, so it needs no lock of its own.
+            homes: home group of each thread
+            next_home: counter used to hand out home groups in turn
+
+        Files must fit within a single group. Blocks returned to callers are numbered across the whole device.
+
+        :param capacity: Total capacity of memory
+        :param block: Size of block of memory
+        :param capacity_unit: Unit used for capacity. Must be one of B, KB, MB, GB, or TB. Defaults to MB.
+        :param block_unit: Unit used for block size. Must be one of B, KB, MB, GB, or TB. Defaults to KB.
+        :param allocation_algorithm: Algorithm used for allocation within each group, see Allocation. Defaults to best.
+        :param groups: Number of allocation groups. Defaults to the number of CPUs, or fewer if the device has fewer
+                       blocks.
+        :param kwargs: Any other keyword arguments for Allocation, e.g. backend or size_classes
+        '''
+        self._block = allocation.to_bytes(block, block_unit)
+        num_blocks = int(allocation.to_bytes(capacity, capacity_unit) / self._block)
+        if groups is None:
+            groups = os.cpu_count() or 1
+        if groups <= 0:
+            raise ValueError('Number of groups must be greater than 0')
+        groups = max(min(groups, num_blocks), 1)
+
+        self._groups = []
+        self._offsets = []
+        offset = 0
+        for i in range(groups):
+            group_blocks = num_blocks // groups + (1 if i < num_blocks % groups else 0)
+            self._groups.append(allocation.Allocation(group_blocks * self._block, self._block, 'b', 'b',
+                                                      allocation_algorithm, **kwargs))
+            self._offsets.append(offset)
+            offset += group_blocks
+        self._locks = [threading.Lock() for group in self._groups]
+        self._index = {}
+        self._homes = threading.local()
+        self._next_home = itertools.count()
+
+    def save(self, file_id: str, size: int, size_unit: str, as_list: bool = False) -> range:
+        '''
+        Takes file_id and saves it in the calling thread's home group, or failing that in another group with room for
+        it, and returns the range of blocks assigned to the file. Other groups that are not busy are tried before
+        waiting on those that are.
+
+        :param file_id: desired file_id as a string
+        :param size: size of given file
+        :param size_unit: unit used for file size. Must be one of B, KB, MB, or GB
+        :param as_list: return the blocks as a list rather than a range. Defaults to False.
+        :return: range of blocks that is assigned to the file given
+        '''
+        if size <= 0:
+            raise ValueError('Size must be greater than 0')
+        allocation.to_bytes(size, size_unit)
+
+        # Claiming the file_id with a single setdefault makes sure only one of several concurrent saves of it wins
+        claim = object()
+        if self._index.setdefault(file_id, claim) is not claim:
+            raise ValueError('file_id already exists')
+
+        home = self._home()
+        others = [(home + i) % len(self._groups) for i in range(1, len(self._groups))]
+        attempts = deque([(home, True)] + [(i, False) for i in others])
+        error = None
+        while attempts:
+            i, blocking = attempts.popleft()
+            lock = self._locks[i]
+            if not lock.acquire(blocking=blocking):
+                attempts.append((i, True))
+                continue
+            try:
+                location = self._groups[i].save(file_id, size, size_unit)
+            except ValueError as e:
+                error = e
+                continue
+            finally:
+                lock.release()
+            self._index[file_id] = i
+            return self._device_location(location, i, as_list)
+
+        del self._index[file_id]
+        raise error
+
+    def read(self, file_id: str, as_list: bool = False) -> range:
+        '''
+        Return blocks allocated to file as a range, or a list of ranges if the file is split across several chunks.
+        Uses the index to find the group holding the file.
+
+        :param file_id: desired file_id as a string
+        :param as_list: return the blocks as a list rather than a range. Defaults to False.
+        :return: range of blocks allocated to the file
+        '''
+        i = self._group_of(file_id)
+        with self._locks[i]:
+            location = self._groups[i].read(file_id)
+        return self._device_location(location, i, as_list)
+
+    def delete(self, file_id: str) -> None:
+        '''
+        Removes allocation for provided file_id, and returns its blocks to its group to be re-allocated.
+
+        :param file_id: desired file_id as a string
+        '''
+        i = self._group_of(file_id)
+        with self._locks[i]:
+            self._groups[i].delete(file_id)
+            # Removed while the group is still locked, so a concurrent delete of the same file fails in the group
+            del self._index[file_id]
+
+    # Setters and Getters
+    def get_capacity(self) -> int:
+        '''
+        Capacity in bytes
+        '''
+        return sum(group.get_capacity() for group in self._groups)
+
+    def get_capacity_used(self) -> int:
+        '''
+        Capacity used in bytes
+        '''
+        return sum(group.get_capacity_used() for group in self._groups)
+
+    def get_capacity_remaining(self) -> int:
+        '''
+        Capacity remaining in bytes
+        '''
+        return self.get_capacity() - self.get_capacity_used()
+
+    def list_files(self) -> dict:
+        '''
+        List all files, as file_id -> range of blocks allocated to the file
+        '''
+        files = {}
+        for i in range(len(self._groups)):
+            with self._locks[i]:
+                group_files = self._groups[i].list_files()
+            files.update((file_id, self._device_location(location, i)) for file_id, location in group_files.items())
+        return files
+
+    def stats(self) -> dict:
+        '''
+        Summary of how the device is being used, summed over groups, see Allocation.stats. Each group's own stats are
+        included under groups. largest_free_extent is the largest in any one group, which is also the largest file
+        that can be saved.
+        '''
+        groups = []
+        for i in range(len(self._groups)):
+            with self._locks[i]:
+                groups.append(self._groups[i].stats())
+        stats = {key: sum(group[key] for group in groups) for key in
+                 ('capacity', 'capacity_used', 'capacity_remaining', 'files', 'free_extents', 'internal_fragmentation')}
+        stats['largest_free_extent'] = max(group['largest_free_extent'] for group in groups)
+        stats['groups'] = groups
+        return stats
+
+    def availability(self) -> str:
+        '''
+        Blocks that have not been allocated, across every group
+        '''
+        blocks = []
+        for i in range(len(self._groups)):
+            with self._locks[i]:
+                available = self._groups[i].availability()
+            if available != 'No available blocks':
+                blocks.extend(str(int(block) + self._offsets[i]) for block in available.split(' -> '))
+        return ' -> '.join(blocks) if blocks else 'No available blocks'
+
+    # Private support functions
+    def _home(self) -> int:
+        '''
+        Home group of the calling thread, handing out groups in turn to threads seen for the first time
+        '''
+        home = getattr(self._homes, 'group', None)
+        if home is None:
+            home = self._homes.group = next(self._next_home) % len(self._groups)
+        return home
+
+    def _group_of(self, file_id: str) -> int:
+        '''
+        Number of the group holding file_id
+        '''
+        i = self._index.get(file_id)
+        if not isinstance(i, int):  # Missing, or claimed by a save still in progress
+            raise ValueError('file_id does not exist')
+        return i
+
+    def _device_location(self, location, i: int, as_list: bool = False):
+        '''
+        Translates a location returned by group i, a range or list of ranges, to blocks numbered across the device
+        '''
+        offset = self._offsets[i]
+        if isinstance(location, list):
+            locations = [range(part.start + offset, part.stop + offset) for part in location]
+            return [block for part in locations for block in part] if as_list else locations
+        location = range(location.start + offset, location.stop + offset)
+        return list(location) if as_list else location
@@ -0,0 +1,94 @@
+import random
+import threading
+import unittest
+import concurrent_allocation
+
+class TestConcurrentAllocation(unittest.TestCase):
+    def initialize_standard(self, groups=2):
+        # 8 blocks in two groups of 4: blocks 0-3 and 4-7
+        return concurrent_allocation.ConcurrentAllocation(1, 128, 'mb', 'kb', 'first', groups=groups)
+
+    def test_save_in_home_group(self):
+        memory = self.initialize_standard()
+        self.assertEqual(memory.save('a', 128, 'kb'), range(0, 1))
+        self.assertEqual(memory.save('b', 256, 'kb', as_list=True), [1, 2])
+        self.assertEqual(memory.read('b'), range(1, 3))
+
+    def test_other_thread_home_group(self):
+        memory = self.initialize_standard()
+        memory.save('a', 128, 'kb')
+        thread = threading.Thread(target=memory.save, args=('b', 128, 'kb'))
+        thread.start()
+        thread.join()
+        self.assertEqual(memory.read('b'), range(4, 5))
+
+    def test_steal_when_home_group_full(self):
+        memory = self.initialize_standard()
+        memory.save('a', 384, 'kb')
+        self.assertEqual(memory.save('b', 256, 'kb'), range(4, 6))
+        self.assertEqual(memory.availability(), '3 -> 6 -> 7')
+
+    def test_save_larger_than_group(self):
+        memory = self.initialize_standard()
+        with self.assertRaises(ValueError):
+            memory.save('a', 640, 'kb')
+        with self.assertRaises(ValueError):
+            memory.read('a')
+
+    def test_save_duplicate(self):
+        memory = self.initialize_standard()
+        memory.save('a', 128, 'kb')
+        with self.assertRaises(ValueError):
+            memory.save('a', 128, 'kb')
+
+    def test_delete(self):
+        memory = self.initialize_standard()
+        memory.save('a', 384, 'kb')
+        memory.save('b', 256, 'kb')
+        memory.delete('b')
+        with self.assertRaises(ValueError):
+            memory.delete('b')
+        self.assertEqual(memory.list_files(), {'a': range(0, 3)})
+        self.assertEqual(memory.get_capacity_used(), 384 * 1024)
+
+    def test_stats(self):
+        memory = self.initialize_standard()
+        memory.save('a', 384, 'kb')
+        stats = memory.stats()
+        self.assertEqual(stats['capacity'], 1024 * 1024)
+        self.assertEqual(stats['files'], 1)
+        self.assertEqual(stats['largest_free_extent'], 512 * 1024)
+        self.assertEqual(len(stats['groups']), 2)
+
+    def test_threads(self):
+        memory = concurrent_allocation.ConcurrentAllocation(4, 4, 'mb', 'kb', 'best', groups=4)
+        errors = []
+
+        def work(thread):
+            rng = random.Random(thread)
+            live = []
+            for i in range(500):
+                file_id = '{}-{}'.format(thread, i)
+                try:
+                    location = memory.save(file_id, rng.randint(1, 32), 'kb')
+                    live.append((file_id, location))
+                except ValueError:
+                    pass
+                if live and rng.random() < 0.4:
+                    file_id, location = live.pop(rng.randrange(len(live)))
+                    if memory.read(file_id) != location:
+                        errors.append(file_id)
+                    memory.delete(file_id)
+
+        threads = [threading.Thread(target=work, args=(thread,)) for thread in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        blocks = [block for location in memory.list_files().values() for block in location]
+        self.assertEqual(len(blocks), len(set(blocks)))
+        free = memory.availability().split(' -> ')
+        self.assertEqual(len(blocks) + len(free), 1024)
+        self.assertEqual(memory.get_capacity_used(), len(blocks) * 4096)
@@ -0,0 +1,418 @@
+from contextlib import contextmanager
+import fcntl
+import os
+import sys
+import tempfile
+import threading
+import zlib
+from multiprocessing import resource_tracker, shared_memory
+
+import allocation
+
+ALGORITHMS = ['first', 'best', 'next']
+MAGIC = 0x414c4c4f43534831  # ALLOCSH1
+
+# Layout of the shared memory segment, as int64 words unless noted:
+#     header: HEADER_WORDS words, indexed by the H_ constants below
+#     extents: max_extents pairs of (start, length) of free runs, the first num_extents of them in use, sorted by start
+#     slots: table_size quads of (state, hash, start, count) forming an open addressing hash table of files
+#     keys: table_size * KEY_BYTES bytes, the UTF-8 file_id of each slot, zero padded
+H_MAGIC, H_BLOCK, H_NUM_BLOCKS, H_ALGORITHM, H_MAX_EXTENTS, H_TABLE_SIZE, H_NUM_EXTENTS, H_FILES, H_TOMBSTONES, \
+    H_CAPACITY_USED, H_ROVER = range(11)
+HEADER_WORDS = 16
+SLOT_WORDS = 4
+KEY_BYTES = 64
+EMPTY, USED, DELETED = 0, 1, 2
+
+class SharedAllocation:
+    def __init__(self, name: str, capacity: int, block: int, capacity_unit: str = 'mb', block_unit: str = 'kb', allocation_algorithm: str = 'best', max_files: int = 65536) -> None:
+        '''
+        Creates a file manager whose whole state lives in a named multiprocessing.shared_memory segment, so that
+        several processes on one host can save and delete files on the same device directly. Other processes join it
+        with SharedAllocation.attach(name). The layout is fixed when it is created:
+            extents: array of free runs sorted by start block, with room for max_files + 1 of them, which is as many
+                     as max_files files can separate free space into
+            slots: hash table of file_id -> (start, count), with linear probing, sized to stay at most half full
+        Every call holds a lock: a flock on a lock file shared by all processes, plus a thread lock within each
+        process. Files are stored contiguously, and file_ids are at most KEY_BYTES bytes of UTF-8.
+
+        :param name: name of the shared memory segment, which must not already exist
+        :param capacity: Total capacity of memory
+        :param block: Size of block of memory
+        :param capacity_unit: Unit used for capacity. Must be one of B, KB, MB, GB, or TB. Defaults to MB.
+        :param block_unit: Unit used for block size. Must be one of B, KB, MB, GB, or TB. Defaults to KB.
+        :param allocation_algorithm: Algorithm used for allocation. One of 'best', 'first' or 'next'. Defaults to
+                                     best.
+        :param max_files: Most files that can be saved at once. Defaults to 65536.
+        '''
+        if allocation_algorithm not in ALGORITHMS:
+            raise ValueError('Incorrect algorithm, must be one of best, first or next')
+        if max_files <= 0:
+            raise ValueError('Maximum number of files must be greater than 0')
+        block = allocation.to_bytes(block, block_unit)
+        num_blocks = int(allocation.to_bytes(capacity, capacity_unit) / block)
+        max_extents = max_files + 1
+        table_size = 1 << (2 * max_files - 1).bit_length()
+
+        size = 8 * (HEADER_WORDS + 2 * max_extents + SLOT_WORDS * table_size) + KEY_BYTES * table_size
+        self._open(shared_memory.SharedMemory(name, create=True, size=size))
+        header = self._header
+        header[H_BLOCK] = block
+        header[H_NUM_BLOCKS] = num_blocks
+        header[H_ALGORITHM] = ALGORITHMS.index(allocation_algorithm)
+        header[H_MAX_EXTENTS] = max_extents
+        header[H_TABLE_SIZE] = table_size
+        self._map_arrays()
+        if num_blocks > 0:
+            self._extents[0] = 0
+            self._extents[1] = num_blocks
+            header[H_NUM_EXTENTS] = 1
+        # Written last, so a process attaching early sees an incomplete segment rather than a half initialized one
+        header[H_MAGIC] = MAGIC
+
+    @classmethod
+    def attach(cls, name: str) -> 'SharedAllocation':
+        '''
+        Joins a shared allocation created by another process
+
+        :param name: name the allocation was created with
+        '''
+        memory = cls.__new__(cls)
+        if sys.version_info >= (3, 13):
+            segment = shared_memory.SharedMemory(name, track=False)
+        else:
+            segment = shared_memory.SharedMemory(name)
+            # Only the creating process should remove the segment when it exits
+            resource_tracker.unregister(segment._name, 'shared_memory')
+        memory._open(segment)
+        if memory._header[H_MAGIC] != MAGIC:
+            memory.close()
+            raise ValueError('{} is not a shared allocation'.format(name))
+        memory._map_arrays()
+        return memory
+
+    def save(self, file_id: str, size: int, size_unit: str, as_list: bool = False) -> range:
+        '''
+        Takes file_id and saves it in a given location, returns range of blocks that is assigned to the file.
+
+        :param file_id: desired file_id as a string
+        :param size: size of given file
+        :param size_unit: unit used for file size. Must be one of B, KB, MB, or GB
+        :param as_list: return the blocks as a list rather than a range. Defaults to False.
+        :return: range of blocks that is assigned to the file given
+        '''
+        key = self._key(file_id)
+        if size <= 0:
+            raise ValueError('Size must be greater than 0')
+        size = allocation.to_bytes(size, size_unit)
+        header = self._header
+        count = -(-size // header[H_BLOCK])
+
+        with self._locked():
+            slot, found = self._find_slot(key)
+            if found:
+                raise ValueError('file_id already exists')
+            if size > (header[H_NUM_BLOCKS] * header[H_BLOCK]) - header[H_CAPACITY_USED]:
+                raise ValueError('Not enough capacity to store file')
+            if header[H_FILES] >= header[H_MAX_EXTENTS] - 1:
+                raise ValueError('File table is full')
+
+            start = self._allocate(count)
+            if start is None:
+                raise ValueError('No chunk large enough to be allocated for given size')
+            self._store_slot(slot, key, start, count)
+            header[H_CAPACITY_USED] += count * header[H_BLOCK]
+        location = range(start, start + count)
+        return list(location) if as_list else location
+
+    def read(self, file_id: str, as_list: bool = False) -> range:
+        '''
+        Return blocks allocated to file as a range. Uses the file table to look up location.
+
+        :param file_id: desired file_id as a string
+        :param as_list: return the blocks as a list rather than a range. Defaults to False.
+        :return: range of blocks allocated to the file
+        '''
+        key = self._key(file_id)
+        with self._locked():
+            slot, found = self._find_slot(key)
+            if not found:
+                raise ValueError('file_id does not exist')
+            start, count = self._slots[slot * SLOT_WORDS + 2], self._slots[slot * SLOT_WORDS + 3]
+        location = range(start, start + count)
+        return list(location) if as_list else location
+
+    def delete(self, file_id: str) -> None:
+        '''
+        Removes allocation for provided file_id, and returns its blocks to the pool to be re-allocated.
+
+        :param file_id: desired file_id as a string
+        '''
+        key = self._key(file_id)
+        header = self._header
+        with self._locked():
+            slot, found = self._find_slot(key)
+            if not found:
+                raise ValueError('file_id does not exist')
+            base = slot * SLOT_WORDS
+            start, count = self._slots[base + 2], self._slots[base + 3]
+            self._slots[base] = DELETED
+            header[H_FILES] -= 1
+            header[H_TOMBSTONES] += 1
+            self._free(start, count)
+            header[H_CAPACITY_USED] -= count * header[H_BLOCK]
+            if header[H_TOMBSTONES] > header[H_TABLE_SIZE] // 4:
+                self._rehash()
+
+    # Setters and Getters
+    def get_capacity(self) -> int:
+        '''
+        Capacity in bytes
+        '''
+        return self._header[H_NUM_BLOCKS] * self._header[H_BLOCK]
+
+    def get_capacity_used(self) -> int:
+        '''
+        Capacity used in bytes
+        '''
+        return self._header[H_CAPACITY_USED]
+
+    def get_capacity_remaining(self) -> int:
+        '''
+        Capacity remaining in bytes
+        '''
+        return self.get_capacity() - self.get_capacity_used()
+
+    def list_files(self) -> dict:
+        '''
+        List all files, as file_id -> range of blocks allocated to the file
+        '''
+        files = {}
+        with self._locked():
+            for slot in range(self._header[H_TABLE_SIZE]):
+                base = slot * SLOT_WORDS
+                if self._slots[base] == USED:
+                    start, count = self._slots[base + 2], self._slots[base + 3]
+                    files[self._slot_key(slot).decode()] = range(start, start + count)
+        return files
+
+    def stats(self) -> dict:
+        '''
+        Summary of how the device is being used, with the same keys as Allocation.stats. Sizes are in bytes.
+        '''
+        header = self._header
+        with self._locked():
+            lengths = [self._extents[2 * i + 1] for i in range(header[H_NUM_EXTENTS])]
+            return {
+                'capacity': self.get_capacity(),
+                'capacity_used': header[H_CAPACITY_USED],
+                'capacity_remaining': self.get_capacity_remaining(),
+                'files': header[H_FILES],
+                'free_extents': len(lengths),
+                'largest_free_extent': header[H_BLOCK] * max(lengths, default=0),
+                'internal_fragmentation': 0,
+                'pools': {},
+            }
+
+    def availability(self) -> str:
+        '''
+        Blocks that have not been allocated
+        '''
+        with self._locked():
+            extents = [(self._extents[2 * i], self._extents[2 * i + 1]) for i in range(self._header[H_NUM_EXTENTS])]
+        if extents:
+            return ' -> '.join(str(block) for start, length in extents for block in range(start, start + length))
+        return 'No available blocks'
+
+    def close(self) -> None:
+        '''
+        Detaches this process from the shared memory segment. The allocation carries on for other processes.
+        '''
+        for view in (self._keys, self._slots, self._extents, self._header):
+            if view is not None:
+                view.release()
+        self._keys = self._slots = self._extents = self._header = None
+        self._segment.close()
+        os.close(self._lock_fd)
+
+    def unlink(self) -> None:
+        '''
+        Removes the shared memory segment and lock file once every process has closed it
+        '''
+        self._segment.unlink()
+        try:
+            os.remove(self._lock_path(self._segment.name))
+        except FileNotFoundError:
+            pass
+
+    # Private support functions
+    def _open(self, segment: shared_memory.SharedMemory) -> None:
+        self._segment = segment
+        self._header = segment.buf[:8 * HEADER_WORDS].cast('q')
+        self._extents = self._slots = self._keys = None
+        self._lock_fd = os.open(self._lock_path(segment.name), os.O_RDWR | os.O_CREAT, 0o600)
+        self._thread_lock = threading.Lock()
+
+    def _map_arrays(self) -> None:
+        header = self._header
+        offset = 8 * HEADER_WORDS
+        end = offset + 16 * header[H_MAX_EXTENTS]
+        self._extents = self._segment.buf[offset:end].cast('q')
+        offset, end = end, end + 8 * SLOT_WORDS * header[H_TABLE_SIZE]
+        self._slots = self._segment.buf[offset:end].cast('q')
+        self._keys = self._segment.buf[end:end + KEY_BYTES * header[H_TABLE_SIZE]]
+
+    @contextmanager
+    def _locked(self):
+        '''
+        Holds the lock shared by every process, and the lock shared by every thread of this process
+        '''
+        with self._thread_lock:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _lock_path(self, name: str) -> str:
+        return os.path.join(tempfile.gettempdir(), '{}.allocation.lock'.format(name.lstrip('/')))
+
+    def _allocate(self, count: int):
+        '''
+        Takes count blocks from the free extent chosen by the allocation algorithm
+
+        :return: first block allocated, or None if no extent is large enough
+        '''
+        extents = self._extents
+        num_extents = self._header[H_NUM_EXTENTS]
+        algorithm = ALGORITHMS[self._header[H_ALGORITHM]]
+        chosen = None
+        if algorithm == 'best':
+            for i in range(num_extents):
+                length = extents[2 * i + 1]
+                if length >= count and (chosen is None or length < extents[2 * chosen + 1]):
+                    chosen = i
+                    if length == count:
+                        break
+        else:
+            # Next fit starts from the first extent ending after the rover and wraps around; first fit from the start
+            first = 0
+            if algorithm == 'next':
+                rover = self._header[H_ROVER]
+                first = self._bisect(rover)
+                if first > 0 and extents[2 * first - 2] + extents[2 * first - 1] > rover:
+                    first -= 1
+            for j in range(num_extents):
+                i = (first + j) % num_extents
+                if extents[2 * i + 1] >= count:
+                    chosen = i
+                    break
+        if chosen is None:
+            return None
+
+        start = extents[2 * chosen]
+        if extents[2 * chosen + 1] == count:
+            extents[2 * chosen:2 * num_extents - 2] = extents[2 * chosen + 2:2 * num_extents]
+            self._header[H_NUM_EXTENTS] = num_extents - 1
+        else:
+            extents[2 * chosen] = start + count
+            extents[2 * chosen + 1] -= count
+        self._header[H_ROVER] = start + count
+        return start
+
+    def _free(self, start: int, count: int) -> None:
+        '''
+        Returns a run of blocks to the extent array, merging it with adjacent free extents
+        '''
+        extents = self._extents
+        num_extents = self._header[H_NUM_EXTENTS]
+        i = self._bisect(start)
+        merge_prev = i > 0 and extents[2 * i - 2] + extents[2 * i - 1] == start
+        merge_next = i < num_extents and start + count == extents[2 * i]
+        if merge_prev and merge_next:
+            extents[2 * i - 1] += count + extents[2 * i + 1]
+            extents[2 * i:2 * num_extents - 2] = extents[2 * i + 2:2 * num_extents]
+            self._header[H_NUM_EXTENTS] = num_extents - 1
+        elif merge_prev:
+            extents[2 * i - 1] += count
+        elif merge_next:
+            extents[2 * i] = start
+            extents[2 * i + 1] += count
+        else:
+            extents[2 * i + 2:2 * num_extents + 2] = extents[2 * i:2 * num_extents]
+            extents[2 * i] = start
+            extents[2 * i + 1] = count
+            self._header[H_NUM_EXTENTS] = num_extents + 1
+
+    def _bisect(self, block: int) -> int:
+        '''
+        Position of the first free extent starting after block
+        '''
+        extents = self._extents
+        low, high = 0, self._header[H_NUM_EXTENTS]
+        while low < high:
+            mid = (low + high) // 2
+            if extents[2 * mid] <= block:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def _find_slot(self, key: bytes) -> tuple:
+        '''
+        Probes the file table for key
+
+        :return: (slot, found) tuple. If the key is not in the table, slot is where it should be inserted.
+        '''
+        slots = self._slots
+        mask = self._header[H_TABLE_SIZE] - 1
+        key_hash = zlib.crc32(key)
+        slot = key_hash & mask
+        insert_at = None
+        while True:
+            base = slot * SLOT_WORDS
+            state = slots[base]
+            if state == EMPTY:
+                return (slot if insert_at is None else insert_at), False
+            elif state == DELETED:
+                if insert_at is None:
+                    insert_at = slot
+            elif slots[base + 1] == key_hash and self._slot_key(slot) == key:
+                return slot, True
+            slot = (slot + 1) & mask
+
+    def _store_slot(self, slot: int, key: bytes, start: int, count: int) -> None:
+        base = slot * SLOT_WORDS
+        if self._slots[base] == DELETED:
+            self._header[H_TOMBSTONES] -= 1
+        self._keys[slot * KEY_BYTES:(slot + 1) * KEY_BYTES] = key.ljust(KEY_BYTES, b'\0')
+        self._slots[base + 1] = zlib.crc32(key)
+        self._slots[base + 2] = start
+        self._slots[base + 3] = count
+        self._slots[base] = USED
+        self._header[H_FILES] += 1
+
+    def _slot_key(self, slot: int) -> bytes:
+        return bytes(self._keys[slot * KEY_BYTES:(slot + 1) * KEY_BYTES]).rstrip(b'\0')
+
+    def _rehash(self) -> None:
+        '''
+        Reinserts every file to clear out deleted slots, which otherwise lengthen probes for missing keys
+        '''
+        files = []
+        for slot in range(self._header[H_TABLE_SIZE]):
+            base = slot * SLOT_WORDS
+            if self._slots[base] == USED:
+                files.append((self._slot_key(slot), self._slots[base + 2], self._slots[base + 3]))
+            self._slots[base] = EMPTY
+        self._header[H_FILES] = 0
+        self._header[H_TOMBSTONES] = 0
+        for key, start, count in files:
+            self._store_slot(self._find_slot(key)[0], key, start, count)
+
+    def _key(self, file_id: str) -> bytes:
+        key = file_id.encode()
+        if not key or len(key) > KEY_BYTES or b'\0' in key:
+            raise ValueError('file_id must be 1 to {} bytes of UTF-8 without null characters'.format(KEY_BYTES))
+        return key
+
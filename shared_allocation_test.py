@@ -0,0 +1,99 @@
+import multiprocessing
+import os
+import random
+import unittest
+import shared_allocation
+
+def work(name, worker):
+    memory = shared_allocation.SharedAllocation.attach(name)
+    rng = random.Random(worker)
+    live = []
+    for i in range(300):
+        file_id = '{}-{}'.format(worker, i)
+        try:
+            live.append((file_id, memory.save(file_id, rng.randint(1, 32), 'kb')))
+        except ValueError:
+            pass
+        if live and rng.random() < 0.4:
+            file_id, location = live.pop(rng.randrange(len(live)))
+            assert memory.read(file_id) == location
+            memory.delete(file_id)
+    memory.close()
+
+class TestSharedAllocation(unittest.TestCase):
+    def setUp(self):
+        self.name = 'allocation-test-{}'.format(os.getpid())
+        self.memory = shared_allocation.SharedAllocation(self.name, 1, 128, 'mb', 'kb', 'first', max_files=4)
+        self.addCleanup(self.memory.unlink)
+        self.addCleanup(self.memory.close)
+
+    def test_save_read_delete(self):
+        self.assertEqual(self.memory.save('a', 256, 'kb'), range(0, 2))
+        self.assertEqual(self.memory.save('b', 128, 'kb', as_list=True), [2])
+        self.assertEqual(self.memory.read('a'), range(0, 2))
+        self.memory.delete('a')
+        with self.assertRaises(ValueError):
+            self.memory.read('a')
+        self.assertEqual(self.memory.availability(), '0 -> 1 -> 3 -> 4 -> 5 -> 6 -> 7')
+        self.assertEqual(self.memory.save('c', 128, 'kb'), range(0, 1))
+
+    def test_errors(self):
+        self.memory.save('a', 128, 'kb')
+        with self.assertRaises(ValueError):
+            self.memory.save('a', 128, 'kb')
+        with self.assertRaises(ValueError):
+            self.memory.save('b', 2, 'mb')
+        with self.assertRaises(ValueError):
+            self.memory.save('b', 0, 'kb')
+        with self.assertRaises(ValueError):
+            self.memory.save('x' * 65, 128, 'kb')
+        with self.assertRaises(ValueError):
+            self.memory.delete('b')
+
+    def test_file_table_full(self):
+        for c in 'abcd':
+            self.memory.save(c, 128, 'kb')
+        with self.assertRaises(ValueError):
+            self.memory.save('e', 128, 'kb')
+        self.memory.delete('b')
+        self.assertEqual(self.memory.save('e', 128, 'kb'), range(1, 2))
+
+    def test_deleted_slots_reused(self):
+        for i in range(100):
+            self.memory.save(str(i), 128, 'kb')
+            self.memory.delete(str(i))
+        self.memory.save('a', 128, 'kb')
+        self.assertEqual(self.memory.list_files(), {'a': range(0, 1)})
+        self.assertEqual(self.memory.stats()['files'], 1)
+
+    def test_attach(self):
+        other = shared_allocation.SharedAllocation.attach(self.name)
+        self.memory.save('a', 256, 'kb')
+        self.assertEqual(other.read('a'), range(0, 2))
+        other.save('b', 128, 'kb')
+        self.assertEqual(self.memory.list_files(), {'a': range(0, 2), 'b': range(2, 3)})
+        self.assertEqual(other.get_capacity_used(), 384 * 1024)
+        other.close()
+
+    def test_attach_missing(self):
+        with self.assertRaises(FileNotFoundError):
+            shared_allocation.SharedAllocation.attach(self.name + '-missing')
+
+    def test_processes(self):
+        name = self.name + '-processes'
+        memory = shared_allocation.SharedAllocation(name, 4, 4, 'mb', 'kb', 'best', max_files=4096)
+        self.addCleanup(memory.unlink)
+        self.addCleanup(memory.close)
+        context = multiprocessing.get_context('spawn')
+        workers = [context.Process(target=work, args=(name, worker)) for worker in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual([worker.exitcode for worker in workers], [0, 0, 0, 0])
+
+        blocks = [block for location in memory.list_files().values() for block in location]
+        self.assertEqual(len(blocks), len(set(blocks)))
+        free = memory.availability().split(' -> ')
+        self.assertEqual(len(blocks) + len(free), 1024)
+        self.assertEqual(memory.get_capacity_used(), len(blocks) * 4096)
@@ -0,0 +1,75 @@
+import argparse
+import multiprocessing
+import os
+import time
+
+import benchmark
+from support import traces
+
+def simulate(trace_name: str, configurations: list, ops: int, capacity: int, seed: int = 0, samples: int = 20,
+             workers: int = None) -> list:
+    '''
+    Replays one trace against several configurations at once, one configuration per worker process. Each worker
+    builds the trace itself, from its name and seed or by reading the recorded trace, rather than being sent it. Sizes
+    in synthetic traces are whole numbers of the smallest block size, so every configuration sees the same trace.
+
+    :param trace_name: synthetic trace name, see support/traces.py, or path to a recorded trace
+    :param configurations: list of (engine name, block size in bytes) tuples, engine names being keys of
+                           benchmark.ENGINES
+    :param ops: number of operations in a synthetic trace
+    :param capacity: capacity of the device in bytes
+    :param seed: seed for a synthetic trace
+    :param samples: number of times to sample fragmentation over the course of each run
+    :param workers: number of processes. Defaults to one per CPU, or one per configuration if there are fewer.
+    :return: list of results from benchmark.replay, in the order of configurations, each with the engine, block,
+             final_fragmentation and peak_fragmentation added
+    '''
+    trace_block = min(block for engine, block in configurations)
+    jobs = [(trace_name, ops, capacity, trace_block, seed, engine, block, samples) for engine, block in configurations]
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    # A fresh process per run, so peak RSS belongs to that run alone
+    with multiprocessing.get_context('spawn').Pool(workers, maxtasksperchild=1) as pool:
+        return pool.map(_simulate_job, jobs, chunksize=1)
+
+def _simulate_job(job: tuple) -> dict:
+    trace_name, ops, capacity, trace_block, seed, engine, block, samples = job
+    trace = benchmark.build_trace(trace_name, ops, capacity, trace_block, seed)
+    result = benchmark.replay(trace, capacity, block, benchmark.ENGINES[engine], samples)
+    result['engine'] = engine
+    result['block'] = block
+    return benchmark.summarize_fragmentation(result)
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description='Compare allocation engines and block sizes on one trace in parallel')
+    parser.add_argument('trace', nargs='?', default='uniform',
+                        help='synthetic trace name ({}) or path to a recorded trace'.format(
+                            ', '.join(traces.SYNTHETIC)))
+    parser.add_argument('--engines', nargs='+', default=list(benchmark.ENGINES), choices=list(benchmark.ENGINES))
+    parser.add_argument('--blocks', nargs='+', type=benchmark.parse_size, default=[benchmark.parse_size('4kb')],
+                        help='block sizes to try with every engine')
+    parser.add_argument('--ops', type=int, default=1000000, help='operations in a synthetic trace')
+    parser.add_argument('--capacity', type=benchmark.parse_size, default=benchmark.parse_size('1gb'))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--samples', type=int, default=20, help='fragmentation samples per run')
+    parser.add_argument('--workers', type=int, default=None, help='processes to use, defaults to one per CPU')
+    args = parser.parse_args(argv)
+
+    began = time.perf_counter()
+    configurations = [(engine, block) for engine in args.engines for block in args.blocks]
+    results = simulate(args.trace, configurations, args.ops, args.capacity, args.seed, args.samples, args.workers)
+
+    print(benchmark.format_table(results, [
+        ('engine', 'engine', '{}'),
+        ('block', 'block', '{}'),
+        ('ops', 'ops', '{}'),
+        ('failed saves', 'failed_saves', '{}'),
+        ('frag end', 'final_fragmentation', '{:.3f}'),
+        ('frag peak', 'peak_fragmentation', '{:.3f}'),
+        ('largest free', 'largest_free_extent', '{}'),
+        ('ops/sec', 'ops_per_sec', '{:.0f}'),
+        ('p99 us', 'p99_us', '{:.1f}'),
+    ]))
+    print('{} runs in {:.1f}s'.format(len(results), time.perf_counter() - began))
+
+if __name__ == '__main__':
+    main()
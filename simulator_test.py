@@ -0,0 +1,18 @@
+import unittest
+import simulator
+
+class TestSimulator(unittest.TestCase):
+    def test_simulate(self):
+        configurations = [('first', 1024), ('best', 1024), ('best', 4096)]
+        results = simulator.simulate('uniform', configurations, 500, 256 * 1024, workers=2, samples=5)
+        self.assertEqual([(result['engine'], result['block']) for result in results], configurations)
+        self.assertTrue(all(result['ops'] == 500 for result in results))
+        for result in results:
+            self.assertLessEqual(result['final_fragmentation'], result['peak_fragmentation'])
+            self.assertGreater(result['largest_free_extent'], 0)
+
+    def test_runs_are_deterministic(self):
+        configurations = [('first', 1024), ('first', 1024)]
+        first, second = simulator.simulate('zipf', configurations, 300, 256 * 1024, seed=3, samples=2)
+        self.assertEqual(first['failed_saves'], second['failed_saves'])
+        self.assertEqual(first['fragmentation'], second['fragmentation'])
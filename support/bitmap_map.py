@@ -0,0 +1,193 @@
+# Free space map backed by a NumPy bitmap, one byte per block
+import numpy as np
+
+class BitmapMap:
+    def __init__(self, num_blocks: int):
+        '''
+        Creates a bitmap covering blocks 0 to num_blocks - 1, all of which start out unallocated. Each block is one
+        byte, set when the block is free. Runs of free blocks are found with vectorized scans over the bitmap rather
+        than by walking nodes. visited is the number of runs examined by the most recent search, for instrumentation.
+
+        :param num_blocks: Number of blocks on the device
+        '''
+        self._bits = np.ones(max(num_blocks, 0), dtype=np.bool_)
+        self.free_blocks = max(num_blocks, 0)
+        self._rover = 0
+        self.visited = 0
+
+    def __iter__(self):
+        '''
+        Iterates over free extents in ascending address order as (start, length) tuples
+        '''
+        starts, lengths = self._runs()
+        return zip(starts.tolist(), lengths.tolist())
+
+    def __len__(self) -> int:
+        '''
+        Number of free extents
+        '''
+        return len(self._runs()[0])
+
+    def largest(self) -> int:
+        '''
+        Length of the largest free extent, or 0 if the map is empty
+        '''
+        lengths = self._runs()[1]
+        return int(lengths.max()) if len(lengths) else 0
+
+    def largest_extent(self):
+        '''
+        The largest free run, preferring the lowest address on ties
+
+        :return: (start, length) tuple, or None if the map is empty
+        '''
+        starts, lengths = self._runs()
+        if not len(lengths):
+            return None
+        largest = np.argmax(lengths)
+        return int(starts[largest]), int(lengths[largest])
+
+    def first_fit(self, count: int, floor: int = 0):
+        '''
+        Allocates count blocks from the lowest addressed run that is large enough.
+
+        :param count: number of blocks needed
+        :param floor: block to start searching from, for callers that know no run below it is large enough. Defaults
+                      to 0.
+        :return: first block allocated, or None if no run is large enough
+        '''
+        starts, lengths = self._runs(floor)
+        self.visited = len(starts)
+        candidates = np.flatnonzero(lengths >= count)
+        if not len(candidates):
+            return None
+        return self._take(int(starts[candidates[0]]) + floor, count)
+
+    def next_fit(self, count: int):
+        '''
+        Allocates count blocks from the first run large enough that ends after the rover, wrapping around to the
+        start of the map if needed, then moves the rover to the end of the allocation.
+
+        :param count: number of blocks needed
+        :return: first block allocated, or None if no run is large enough
+        '''
+        starts, lengths = self._runs()
+        self.visited = len(starts)
+        candidates = np.flatnonzero(lengths >= count)
+        if not len(candidates):
+            return None
+        after = candidates[starts[candidates] + lengths[candidates] > self._rover]
+        chosen = after[0] if len(after) else candidates[0]
+        first_block = self._take(int(starts[chosen]), count)
+        self._rover = first_block + count
+        return first_block
+
+    def best_fit(self, count: int):
+        '''
+        Allocates count blocks from the smallest run that is large enough, preferring the lowest address on ties.
+
+        :param count: number of blocks needed
+        :return: first block allocated, or None if no run is large enough
+        '''
+        starts, lengths = self._runs()
+        self.visited = len(starts)
+        candidates = np.flatnonzero(lengths >= count)
+        if not len(candidates):
+            return None
+        # argmin returns the first minimum, and runs are in address order, so ties go to the lowest address
+        best = candidates[np.argmin(lengths[candidates])]
+        return self._take(int(starts[best]), count)
+
+    def near_fit(self, count: int, block: int, window: int = 16):
+        '''
+        Allocates count blocks as close to block as possible, from the nearest run large enough among the window runs
+        on either side of it, as FreeMap.near_fit does
+
+        :param count: number of blocks needed
+        :param block: block to allocate near
+        :param window: most runs examined on each side of block. Defaults to 16.
+        :return: first block allocated, or None if no run in the window is large enough
+        '''
+        starts, lengths = self._runs()
+        i = int(np.searchsorted(starts, block, side='right')) - 1
+        starts = starts[max(i - window + 1, 0):i + 1 + window]
+        lengths = lengths[max(i - window + 1, 0):i + 1 + window]
+        self.visited = len(starts)
+        candidates = np.flatnonzero(lengths >= count)
+        if not len(candidates):
+            return None
+        starts, lengths = starts[candidates], lengths[candidates]
+        firsts = np.clip(block, starts, starts + lengths - count)
+        distances = np.maximum(np.maximum(firsts - block, block - firsts - count), 0)
+        # lexsort sorts by its last key first, so this is by distance then address
+        nearest = np.lexsort((firsts, distances))[0]
+        return self._take(int(firsts[nearest]), count)
+
+    def take(self, start: int, count: int) -> None:
+        '''
+        Allocates the specific run of count blocks at start
+
+        :param start: first block of the run
+        :param count: number of blocks in the run
+        '''
+        if start < 0 or start + count > len(self._bits) or not self._bits[start:start + count].all():
+            raise ValueError('Blocks {} to {} are not free'.format(start, start + count - 1))
+        self._take(start, count)
+
+    def free(self, start: int, count: int) -> None:
+        '''
+        Returns a run of blocks to the map. Adjacent free runs merge implicitly.
+
+        :param start: first block of the run
+        :param count: number of blocks in the run
+        '''
+        self._bits[start:start + count] = True
+        self.free_blocks += count
+
+    def free_many(self, extents: list) -> None:
+        '''
+        Returns many runs of blocks to the map at once
+
+        :param extents: list of (start, count) tuples of runs to be freed, in any order
+        '''
+        for start, count in extents:
+            self.free(start, count)
+
+    def load(self, extents: list) -> None:
+        '''
+        Replaces the contents of the map with the given extents
+
+        :param extents: list of (start, length) tuples of free runs, none overlapping
+        '''
+        self._bits[:] = False
+        for start, length in extents:
+            self._bits[start:start + length] = True
+        self.free_blocks = int(np.count_nonzero(self._bits))
+
+    def copy(self) -> 'BitmapMap':
+        '''
+        Independent copy of the map
+        '''
+        other = BitmapMap(0)
+        other._bits = self._bits.copy()
+        other.free_blocks = self.free_blocks
+        other._rover = self._rover
+        return other
+
+    def _take(self, start: int, count: int) -> int:
+        self._bits[start:start + count] = False
+        self.free_blocks -= count
+        return start
+
+    def _runs(self, floor: int = 0):
+        '''
+        Finds every run of free blocks by differencing the bitmap padded with an allocated block at each end
+
+        :param floor: block to start from. Run starts are relative to it, and a run containing it is cut short there.
+        :return: arrays of run starts and run lengths, in ascending address order
+        '''
+        padded = np.concatenate(([0], self._bits[floor:].view(np.int8), [0]))
+        edges = np.diff(padded)
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+        return starts, ends - starts
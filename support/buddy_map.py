@@ -0,0 +1,163 @@
+# Free space map for buddy allocation, keeping one free list per power-of-two block size
+from bisect import bisect_left, insort
+
+class BuddyMap:
+    def __init__(self, num_blocks: int):
+        '''
+        Creates a buddy map covering blocks 0 to num_blocks - 1, all of which start out unallocated. Free space is
+        held as aligned power-of-two runs; a device whose size is not a power of two starts out as the largest such
+        runs that tile it, so construction is O(log num_blocks).
+
+        free: list indexed by order, each a sorted list of start blocks of free runs of 2**order blocks
+        visited: number of free lists examined by the most recent allocation, for instrumentation
+
+        :param num_blocks: Number of blocks on the device
+        '''
+        num_blocks = max(num_blocks, 0)
+        self.free_blocks = num_blocks
+        self.visited = 0
+        self._free = [[] for i in range(max(num_blocks.bit_length(), 1))]
+
+        start = 0
+        for order in reversed(range(num_blocks.bit_length())):
+            if num_blocks & (1 << order):
+                self._free[order].append(start)
+                start += 1 << order
+
+    def __iter__(self):
+        '''
+        Iterates over free runs in ascending address order as (start, length) tuples. Free buddies are always merged,
+        but neighbouring runs that are not buddies are reported separately.
+        '''
+        runs = [(start, 1 << order) for order, starts in enumerate(self._free) for start in starts]
+        return iter(sorted(runs))
+
+    def __len__(self) -> int:
+        '''
+        Number of free runs
+        '''
+        return sum(len(starts) for starts in self._free)
+
+    def largest(self) -> int:
+        '''
+        Length of the largest free run, or 0 if the map is empty
+        '''
+        for order in reversed(range(len(self._free))):
+            if self._free[order]:
+                return 1 << order
+        return 0
+
+    def reserved(self, count: int) -> int:
+        '''
+        Number of blocks actually reserved to hold count blocks, i.e. count rounded up to a power of two
+        '''
+        return 1 << self._order(count)
+
+    def allocate(self, count: int):
+        '''
+        Allocates the lowest addressed run from the smallest non-empty free list that fits count blocks, splitting it
+        in half until it is the size needed. The upper halves are returned to the free lists.
+
+        :param count: number of blocks needed
+        :return: first block allocated, or None if no run is large enough
+        '''
+        order = self._order(count)
+        self.visited = 0
+        for found in range(order, len(self._free)):
+            self.visited += 1
+            if self._free[found]:
+                break
+        else:
+            return None
+
+        start = self._free[found].pop(0)
+        while found > order:
+            found -= 1
+            insort(self._free[found], start + (1 << found))
+
+        self.free_blocks -= 1 << order
+        return start
+
+    def take(self, start: int, count: int) -> None:
+        '''
+        Allocates the specific run reserved for count blocks at start, splitting the free run it lies in down to size.
+        The halves not containing start are returned to the free lists.
+
+        :param start: first block of the run, aligned to the reserved size
+        :param count: number of blocks requested
+        '''
+        order = self._order(count)
+        for found in range(order, len(self._free)):
+            run = start & ~((1 << found) - 1)
+            starts = self._free[found]
+            i = bisect_left(starts, run)
+            if i < len(starts) and starts[i] == run and not start & ((1 << order) - 1):
+                break
+        else:
+            raise ValueError('Blocks {} to {} are not free'.format(start, start + (1 << order) - 1))
+
+        del starts[i]
+        while found > order:
+            found -= 1
+            half = 1 << found
+            insort(self._free[found], run + half if start < run + half else run)
+            if start >= run + half:
+                run += half
+        self.free_blocks -= 1 << order
+
+    def free(self, start: int, count: int) -> None:
+        '''
+        Returns the run reserved for count blocks at start to the free lists, merging it with its buddy for as long
+        as the buddy is also free.
+
+        :param start: first block of the run
+        :param count: number of blocks requested when the run was allocated
+        '''
+        order = self._order(count)
+        self.free_blocks += 1 << order
+        while order + 1 < len(self._free):
+            buddy = start ^ (1 << order)
+            starts = self._free[order]
+            i = bisect_left(starts, buddy)
+            if i == len(starts) or starts[i] != buddy:
+                break
+            del starts[i]
+            start = min(start, buddy)
+            order += 1
+        insort(self._free[order], start)
+
+    def free_many(self, extents: list) -> None:
+        '''
+        Returns many runs to the free lists at once
+
+        :param extents: list of (start, count) tuples, count being the number of blocks requested at allocation
+        '''
+        for start, count in extents:
+            self.free(start, count)
+
+    def load(self, extents: list) -> None:
+        '''
+        Replaces the contents of the free lists with the given runs
+
+        :param extents: list of (start, length) tuples of free runs as reported by iterating over a map, each an
+                        aligned power-of-two run
+        '''
+        for starts in self._free:
+            starts.clear()
+        for start, length in extents:
+            self._free[self._order(length)].append(start)
+        for starts in self._free:
+            starts.sort()
+        self.free_blocks = sum(length for start, length in extents)
+
+    def copy(self) -> 'BuddyMap':
+        '''
+        Independent copy of the map
+        '''
+        other = BuddyMap(0)
+        other._free = [list(starts) for starts in self._free]
+        other.free_blocks = self.free_blocks
+        return other
+
+    def _order(self, count: int) -> int:
+        return max(count - 1, 0).bit_length()
@@ -0,0 +1,156 @@
+# Copy-on-write views of allocator state, letting forks share structure with the allocator they came from
+from collections.abc import MutableMapping
+
+# Free map methods that change the map
+MUTATORS = ('allocate', 'first_fit', 'next_fit', 'best_fit', 'near_fit', 'take', 'free', 'free_many', 'load')
+
+# Forks of forks stacked deeper than this are flattened, so lookups stay cheap
+MAX_DEPTH = 8
+
+class CopyOnWriteMap:
+    def __init__(self, free_map):
+        '''
+        Wraps a free map that may be shared with forks. Reads go to the shared map; the first change copies it, unless
+        every other holder has let go of it, and from then on the copy is used directly.
+            free_map: the map, shared or owned
+            holders: one item list counting the wrappers sharing free_map, itself shared between them
+            owned: whether free_map belongs to this wrapper alone
+
+        :param free_map: a FreeMap, BitmapMap or BuddyMap, owned by this wrapper
+        '''
+        self._free_map = free_map
+        self._holders = [1]
+        self._owned = True
+        self._bind()
+
+    def fork(self) -> 'CopyOnWriteMap':
+        '''
+        Another wrapper sharing this one's map, in O(1) time. A map this wrapper owns becomes shared again.
+        '''
+        if self._owned:
+            self._owned = False
+            self._holders = [1]
+            for name in MUTATORS:
+                self.__dict__.pop(name, None)
+        other = CopyOnWriteMap.__new__(CopyOnWriteMap)
+        other._free_map = self._free_map
+        other._holders = self._holders
+        other._owned = False
+        self._holders[0] += 1
+        return other
+
+    def __getattr__(self, name: str):
+        # Only reached for names not set on the wrapper, i.e. mutators while shared and attributes of the map
+        if name in MUTATORS:
+            self._own()
+            return self.__dict__[name]
+        if '_free_map' not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.__dict__['_free_map'], name)
+
+    def __iter__(self):
+        return iter(self._free_map)
+
+    def __len__(self) -> int:
+        return len(self._free_map)
+
+    def __del__(self):
+        if not self.__dict__.get('_owned', True):
+            self._holders[0] -= 1
+
+    def _own(self) -> None:
+        '''
+        Takes sole ownership of the map, copying it if any other wrapper still shares it
+        '''
+        if self._holders[0] > 1:
+            self._holders[0] -= 1
+            self._free_map = self._free_map.copy()
+            self._holders = [1]
+        self._owned = True
+        self._bind()
+
+    def _bind(self) -> None:
+        '''
+        Sets the owned map's mutators on the wrapper, so calling them costs no more than calling the map directly
+        '''
+        for name in MUTATORS:
+            if hasattr(self._free_map, name):
+                self.__dict__[name] = getattr(self._free_map, name)
+
+class ForkedFileTable(MutableMapping):
+    def __init__(self, base):
+        '''
+        A file_id -> extents mapping layered on a base mapping that is never written to, which several tables may
+        share. Changes are kept in memory on top of it.
+            base: the shared mapping
+            changes: hashmap (dict) of file_id -> extents saved or moved, or None if deleted, since the fork
+            depth: number of forked tables stacked below this one, including itself
+        '''
+        self._base = base
+        self._changes = {}
+        self._len = len(base)
+        self.depth = base.depth + 1 if isinstance(base, ForkedFileTable) else 1
+
+    @staticmethod
+    def fork(table) -> tuple:
+        '''
+        Freezes a file table so it can be shared, in O(1) time unless it has to be flattened
+
+        :param table: the mapping to fork, which must not be written to afterwards
+        :return: tuple of two new tables layered on it
+        '''
+        if isinstance(table, ForkedFileTable) and not table._changes:
+            table = table._base
+        elif isinstance(table, ForkedFileTable) and table.depth >= MAX_DEPTH:
+            table = dict(table.items())
+        return ForkedFileTable(table), ForkedFileTable(table)
+
+    def __getitem__(self, file_id: str) -> tuple:
+        extents = self._changes.get(file_id, False)
+        if extents is False:
+            return self._base[file_id]
+        elif extents is None:
+            raise KeyError(file_id)
+        return extents
+
+    def __setitem__(self, file_id: str, extents: tuple) -> None:
+        if file_id not in self:
+            self._len += 1
+        self._changes[file_id] = extents
+
+    def __delitem__(self, file_id: str) -> None:
+        if file_id not in self:
+            raise KeyError(file_id)
+        self._len -= 1
+        if file_id in self._base:
+            self._changes[file_id] = None
+        else:
+            del self._changes[file_id]
+
+    def __contains__(self, file_id) -> bool:
+        extents = self._changes.get(file_id, False)
+        return file_id in self._base if extents is False else extents is not None
+
+    def __iter__(self):
+        for file_id, extents in self.items():
+            yield file_id
+
+    def __len__(self) -> int:
+        return self._len
+
+    def get(self, file_id: str, default=None):
+        extents = self._changes.get(file_id, False)
+        if extents is False:
+            return self._base.get(file_id, default)
+        return default if extents is None else extents
+
+    def items(self):
+        '''
+        Iterates over (file_id, extents) tuples, those of the base first
+        '''
+        for file_id, extents in self._base.items():
+            if file_id not in self._changes:
+                yield file_id, extents
+        for file_id, extents in self._changes.items():
+            if extents is not None:
+                yield file_id, extents
@@ -0,0 +1,600 @@
+# Free space map that tracks runs of unallocated blocks as (start, length) extents
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+import heapq
+
+class Extent:
+    def __init__(self, start=None, length=0, prev=None, next=None):
+        self.start = start
+        self.length = length
+        self.prev = prev
+        self.next = next
+
+class FreeMap:
+    def __init__(self, num_blocks: int):
+        '''
+        Creates a free map covering blocks 0 to num_blocks - 1, all of which start out unallocated. An empty device is
+        a single extent, so construction does not depend on the number of blocks.
+
+        Extents are kept in a doubly linked list in ascending address order, alongside three indexes:
+            extents: hashmap (dict) of start block -> extent node
+            starts: sorted list of extent start blocks used to find the neighbours of a freed run by bisection
+            by_size: sorted list of (length, start) tuples used to find the smallest sufficient extent by bisection
+            rover: block after the end of the last next fit allocation, where the next search resumes. It is kept as an
+                   address rather than a node, so it stays valid however extents are split or merged in the meantime
+
+        visited is the number of extents examined by the most recent search, for instrumentation.
+
+        :param num_blocks: Number of blocks on the device
+        '''
+        self.next = None
+        self.free_blocks = 0
+        self._extents = {}
+        self._starts = []
+        self._by_size = []
+        self._rover = 0
+        self.visited = 0
+        if num_blocks > 0:
+            self._link(self, Extent(0, num_blocks))
+            self.free_blocks = num_blocks
+
+    def __iter__(self):
+        '''
+        Iterates over free extents in ascending address order as (start, length) tuples
+        '''
+        curr = self.next
+        while curr:
+            yield curr.start, curr.length
+            curr = curr.next
+
+    def __len__(self) -> int:
+        '''
+        Number of free extents
+        '''
+        return len(self._by_size)
+
+    def largest(self) -> int:
+        '''
+        Length of the largest free extent, or 0 if the map is empty
+        '''
+        return self._by_size[-1][0] if self._by_size else 0
+
+    def largest_extent(self):
+        '''
+        The largest free extent, preferring the lowest address on ties
+
+        :return: (start, length) tuple, or None if the map is empty
+        '''
+        if not self._by_size:
+            return None
+        length, start = self._by_size[bisect_left(self._by_size, (self._by_size[-1][0], -1))]
+        return start, length
+
+    def first_fit(self, count: int, floor: int = 0):
+        '''
+        Allocates count blocks from the lowest addressed extent that is large enough.
+
+        :param count: number of blocks needed
+        :param floor: block to start searching from. Only useful when the caller knows no extent below it is large
+                      enough, e.g. because an earlier search for as many or fewer blocks got that far and nothing has
+                      been freed since. Defaults to 0.
+        :return: first block allocated, or None if no extent is large enough
+        '''
+        self.visited = 0
+        if count > self.largest():
+            return None
+        curr = self._extent_from(floor) if floor else self.next
+        while curr:
+            self.visited += 1
+            if curr.length >= count:
+                return self._take_front(curr, count)
+            curr = curr.next
+        return None
+
+    def next_fit(self, count: int):
+        '''
+        Allocates count blocks from the first extent large enough at or after the rover, wrapping around to the start
+        of the map if needed, then moves the rover to the end of the allocation.
+
+        :param count: number of blocks needed
+        :return: first block allocated, or None if no extent is large enough
+        '''
+        self.visited = 0
+        if count > self.largest():
+            return None
+
+        resume = self._extent_from(self._rover)
+        curr = resume
+        while curr:
+            self.visited += 1
+            if curr.length >= count:
+                break
+            curr = curr.next
+        else:
+            curr = self.next
+            while curr is not resume:
+                self.visited += 1
+                if curr.length >= count:
+                    break
+                curr = curr.next
+
+        first_block = self._take_front(curr, count)
+        self._rover = first_block + count
+        return first_block
+
+    def best_fit(self, count: int):
+        '''
+        Allocates count blocks from the smallest extent that is large enough, preferring the lowest address on ties.
+        The size index is ordered by (length, start), so the first entry at or after (count, -1) is exactly that
+        extent.
+
+        :param count: number of blocks needed
+        :return: first block allocated, or None if no extent is large enough
+        '''
+        i = bisect_left(self._by_size, (count, -1))
+        self.visited = 1
+        if i == len(self._by_size):
+            return None
+        return self._take_front(self._extents[self._by_size[i][1]], count)
+
+    def near_fit(self, count: int, block: int, window: int = 16):
+        '''
+        Allocates count blocks as close to block as possible, from the nearest extent large enough among the window
+        extents on either side of it. The extents are found by bisecting the address index and walking outwards, so
+        this does not depend on how many extents there are.
+
+        :param count: number of blocks needed
+        :param block: block to allocate near
+        :param window: most extents examined on each side of block. Defaults to 16.
+        :return: first block allocated, or None if no extent in the window is large enough
+        '''
+        found, self.visited = _nearest(self._extents_before(block), self._extents_after(block), count, block, window)
+        if found is None:
+            return None
+        self.take(found[1], count)
+        return found[1]
+
+    def take(self, start: int, count: int) -> None:
+        '''
+        Allocates the specific run of count blocks at start, splitting the extent it lies in as needed.
+
+        :param start: first block of the run
+        :param count: number of blocks in the run
+        '''
+        extent = self._extent_from(start)
+        if not extent or extent.start > start or extent.start + extent.length < start + count:
+            raise ValueError('Blocks {} to {} are not free'.format(start, start + count - 1))
+        if extent.start < start:
+            # Keep the part before the run as its own extent, and carry on with the part from start
+            after = Extent(start, extent.start + extent.length - start)
+            self._unindex(extent)
+            extent.length = start - extent.start
+            self._index(extent)
+            self._link(extent, after)
+            extent = after
+        self._take_front(extent, count)
+
+    def free(self, start: int, count: int) -> None:
+        '''
+        Returns a run of blocks to the map, merging it with any adjacent free extents. Neighbours are located by
+        bisecting the address index, so this does not depend on how many extents precede the run.
+
+        :param start: first block of the run
+        :param count: number of blocks in the run
+        '''
+        i = bisect_left(self._starts, start)
+        prev = self._extents[self._starts[i - 1]] if i > 0 else None
+        curr = self._extents[self._starts[i]] if i < len(self._starts) else None
+
+        if prev and prev.start + prev.length == start:
+            self._unindex(prev)
+            prev.length += count
+            node = prev
+        else:
+            node = Extent(start, count)
+            self._link(prev if prev else self, node, index=False)
+
+        if curr and node.start + node.length == curr.start:
+            self._unlink(curr)
+            node.length += curr.length
+
+        self._index(node)
+        self.free_blocks += count
+
+    def free_many(self, extents: list) -> None:
+        '''
+        Returns many runs of blocks to the map at once. The runs are sorted and merged with each other first, then
+        with the map in a single sweep that rebuilds the indexes, unless there are few enough of them that freeing
+        each one separately is cheaper.
+
+        :param extents: list of (start, count) tuples of runs to be freed, in any order
+        '''
+        runs = []
+        for start, count in sorted(extents):
+            if runs and runs[-1][0] + runs[-1][1] == start:
+                runs[-1][1] += count
+            else:
+                runs.append([start, count])
+
+        if len(runs) * 8 < len(self._starts):
+            for start, count in runs:
+                self.free(start, count)
+            return
+
+        merged = []
+        existing = iter(self)
+        current = next(existing, None)
+        for start, count in runs:
+            while current and current[0] < start:
+                merged.append(current)
+                current = next(existing, None)
+            merged.append((start, count))
+        while current:
+            merged.append(current)
+            current = next(existing, None)
+        self.load(merged)
+
+    def load(self, extents: list) -> None:
+        '''
+        Replaces the contents of the map with the given extents, merging any that are adjacent. Used to rebuild the
+        indexes in a single sweep, and to restore a saved map.
+
+        :param extents: list of (start, length) tuples of free runs in ascending address order, none overlapping
+        '''
+        self.next = None
+        self._extents = {}
+        self._starts = []
+        prev = self
+        for start, length in extents:
+            if prev is not self and prev.start + prev.length == start:
+                prev.length += length
+                continue
+            node = Extent(start, length, prev if prev is not self else None)
+            prev.next = node
+            self._extents[start] = node
+            self._starts.append(start)
+            prev = node
+        self._by_size = sorted((node.length, start) for start, node in self._extents.items())
+        self.free_blocks = sum(node.length for node in self._extents.values())
+
+    def copy(self) -> 'FreeMap':
+        '''
+        Independent copy of the map, built in a single sweep over its extents
+        '''
+        other = FreeMap(0)
+        other.load(list(self))
+        other._rover = self._rover
+        return other
+
+    def _extents_before(self, block: int, hidden: set = ()):
+        '''
+        Iterates over extents starting at or before block as (start, length) tuples, nearest first, passing over those
+        whose start is in hidden
+        '''
+        i = bisect_right(self._starts, block) - 1
+        curr = self._extents[self._starts[i]] if i >= 0 else None
+        while curr:
+            if curr.start not in hidden:
+                yield curr.start, curr.length
+            curr = curr.prev
+
+    def _extents_after(self, block: int, hidden: set = ()):
+        '''
+        Iterates over extents starting after block as (start, length) tuples, nearest first, passing over those whose
+        start is in hidden
+        '''
+        i = bisect_right(self._starts, block)
+        curr = self._extents[self._starts[i]] if i < len(self._starts) else None
+        while curr:
+            if curr.start not in hidden:
+                yield curr.start, curr.length
+            curr = curr.next
+
+    def _extent_from(self, block: int):
+        '''
+        Extent containing block, or the first extent after it if block is not free
+        '''
+        i = bisect_right(self._starts, block) - 1
+        if i < 0 or self._starts[i] + self._extents[self._starts[i]].length <= block:
+            i += 1
+        return self._extents[self._starts[i]] if i < len(self._starts) else None
+
+    def _take_front(self, extent: Extent, count: int) -> int:
+        '''
+        Removes count blocks from the front of extent, unlinking it if it is used up entirely. The remainder is split
+        off in place, keeping the same node.
+        '''
+        first_block = extent.start
+        if extent.length == count:
+            self._unlink(extent)
+        else:
+            self._unindex(extent)
+            extent.start += count
+            extent.length -= count
+            self._index(extent)
+        self.free_blocks -= count
+        return first_block
+
+    def _link(self, prev, extent: Extent, index: bool = True) -> None:
+        '''
+        Inserts extent into the list after prev (which may be the map itself, acting as head sentinel)
+        '''
+        extent.prev = prev if prev is not self else None
+        extent.next = prev.next
+        if extent.next:
+            extent.next.prev = extent
+        prev.next = extent
+        if index:
+            self._index(extent)
+
+    def _unlink(self, extent: Extent) -> None:
+        '''
+        Removes extent from the list and from the indexes
+        '''
+        self._unindex(extent)
+        prev = extent.prev if extent.prev else self
+        prev.next = extent.next
+        if extent.next:
+            extent.next.prev = extent.prev
+
+    def _index(self, extent: Extent) -> None:
+        self._extents[extent.start] = extent
+        insort(self._starts, extent.start)
+        insort(self._by_size, (extent.length, extent.start))
+
+    def _unindex(self, extent: Extent) -> None:
+        del self._extents[extent.start]
+        del self._starts[bisect_left(self._starts, extent.start)]
+        del self._by_size[bisect_left(self._by_size, (extent.length, extent.start))]
+
+def _nearest(before, after, count: int, block: int, window: int) -> tuple:
+    '''
+    Finds the placement of count blocks closest to block, as described in FreeMap.near_fit, without allocating it. A
+    placement within an extent is clamped to the extent, and its distance is the number of blocks between it and block.
+    Extents before block only get further away, as do those after it, so each side stops at its first fit.
+
+    :param before: iterable of (start, length) tuples of extents starting at or before block, nearest first
+    :param after: iterable of (start, length) tuples of extents starting after block, nearest first
+    :return: tuple of ((distance, first block) or None, number of extents examined)
+    '''
+    found = None
+    visited = 0
+    for start, length in islice(before, window):
+        visited += 1
+        if length >= count:
+            first = min(block, start + length - count)
+            found = (max(block - first - count, 0), first)
+            break
+    for start, length in islice(after, window):
+        visited += 1
+        if length >= count:
+            candidate = (start - block, start)
+            found = min(found, candidate) if found else candidate
+            break
+    return found, visited
+
+class FreeMapFork:
+    # Smallest change, in extents, at which a fork is folded into a new base
+    FLATTEN_MIN = 256
+
+    def __init__(self, base: FreeMap, hidden: set = None, changed: FreeMap = None, rover: int = 0,
+                 hidden_blocks: int = 0, hidden_sizes: list = None):
+        '''
+        A free map layered on a FreeMap that is never written to, which any number of forks may share. Extents of the
+        base are pulled into a small map of the fork's own before they are changed, and hidden in the base, so a fork
+        costs memory only for the extents it has touched. A freed run pulls in the base extents either side of it
+        first, so the visible base extents and the fork's own never need merging with each other. Once the fork has
+        touched more than a quarter of the base it is folded into a new base, keeping searches that skip hidden
+        extents cheap.
+            base: the shared map
+            hidden: set of start blocks of base extents that have been pulled
+            hidden_sizes: sorted list of the base size index's (length, start) entries for pulled extents, bisected
+                          to skip runs of hidden entries in logarithmic time
+            changed: FreeMap of the extents that have been pulled, as changed since, and runs freed by the fork
+            rover: block after the end of the last next fit allocation
+            hidden_blocks: number of blocks in hidden extents
+
+        :param base: the map to fork, which must not be written to afterwards
+        '''
+        self._base = base
+        self._hidden = hidden if hidden is not None else set()
+        self._hidden_sizes = hidden_sizes if hidden_sizes is not None else []
+        self._changed = changed if changed is not None else FreeMap(0)
+        self._rover = rover
+        self._hidden_blocks = hidden_blocks
+        self.visited = 0
+
+    @classmethod
+    def of(cls, free_map: FreeMap) -> 'FreeMapFork':
+        '''
+        Fork of free_map, which must not be written to afterwards
+        '''
+        return cls(free_map, rover=free_map._rover)
+
+    def fork(self) -> 'FreeMapFork':
+        '''
+        Another fork with the same contents, in time proportional to the extents this one has touched
+        '''
+        return FreeMapFork(self._base, set(self._hidden), self._changed.copy(), self._rover, self._hidden_blocks,
+                           list(self._hidden_sizes))
+
+    @property
+    def free_blocks(self) -> int:
+        return self._base.free_blocks - self._hidden_blocks + self._changed.free_blocks
+
+    def __iter__(self):
+        '''
+        Iterates over free extents in ascending address order as (start, length) tuples
+        '''
+        return heapq.merge(self._visible(self._base.next), iter(self._changed))
+
+    def __len__(self) -> int:
+        return len(self._base) - len(self._hidden) + len(self._changed)
+
+    def largest(self) -> int:
+        by_size = self._base._by_size
+        i = self._last_visible()
+        return max(by_size[i][0] if i >= 0 else 0, self._changed.largest())
+
+    def largest_extent(self):
+        length = self.largest()
+        if not length:
+            return None
+        candidates = [self._smallest_visible_fit(length), self._smallest_fit(self._changed._by_size, length)]
+        return min((start, fit) for fit, start in filter(None, candidates) if fit == length)
+
+    def first_fit(self, count: int, floor: int = 0):
+        self.visited = 0
+        if count > self.largest():
+            return None
+        return self._take_first(count, floor)
+
+    def next_fit(self, count: int):
+        self.visited = 0
+        if count > self.largest():
+            return None
+        first_block = self._take_first(count, self._rover)
+        if first_block is None:
+            first_block = self._take_first(count, 0)
+        self._rover = first_block + count
+        return first_block
+
+    def best_fit(self, count: int):
+        self.visited = 1
+        candidates = [self._smallest_visible_fit(count), self._smallest_fit(self._changed._by_size, count)]
+        candidates = [candidate for candidate in candidates if candidate]
+        if not candidates:
+            return None
+        length, start = min(candidates)
+        self.take(start, count)
+        return start
+
+    def near_fit(self, count: int, block: int, window: int = 16):
+        self._flatten_if_large()
+        before = heapq.merge(self._base._extents_before(block, self._hidden), self._changed._extents_before(block),
+                             reverse=True)
+        after = heapq.merge(self._base._extents_after(block, self._hidden), self._changed._extents_after(block))
+        found, self.visited = _nearest(before, after, count, block, window)
+        if found is None:
+            return None
+        self.take(found[1], count)
+        return found[1]
+
+    def take(self, start: int, count: int) -> None:
+        self._flatten_if_large()
+        extent = self._base._extent_from(start)
+        if extent and extent.start <= start and extent.start not in self._hidden:
+            self._pull(extent)
+        self._changed.take(start, count)
+
+    def free(self, start: int, count: int) -> None:
+        self._flatten_if_large()
+        before = self._base._extent_from(start - 1) if start else None
+        if before and before.start + before.length == start and before.start not in self._hidden:
+            self._pull(before)
+        after = self._base._extents.get(start + count)
+        if after and after.start not in self._hidden:
+            self._pull(after)
+        self._changed.free(start, count)
+
+    def free_many(self, extents: list) -> None:
+        for start, count in extents:
+            self.free(start, count)
+
+    def load(self, extents: list) -> None:
+        self._base = FreeMap(0)
+        self._base.load(extents)
+        self._hidden = set()
+        self._hidden_sizes = []
+        self._changed = FreeMap(0)
+        self._hidden_blocks = 0
+
+    def _take_first(self, count: int, floor: int):
+        '''
+        Allocates count blocks from the lowest addressed extent large enough that contains or follows floor, as
+        FreeMap.first_fit does
+
+        :return: first block allocated, or None if there is no such extent
+        '''
+        found = None
+        for source, visible in ((self._base, True), (self._changed, False)):
+            curr = source._extent_from(floor) if floor else source.next
+            while curr and (found is None or curr.start < found):
+                self.visited += 1
+                if curr.length >= count and not (visible and curr.start in self._hidden):
+                    found = curr.start
+                    break
+                curr = curr.next
+        if found is not None:
+            self.take(found, count)
+        return found
+
+    @staticmethod
+    def _smallest_fit(by_size: list, count: int):
+        '''
+        Smallest (length, start) entry of a size index with length of at least count
+        '''
+        i = bisect_left(by_size, (count, -1))
+        return by_size[i] if i < len(by_size) else None
+
+    def _smallest_visible_fit(self, count: int):
+        '''
+        Smallest (length, start) entry of the base's size index with length of at least count that has not been
+        pulled. Hidden entries are skipped by bisecting for the end of the run of them, rather than one at a time, and
+        each entry examined while bisecting is counted in visited.
+        '''
+        by_size = self._base._by_size
+        i = bisect_left(by_size, (count, -1))
+        self.visited += 1
+        if i < len(by_size) and by_size[i][1] in self._hidden:
+            # by_size[i:k + 1] is all hidden while as many of its entries are in hidden_sizes
+            hidden_sizes = self._hidden_sizes
+            first = bisect_left(hidden_sizes, by_size[i])
+            lo, hi = i + 1, len(by_size)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                self.visited += 1
+                if bisect_right(hidden_sizes, by_size[mid]) - first == mid - i + 1:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            i = lo
+        return by_size[i] if i < len(by_size) else None
+
+    def _last_visible(self) -> int:
+        '''
+        Index of the largest entry of the base's size index that has not been pulled, or -1 if there is none. Entries
+        examined while bisecting are counted in visited.
+        '''
+        by_size = self._base._by_size
+        hidden_sizes = self._hidden_sizes
+        if not by_size or by_size[-1][1] not in self._hidden:
+            return len(by_size) - 1
+        # by_size[k:] is all hidden while as many of its entries are in hidden_sizes
+        lo, hi = 0, len(by_size) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            self.visited += 1
+            if len(hidden_sizes) - bisect_left(hidden_sizes, by_size[mid]) == len(by_size) - mid:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo - 1
+
+    def _visible(self, curr):
+        while curr:
+            if curr.start not in self._hidden:
+                yield curr.start, curr.length
+            curr = curr.next
+
+    def _pull(self, extent: Extent) -> None:
+        self._hidden.add(extent.start)
+        insort(self._hidden_sizes, (extent.length, extent.start))
+        self._hidden_blocks += extent.length
+        self._changed.free(extent.start, extent.length)
+
+    def _flatten_if_large(self) -> None:
+        if len(self._hidden) + len(self._changed) > max(self.FLATTEN_MIN, len(self._base) // 4):
+            rover = self._rover
+            self.load(list(self))
+            self._rover = rover
@@ -0,0 +1,46 @@
+# Index of free chunks for compaction, finding the lowest addressed chunk that fits a file in logarithmic time
+class HoleTree:
+    def __init__(self, holes: list):
+        '''
+        Holds free chunks in ascending address order. Chunks only ever shrink from their start, as files are moved
+        into them, so their address order never changes.
+            starts: start block of each chunk, in ascending address order
+            size: number of leaves in the tree, the number of chunks rounded up to a power of two
+            largest: array backed binary tree, node i having children 2i and 2i + 1, in which each node holds the
+                     largest length of the chunks below it. Leaf size + j holds the length of chunk j.
+
+        :param holes: list of (start, length) of free chunks, in ascending address order
+        '''
+        self._starts = [start for start, length in holes]
+        self._size = 1
+        while self._size < len(holes):
+            self._size *= 2
+        self._largest = [0] * (2 * self._size)
+        for j, (start, length) in enumerate(holes):
+            self._largest[self._size + j] = length
+        for i in range(self._size - 1, 0, -1):
+            self._largest[i] = max(self._largest[2 * i], self._largest[2 * i + 1])
+
+    def take(self, count: int, below: int):
+        '''
+        Takes count blocks from the start of the lowest addressed chunk that has at least count blocks and starts
+        below block below, in O(log n) time
+
+        :return: first block taken, or None if there is no such chunk
+        '''
+        largest = self._largest
+        if largest[1] < count:
+            return None
+        i = 1
+        while i < self._size:
+            i = 2 * i if largest[2 * i] >= count else 2 * i + 1
+        start = self._starts[i - self._size]
+        if start >= below:
+            return None
+        self._starts[i - self._size] = start + count
+        largest[i] -= count
+        i //= 2
+        while i:
+            largest[i] = max(largest[2 * i], largest[2 * i + 1])
+            i //= 2
+        return start
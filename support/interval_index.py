@@ -0,0 +1,59 @@
+# Index from allocated blocks back to the files that own them
+from bisect import bisect_left, bisect_right, insort
+
+class IntervalIndex:
+    def __init__(self):
+        '''
+        Creates an empty index of non-overlapping extents, each owned by a file.
+            starts: sorted list of extent start blocks, bisected to find the extent containing a block
+            extents: hashmap (dict) of start block -> (count, file_id)
+        '''
+        self._starts = []
+        self._extents = {}
+
+    def __len__(self) -> int:
+        '''
+        Number of extents
+        '''
+        return len(self._starts)
+
+    def add(self, start: int, count: int, file_id: str) -> None:
+        '''
+        Records that file_id owns the count blocks at start
+        '''
+        insort(self._starts, start)
+        self._extents[start] = (count, file_id)
+
+    def remove(self, start: int) -> None:
+        '''
+        Forgets the extent starting at start
+        '''
+        del self._starts[bisect_left(self._starts, start)]
+        del self._extents[start]
+
+    def owner(self, block: int):
+        '''
+        File owning block, or None if it is not allocated
+        '''
+        i = bisect_right(self._starts, block) - 1
+        if i < 0:
+            return None
+        start = self._starts[i]
+        count, file_id = self._extents[start]
+        return file_id if block < start + count else None
+
+    def overlapping(self, start: int, stop: int) -> list:
+        '''
+        Extents that overlap blocks start to stop - 1
+
+        :return: list of (start, count, file_id) tuples in ascending address order
+        '''
+        i = max(bisect_right(self._starts, start) - 1, 0)
+        found = []
+        while i < len(self._starts) and self._starts[i] < stop:
+            extent_start = self._starts[i]
+            count, file_id = self._extents[extent_start]
+            if extent_start + count > start:
+                found.append((extent_start, count, file_id))
+            i += 1
+        return found
@@ -0,0 +1,151 @@
+# Append-only journal of file placements, with group commit and numbered checkpoints
+from functools import wraps
+import json
+import os
+import threading
+import zlib
+
+# A journal directory holds one generation at a time: checkpoint.<n>, a snapshot of the allocator (see
+# support/snapshot.py), and journal.<n>, the records of every change made since. Each record is a line of
+# '<crc32 in hex> <JSON [event, file_id, extents]>', event being one of 'save', 'delete' or 'move'. A newer checkpoint
+# is always complete before the older generation is removed, so the highest numbered checkpoint plus its journal is
+# the latest durable state.
+
+class Journal:
+    def __init__(self, directory: str, generation: int, group_commit: int = 64, commit_window: float = 0.005,
+                 checkpoint_every: int = 10000):
+        '''
+        Creates an empty journal for the given generation. Records are buffered and written with a single fsync once
+        group_commit of them are pending, or commit_window seconds after the first of them was appended, whichever
+        comes first.
+            pending: list of encoded records not yet written
+            appended: number of records appended since the journal was created
+            timer: thread that flushes the pending records at the end of the commit window, or None if not running
+
+        :param directory: directory holding the checkpoint and journal
+        :param generation: number of the checkpoint this journal follows
+        :param group_commit: most records to buffer before writing them. 1 writes every record as it is appended.
+        :param commit_window: most seconds a record stays buffered. None to only write when group_commit is reached
+                              or flush is called.
+        :param checkpoint_every: records after which checkpoint_due becomes True
+        '''
+        if group_commit <= 0:
+            raise ValueError('Group commit must be greater than 0')
+        self.directory = directory
+        self.generation = generation
+        self.group_commit = group_commit
+        self.commit_window = commit_window
+        self.checkpoint_every = checkpoint_every
+        self.appended = 0
+        self._file = open(self.log_path(directory, generation), 'wb')
+        self._pending = []
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def append(self, event: str, file_id: str, extents: tuple) -> None:
+        '''
+        Buffers a record of a file being saved, deleted or moved to the given extents
+        '''
+        payload = json.dumps([event, file_id, extents], separators=(',', ':')).encode()
+        record = b'%08x %s\n' % (zlib.crc32(payload), payload)
+        with self._lock:
+            self._pending.append(record)
+            self.appended += 1
+            if len(self._pending) >= self.group_commit:
+                self._write()
+            elif self._timer is None and self.commit_window is not None:
+                self._timer = threading.Timer(self.commit_window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self) -> None:
+        '''
+        Writes and fsyncs every pending record
+        '''
+        with self._lock:
+            self._write()
+
+    def checkpoint_due(self) -> bool:
+        '''
+        Whether checkpoint_every records have been appended since the last checkpoint
+        '''
+        return self.appended >= self.checkpoint_every
+
+    def close(self) -> None:
+        '''
+        Writes any pending records and closes the journal
+        '''
+        with self._lock:
+            self._write()
+            self._file.close()
+
+    def _write(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pending and not self._file.closed:
+            self._file.write(b''.join(self._pending))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending.clear()
+
+    @staticmethod
+    def checkpoint_path(directory: str, generation: int) -> str:
+        return os.path.join(directory, 'checkpoint.{}'.format(generation))
+
+    @staticmethod
+    def log_path(directory: str, generation: int) -> str:
+        return os.path.join(directory, 'journal.{}'.format(generation))
+
+    @staticmethod
+    def latest_generation(directory: str):
+        '''
+        Number of the most recent complete checkpoint in directory, or None if there is none
+        '''
+        generations = [int(name.split('.')[1]) for name in os.listdir(directory)
+                       if name.startswith('checkpoint.') and name.split('.')[1].isdigit()]
+        return max(generations, default=None)
+
+    @staticmethod
+    def read(path: str) -> list:
+        '''
+        Reads the records of a journal, stopping at the first one that is incomplete or corrupt, as the last group
+        being written when the process stopped may be
+
+        :return: list of (event, file_id, extents) tuples, where extents is a tuple of (start, count) tuples
+        '''
+        records = []
+        if not os.path.exists(path):
+            return records
+        with open(path, 'rb') as f:
+            for line in f:
+                checksum, _, payload = line.rstrip(b'\n').partition(b' ')
+                if not line.endswith(b'\n') or checksum != b'%08x' % zlib.crc32(payload):
+                    break
+                event, file_id, extents = json.loads(payload)
+                records.append((event, file_id, tuple((start, count) for start, count in extents)))
+        return records
+
+    @staticmethod
+    def remove_before(directory: str, generation: int) -> None:
+        '''
+        Removes the checkpoints and journals of every generation older than the given one
+        '''
+        for name in os.listdir(directory):
+            prefix, _, number = name.partition('.')
+            if prefix in ('checkpoint', 'journal') and number.isdigit() and int(number) < generation:
+                os.remove(os.path.join(directory, name))
+
+def journaled(method):
+    '''
+    Decorates an Allocation method that changes file placements so that, when the instance has a journal open and
+    enough records have been appended since the last checkpoint, a new checkpoint is taken once the call completes
+    '''
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            if self._journal and self._journal.checkpoint_due():
+                self.checkpoint()
+    return wrapper
@@ -0,0 +1,88 @@
+# Opt-in operation counters and histograms for an Allocation
+from functools import wraps
+from time import perf_counter_ns
+
+class Metrics:
+    def __init__(self):
+        '''
+        Creates an empty set of metrics. Histograms are bucketed by powers of two, keyed by the bucket's upper bound,
+        so recording a value is a dict increment.
+            operations: hashmap (dict) of operation -> number of calls, with failed calls also counted as
+                        '<operation>_failed'
+            latency_ns: hashmap (dict) of operation -> histogram of call latency in nanoseconds
+            visited: histogram of free map entries examined per search
+            bytes_allocated: total capacity taken by saves in Bytes
+            bytes_freed: total capacity returned by deletes in Bytes
+        '''
+        self.operations = {}
+        self.latency_ns = {}
+        self.visited = {}
+        self.bytes_allocated = 0
+        self.bytes_freed = 0
+
+    def record(self, operation: str, elapsed_ns: int) -> None:
+        '''
+        Counts a call to operation and adds its latency to the operation's histogram
+        '''
+        self.operations[operation] = self.operations.get(operation, 0) + 1
+        self._add(self.latency_ns.setdefault(operation, {}), elapsed_ns)
+
+    def record_failure(self, operation: str) -> None:
+        '''
+        Counts a call to operation that raised an error
+        '''
+        failed = operation + '_failed'
+        self.operations[failed] = self.operations.get(failed, 0) + 1
+
+    def record_search(self, visited: int) -> None:
+        '''
+        Adds the number of free map entries examined by a search to its histogram
+        '''
+        self._add(self.visited, visited)
+
+    def record_capacity(self, size: int) -> None:
+        '''
+        Adds a change in capacity used, positive when allocated and negative when freed, to the byte totals
+        '''
+        if size > 0:
+            self.bytes_allocated += size
+        else:
+            self.bytes_freed -= size
+
+    def to_dict(self) -> dict:
+        '''
+        Copy of all metrics as plain dicts
+        '''
+        return {
+            'operations': dict(self.operations),
+            'latency_ns': {operation: dict(histogram) for operation, histogram in self.latency_ns.items()},
+            'visited': dict(self.visited),
+            'bytes_allocated': self.bytes_allocated,
+            'bytes_freed': self.bytes_freed,
+        }
+
+    def _add(self, histogram: dict, value: int) -> None:
+        bucket = 1 << max(value - 1, 0).bit_length()
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+
+def instrumented(operation: str):
+    '''
+    Decorates an Allocation method so that, when the instance has metrics enabled, its calls, failures and latency are
+    recorded under operation. Without metrics the method is called directly with no timing.
+    '''
+    def decorate(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            metrics = self._metrics
+            if metrics is None:
+                return method(self, *args, **kwargs)
+            start = perf_counter_ns()
+            try:
+                return method(self, *args, **kwargs)
+            except ValueError:
+                metrics.record_failure(operation)
+                raise
+            finally:
+                metrics.record(operation, perf_counter_ns() - start)
+        return wrapper
+    return decorate
@@ -0,0 +1,120 @@
+# Segregated free lists of fixed-size slots for small files
+from bisect import bisect_left
+
+class SizeClassPools:
+    def __init__(self, classes: tuple, refill: int):
+        '''
+        Creates one free list per size class. Each list is a stack of start blocks of idle slots, so taking or
+        returning a slot is O(1). Slots are carved in bulk from the main free map by the owner of the pools.
+
+        idle: hashmap (dict) of slot size in blocks -> stack of start blocks of idle slots
+        in_use: hashmap (dict) of slot size in blocks -> number of slots currently holding a file
+
+        :param classes: slot sizes in blocks, e.g. (1, 2, 3, 4)
+        :param refill: number of slots carved from the main free map when a pool runs empty. Up to twice this many idle
+                       slots are kept per class, any more are handed back to the main free map.
+        '''
+        if not classes or any(not isinstance(c, int) or c <= 0 for c in classes):
+            raise ValueError('Size classes must be positive numbers of blocks')
+        if refill <= 0:
+            raise ValueError('Pool refill must be greater than 0')
+        self.classes = sorted(set(classes))
+        self.refill = refill
+        self._idle = {c: [] for c in self.classes}
+        self._in_use = {c: 0 for c in self.classes}
+
+    def __iter__(self):
+        '''
+        Iterates over idle slots as (start, length) tuples, in no particular order
+        '''
+        for slot_size, starts in self._idle.items():
+            for start in starts:
+                yield start, slot_size
+
+    def idle_blocks(self) -> int:
+        '''
+        Number of blocks held in idle slots
+        '''
+        return sum(slot_size * len(starts) for slot_size, starts in self._idle.items())
+
+    def slot_size(self, count: int):
+        '''
+        Smallest slot size that holds count blocks, or None if count is too large to be pooled
+        '''
+        i = bisect_left(self.classes, count)
+        return self.classes[i] if i < len(self.classes) else None
+
+    def pop(self, slot_size: int):
+        '''
+        Takes an idle slot of the given size
+
+        :return: first block of the slot, or None if the pool is empty
+        '''
+        idle = self._idle[slot_size]
+        if not idle:
+            return None
+        self._in_use[slot_size] += 1
+        return idle.pop()
+
+    def push(self, slot_size: int, start: int) -> bool:
+        '''
+        Returns a slot that no longer holds a file to its pool
+
+        :return: False if the pool is already full, in which case the slot should go back to the main free map
+        '''
+        self._in_use[slot_size] -= 1
+        idle = self._idle[slot_size]
+        if len(idle) >= 2 * self.refill:
+            return False
+        idle.append(start)
+        return True
+
+    def adopt(self, slot_size: int) -> None:
+        '''
+        Counts a slot taken directly from the main free map as holding a file, e.g. when replaying a journal
+        '''
+        self._in_use[slot_size] += 1
+
+    def release(self, slot_size: int) -> None:
+        '''
+        Counts a slot as no longer holding a file without returning it to the pool, e.g. when its blocks have been
+        handed back to the main free map directly
+        '''
+        self._in_use[slot_size] -= 1
+
+    def fill(self, slot_size: int, start: int, slots: int) -> None:
+        '''
+        Adds a run of slots carved from the main free map. They are stacked so the lowest address is handed out first.
+        '''
+        self._idle[slot_size].extend(range(start + (slots - 1) * slot_size, start - 1, -slot_size))
+
+    def drain(self) -> list:
+        '''
+        Empties every pool of its idle slots
+
+        :return: list of (start, length) tuples of the slots removed, to be returned to the main free map
+        '''
+        slots = list(self)
+        for starts in self._idle.values():
+            starts.clear()
+        return slots
+
+    def occupancy(self) -> dict:
+        '''
+        Idle and in use slot counts for each size class, keyed by slot size in blocks
+        '''
+        return {c: {'idle': len(self._idle[c]), 'in_use': self._in_use[c]} for c in self.classes}
+
+    def to_dict(self) -> dict:
+        '''
+        Copy of the idle slots and in use counts of every size class, as plain dicts that can be passed to load
+        '''
+        return {'idle': {c: list(self._idle[c]) for c in self.classes}, 'in_use': dict(self._in_use)}
+
+    def load(self, state: dict) -> None:
+        '''
+        Replaces the idle slots and in use counts with those from to_dict. Slot sizes may be given as strings, as they
+        are after a round trip through JSON.
+        '''
+        self._idle = {c: list(state['idle'].get(c, state['idle'].get(str(c), []))) for c in self.classes}
+        self._in_use = {c: state['in_use'].get(c, state['in_use'].get(str(c), 0)) for c in self.classes}
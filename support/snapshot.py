@@ -0,0 +1,203 @@
+# Compact binary image of allocator state, read back through mmap
+from array import array
+from collections.abc import MutableMapping
+import json
+import mmap
+import os
+import struct
+import sys
+
+# Layout of an image, every section starting on an 8 byte boundary:
+#     header: HEADER fields, see below
+#     config: JSON object of the settings needed to recreate the Allocation
+#     free: num_free pairs of int64 (start, length), in ascending address order
+#     index: num_files quads of int64 (key offset, key length, first extent, extent count), sorted by file_id bytes
+#     keys: keys_len bytes of UTF-8 file_ids, concatenated
+#     extents: num_extents pairs of int64 (start, count)
+# Integer arrays are in the byte order of the machine that wrote the image, which is recorded in the config.
+MAGIC = b'ALLOCSN1'
+HEADER = struct.Struct('<8sQQQQQQQQQ')
+INDEX_FIELDS = 4
+
+class Snapshot:
+    def __init__(self, path: str):
+        '''
+        Opens an image with mmap. Nothing beyond the header and config is decoded until asked for.
+
+        :param path: path of an image written by Snapshot.write
+        '''
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < HEADER.size or self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError('{} is not an allocation snapshot'.format(path))
+
+        (magic, capacity, block, capacity_used, internal_fragmentation, num_free, num_files, keys_len, num_extents,
+         config_len) = HEADER.unpack_from(self._mmap)
+        self.header = {
+            'capacity': capacity,
+            'block': block,
+            'capacity_used': capacity_used,
+            'internal_fragmentation': internal_fragmentation,
+        }
+
+        offset = HEADER.size
+        self.config = json.loads(bytes(self._mmap[offset:offset + config_len]))
+        if self.config.pop('byteorder') != sys.byteorder:
+            raise ValueError('{} was written on a machine with a different byte order'.format(path))
+
+        view = memoryview(self._mmap)
+        offset = _aligned(offset + config_len)
+        self._free = view[offset:offset + num_free * 16].cast('q')
+        offset += num_free * 16
+        self._index = view[offset:offset + num_files * INDEX_FIELDS * 8].cast('q')
+        offset += num_files * INDEX_FIELDS * 8
+        self._keys = view[offset:offset + keys_len]
+        offset = _aligned(offset + keys_len)
+        self._extents = view[offset:offset + num_extents * 16].cast('q')
+        self.num_files = num_files
+
+    @staticmethod
+    def write(path: str, header: dict, config: dict, free: list, files: list) -> None:
+        '''
+        Writes an image to path, replacing any existing file only once the new image is complete
+
+        :param header: capacity, block, capacity_used and internal_fragmentation, all in bytes
+        :param config: JSON serializable settings needed to recreate the Allocation
+        :param free: list of (start, length) tuples of free runs, in ascending address order
+        :param files: list of (file_id, extents) tuples, where extents is a tuple of (start, count) tuples
+        '''
+        config = dict(config, byteorder=sys.byteorder)
+        config_bytes = json.dumps(config).encode()
+
+        entries = sorted((file_id.encode(), extents) for file_id, extents in files)
+        index = array('q')
+        extents_array = array('q')
+        keys = bytearray()
+        for key, extents in entries:
+            index.extend((len(keys), len(key), len(extents_array) // 2, len(extents)))
+            keys += key
+            for start, count in extents:
+                extents_array.extend((start, count))
+
+        free_array = array('q')
+        for start, length in free:
+            free_array.extend((start, length))
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, header['capacity'], header['block'], header['capacity_used'],
+                                header['internal_fragmentation'], len(free_array) // 2, len(entries), len(keys),
+                                len(extents_array) // 2, len(config_bytes)))
+            for section in (config_bytes, free_array.tobytes(), index.tobytes(), bytes(keys), extents_array.tobytes()):
+                f.write(section)
+                f.write(b'\0' * (-len(section) % 8))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def free(self):
+        '''
+        Iterates over free runs as (start, length) tuples, in ascending address order
+        '''
+        free = self._free
+        for i in range(0, len(free), 2):
+            yield free[i], free[i + 1]
+
+    def key(self, i: int) -> bytes:
+        '''
+        UTF-8 file_id of the i-th file in the index
+        '''
+        base = i * INDEX_FIELDS
+        offset = self._index[base]
+        return bytes(self._keys[offset:offset + self._index[base + 1]])
+
+    def extents(self, i: int) -> tuple:
+        '''
+        Extents of the i-th file in the index
+        '''
+        base = i * INDEX_FIELDS
+        first = self._index[base + 2] * 2
+        ext = self._extents
+        return tuple((ext[j], ext[j + 1]) for j in range(first, first + self._index[base + 3] * 2, 2))
+
+    def find(self, key: bytes):
+        '''
+        Binary searches the index for a UTF-8 file_id
+
+        :return: position of the file in the index, or None if it is not in the image
+        '''
+        low = 0
+        high = self.num_files
+        while low < high:
+            mid = (low + high) // 2
+            if self.key(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self.num_files and self.key(low) == key:
+            return low
+        return None
+
+class SnapshotFileTable(MutableMapping):
+    def __init__(self, snapshot: Snapshot):
+        '''
+        A file_id -> extents mapping backed by an image's file table, decoding entries only as they are looked up.
+        Changes are kept in memory on top of the image, which is never written to.
+            overlay: hashmap (dict) of file_id -> extents saved or moved since the image was taken
+            deleted: set of file_ids in the image that have since been deleted or moved
+        '''
+        self._snapshot = snapshot
+        self._overlay = {}
+        self._deleted = set()
+        self._len = snapshot.num_files
+
+    def __getitem__(self, file_id: str) -> tuple:
+        if file_id in self._overlay:
+            return self._overlay[file_id]
+        if file_id not in self._deleted:
+            i = self._snapshot.find(file_id.encode())
+            if i is not None:
+                return self._snapshot.extents(i)
+        raise KeyError(file_id)
+
+    def __setitem__(self, file_id: str, extents: tuple) -> None:
+        if file_id not in self:
+            self._len += 1
+        self._overlay[file_id] = extents
+        if file_id not in self._deleted and self._snapshot.find(file_id.encode()) is not None:
+            self._deleted.add(file_id)
+
+    def __delitem__(self, file_id: str) -> None:
+        if file_id not in self:
+            raise KeyError(file_id)
+        self._len -= 1
+        self._overlay.pop(file_id, None)
+        if self._snapshot.find(file_id.encode()) is not None:
+            self._deleted.add(file_id)
+
+    def __contains__(self, file_id) -> bool:
+        try:
+            self[file_id]
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        for file_id, extents in self.items():
+            yield file_id
+
+    def __len__(self) -> int:
+        return self._len
+
+    def items(self):
+        '''
+        Iterates over (file_id, extents) tuples, decoding the image's file table in a single pass
+        '''
+        for i in range(self._snapshot.num_files):
+            file_id = self._snapshot.key(i).decode()
+            if file_id not in self._deleted:
+                yield file_id, self._snapshot.extents(i)
+        yield from self._overlay.items()
+
+def _aligned(offset: int) -> int:
+    return offset + (-offset % 8)
@@ -0,0 +1,149 @@
+# Synthetic and recorded operation traces for replaying against an Allocation
+import random
+
+# Each operation is a tuple of one of:
+#     ('save', file_id, size, unit)
+#     ('read', file_id)
+#     ('delete', file_id)
+
+# All generators take the capacity of the device in blocks and the block size in bytes, and emit sizes in bytes that
+# are whole numbers of blocks.
+
+def uniform(ops: int, capacity: int, block: int, seed: int = 0, max_size: int = 64, fill: float = 0.7) -> list:
+    '''
+    Saves of uniformly distributed sizes, deleting random live files whenever the device is fuller than fill
+
+    :param ops: number of operations to generate
+    :param capacity: capacity of the device in blocks
+    :param block: size of block in bytes
+    :param seed: seed for the random number generator
+    :param max_size: largest file size in blocks
+    :param fill: fraction of capacity to hover around
+    :return: list of operations
+    '''
+    rng = random.Random(seed)
+    return _steady_state(ops, capacity, block, rng, lambda: rng.randint(1, max_size), fill)
+
+def zipf(ops: int, capacity: int, block: int, seed: int = 0, max_size: int = 1024, exponent: float = 1.2,
+         fill: float = 0.7) -> list:
+    '''
+    Saves of Zipf distributed sizes (many small files, few very large ones), deleting random live files whenever the
+    device is fuller than fill
+    '''
+    rng = random.Random(seed)
+    sizes = range(1, max_size + 1)
+    cum_weights = []
+    total = 0
+    for size in sizes:
+        total += size ** -exponent
+        cum_weights.append(total)
+    return _steady_state(ops, capacity, block, rng, lambda: rng.choices(sizes, cum_weights=cum_weights)[0], fill)
+
+def bursty_churn(ops: int, capacity: int, block: int, seed: int = 0, max_size: int = 16, burst: int = 200) -> list:
+    '''
+    Alternating bursts of saves of short-lived files and bursts deleting most of them, over a background of long-lived
+    files that are never deleted, which leaves the device increasingly fragmented
+    '''
+    rng = random.Random(seed)
+    trace = []
+    live = []
+    used = 0
+    counter = 0
+    while len(trace) < ops:
+        progress = len(trace)
+        for i in range(min(burst, ops - len(trace))):
+            size = rng.randint(1, max_size)
+            if used + size > capacity:
+                break
+            counter += 1
+            file_id = str(counter)
+            trace.append(('save', file_id, size * block, 'b'))
+            used += size
+            # Roughly one file in ten lives for the rest of the trace
+            if rng.random() >= 0.1:
+                live.append((file_id, size))
+        rng.shuffle(live)
+        while len(live) > burst // 10 and len(trace) < ops:
+            file_id, size = live.pop()
+            trace.append(('delete', file_id))
+            used -= size
+        if len(trace) == progress:  # Device is full of long-lived files
+            break
+    return trace
+
+def fill_to_full(ops: int, capacity: int, block: int, seed: int = 0, max_size: int = 64) -> list:
+    '''
+    Saves of uniformly distributed sizes with no deletes, until ops have been generated or the device is full
+    '''
+    rng = random.Random(seed)
+    trace = []
+    used = 0
+    while len(trace) < ops and used < capacity:
+        size = rng.randint(1, max_size)
+        trace.append(('save', str(len(trace) + 1), size * block, 'b'))
+        used += size
+    return trace
+
+SYNTHETIC = {
+    'uniform': uniform,
+    'zipf': zipf,
+    'churn': bursty_churn,
+    'fill': fill_to_full,
+}
+
+def parse(lines) -> list:
+    '''
+    Parses a recorded trace, one operation per line: 'save <file_id> <size> [unit]', 'read <file_id>' or
+    'delete <file_id>'. The unit defaults to b. Blank lines and lines starting with # are skipped.
+
+    :param lines: iterable of lines, e.g. an open file
+    :return: list of operations
+    '''
+    trace = []
+    for number, line in enumerate(lines, 1):
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        trace.append(parse_operation(fields, number))
+    return trace
+
+def parse_operation(fields: list, number: int = 0) -> tuple:
+    '''
+    Parses the fields of a single trace line into an operation
+
+    :param fields: the line split on whitespace
+    :param number: line number, used in error messages
+    '''
+    command = fields[0].lower()
+    if command == 'save' and len(fields) in (3, 4) and fields[2].isdigit():
+        return ('save', fields[1], int(fields[2]), fields[3].lower() if len(fields) == 4 else 'b')
+    elif command in ('read', 'delete') and len(fields) == 2:
+        return (command, fields[1])
+    raise ValueError('Line {}: could not parse {!r}'.format(number, ' '.join(fields)))
+
+def dump(trace: list) -> str:
+    '''
+    Formats a trace in the format read by parse
+    '''
+    return ''.join(' '.join(str(field) for field in operation) + '\n' for operation in trace)
+
+def _steady_state(ops: int, capacity: int, block: int, rng: random.Random, next_size, fill: float) -> list:
+    trace = []
+    live = []
+    used = 0
+    counter = 0
+    while len(trace) < ops:
+        if live and used > capacity * fill:
+            i = rng.randrange(len(live))
+            live[i], live[-1] = live[-1], live[i]
+            file_id, size = live.pop()
+            trace.append(('delete', file_id))
+            used -= size
+        else:
+            size = next_size()
+            counter += 1
+            file_id = str(counter)
+            trace.append(('save', file_id, size * block, 'b'))
+            live.append((file_id, size))
+            used += size
+    return trace